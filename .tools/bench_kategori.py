@@ -0,0 +1,134 @@
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime
+
+# Måler watcher.compute_kategori (den kompilerede KategoriClassifier) mod den tidligere
+# implementering (strptime pr. fænologiperiode og slugify af afdelingerne pr. række) på en
+# optaget dagseksport, og tjekker at de to giver samme kategori for hver række.
+#
+# Brug (fra repo-roden):
+#   python .tools/bench_kategori.py eksport.csv          # rå DOFbasen-eksport (som watcheren henter)
+#   python .tools/bench_kategori.py downloads/observationer_20261018120000.json
+#   python .tools/bench_kategori.py                      # syntetisk dag ud fra referencedata
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, ROOT)
+import watcher
+
+
+# --- Reference: compute_kategori som den så ud før kompileringen ---
+def _dato_in_faenologi_periode(obsdato, perioder):
+    try:
+        obs_dt = datetime.strptime(obsdato[:5], "%d-%m")
+    except Exception:
+        return False
+    for fra, til in perioder:
+        try:
+            fra_dt = datetime.strptime(fra, "%d-%m")
+            til_dt = datetime.strptime(til, "%d-%m")
+        except Exception:
+            continue
+        if fra_dt <= til_dt:
+            if fra_dt <= obs_dt <= til_dt:
+                return True
+        else:
+            if obs_dt >= fra_dt or obs_dt <= til_dt:
+                return True
+    return False
+
+
+def reference_kategori(row):
+    art = (row.get("Artnavn") or "").strip().strip("[]")
+    obsdato = (row.get("Dato") or "").strip()
+    klass = watcher.KLASS_MAP.get(art)
+    if klass == "SU":
+        return "SU"
+    if klass == "SUB":
+        return "SUB"
+    perioder = watcher.FAENOLOGI_PERIODER.get(art)
+    if perioder and obsdato and _dato_in_faenologi_periode(obsdato, perioder):
+        return "bemaerk"
+    afdeling_raw = row.get("DOF_afdeling") or ""
+    afdelinger = [s.strip() for s in str(afdeling_raw).split("|") if s.strip()]
+    if not afdelinger:
+        afdelinger = [str(afdeling_raw).strip()] if str(afdeling_raw).strip() else []
+    for afd in afdelinger:
+        thresholds = watcher.BEMAERK_BY_REGION.get(watcher.to_region_slug(afd)) or {}
+        thr = thresholds.get(art)
+        if thr is not None and watcher.parse_float(row.get("Antal")) >= float(thr):
+            return "bemaerk"
+    return "alm"
+
+
+def load_rows(path):
+    if path.endswith(".json"):
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    with open(path, "rb") as f:
+        raw = f.read()
+    return list(watcher.iter_rows(watcher.iter_lines(watcher.iter_decoded([raw]))))
+
+
+def synthetic_rows(n):
+    """En dag med arter fra referencedata, tilfældige datoer, afdelinger og antal."""
+    species = sorted(set(watcher.KLASS_MAP) | set(watcher.FAENOLOGI_PERIODER))
+    regions = [f"DOF {slug.replace('oe', 'ø').replace('ae', 'æ').title()}" for slug in watcher.BEMAERK_BY_REGION]
+    rows = []
+    for _ in range(n):
+        d = random.randint(1, 365)
+        dato = datetime.fromordinal(datetime(2026, 1, 1).toordinal() + d - 1).strftime("%d-%m-%Y")
+        rows.append({
+            "Artnavn": random.choice(species),
+            "Dato": dato,
+            "DOF_afdeling": " | ".join(random.sample(regions, random.choice([1, 1, 1, 2]))) if regions else "",
+            "Antal": str(random.choice([1, 1, 2, 3, 5, 10, 25, 100])),
+        })
+    return rows
+
+
+def best_of(fn, rows, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for r in rows:
+            fn(r)
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark af compute_kategori")
+    parser.add_argument("export", nargs="?", help="optaget eksport (.csv) eller observationer_*.json")
+    parser.add_argument("--rows", type=int, default=20000, help="antal syntetiske rækker uden eksport")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    rows = load_rows(args.export) if args.export else synthetic_rows(args.rows)
+    print(f"{len(rows)} rækker ({args.export or 'syntetisk'})")
+
+    diffs = [r for r in rows if reference_kategori(r) != watcher.compute_kategori(r)]
+    for r in diffs[:10]:
+        print(f"  FORSKEL {r.get('Artnavn')!r} {r.get('Dato')!r} {r.get('DOF_afdeling')!r} {r.get('Antal')!r}: "
+              f"før {reference_kategori(r)} nu {watcher.compute_kategori(r)}")
+
+    t0 = time.perf_counter()
+    watcher.KategoriClassifier(watcher.KLASS_MAP, watcher.FAENOLOGI_PERIODER, watcher.BEMAERK_BY_REGION)
+    compile_ms = (time.perf_counter() - t0) * 1000
+
+    old = best_of(reference_kategori, rows, args.repeat)
+    new = best_of(watcher.compute_kategori, rows, args.repeat)
+    per_row = lambda t: t / max(len(rows), 1) * 1e6
+    print(f"før:  {old * 1000:.1f} ms ({per_row(old):.2f} µs/række)")
+    print(f"nu:   {new * 1000:.1f} ms ({per_row(new):.2f} µs/række)  kompilering {compile_ms:.1f} ms")
+    print(f"faktor {old / max(new, 1e-9):.1f}x")
+    if diffs:
+        print(f"{len(diffs)} række(r) klassificeres forskelligt")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+import base64
+import os
+import random
+import sys
+import time
+
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives import serialization
+from py_vapid import Vapid
+from pywebpush import WebPusher
+
+# Måler VAPID-signering ved en fan-out: én signatur pr. subscription (som webpush())
+# mod server.get_vapid_headers, der genbruger tokenet pr. push-tjeneste.
+# Brug: python .tools/bench_vapid.py [antal_subscriptions]
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "server"))
+import server
+
+N = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+AUDIENCES = [
+    "https://fcm.googleapis.com/fcm/send/",
+    "https://updates.push.services.mozilla.com/wpush/v2/",
+    "https://web.push.apple.com/",
+]
+b64 = lambda b: base64.urlsafe_b64encode(b).decode().rstrip("=")
+
+if not server.VAPID_PRIVATE_KEY:
+    sk = ec.generate_private_key(ec.SECP256R1())
+    server.VAPID_PRIVATE_KEY = b64(sk.private_numbers().private_value.to_bytes(32, "big"))
+    print("VAPID_PRIVATE_KEY ikke sat – bruger en midlertidig nøgle")
+
+subs = []
+for i in range(N):
+    pub = ec.generate_private_key(ec.SECP256R1()).public_key().public_bytes(
+        serialization.Encoding.X962, serialization.PublicFormat.UncompressedPoint
+    )
+    subs.append({
+        "endpoint": random.choice(AUDIENCES) + f"token{i}",
+        "keys": {"p256dh": b64(pub), "auth": b64(os.urandom(16))},
+    })
+
+# Før: ny signatur for hver subscription
+vapid = Vapid.from_string(private_key=server.VAPID_PRIVATE_KEY)
+t0 = time.perf_counter()
+for sub in subs:
+    url = server.urlparse(sub["endpoint"])
+    vapid.sign({"sub": server.VAPID_CLAIMS_SUB, "aud": f"{url.scheme}://{url.netloc}", "exp": int(time.time()) + 12 * 3600})
+uncached = time.perf_counter() - t0
+
+# Efter: cache pr. audience
+server._vapid_header_cache.clear()
+t0 = time.perf_counter()
+for sub in subs:
+    server.get_vapid_headers(sub["endpoint"])
+cached = time.perf_counter() - t0
+
+# Til sammenligning: payload-kryptering, som stadig betales pr. besked
+data = '{"title": "1 Rødglente, Skagen", "body": "trækkende", "url": "https://dofbasen.dk"}'.encode("utf-8")
+t0 = time.perf_counter()
+for sub in subs:
+    WebPusher(sub).encode(data, content_encoding="aes128gcm")
+encrypt = time.perf_counter() - t0
+
+print(f"{N} subscriptions fordelt på {len(AUDIENCES)} push-tjenester")
+print(f"Signering uden cache: {uncached * 1000:8.1f} ms  ({uncached / N * 1e6:6.1f} µs/push)")
+print(f"Signering med cache:  {cached * 1000:8.1f} ms  ({cached / N * 1e6:6.1f} µs/push)")
+print(f"Payload-kryptering:   {encrypt * 1000:8.1f} ms  ({encrypt / N * 1e6:6.1f} µs/push)")
+print(f"Signaturer lavet med cache: {len(server._vapid_header_cache)}")
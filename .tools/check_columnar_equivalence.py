@@ -0,0 +1,127 @@
+import argparse
+import os
+import random
+import sys
+import time
+
+# Tjekker at watcherens kolonnebaserede pipeline (columnar_dedupe_enrich) giver præcis samme
+# rækker (værdier, typer og nøglerækkefølge) og tråde som dedupe_rows + enrich_with_kategori +
+# group_threads. Kører på tilfældige eksporter med dubletter på tværs af afdelinger, rækker uden
+# Obsid, decimal-Antal m.m., og på optagede eksporter hvis de gives. Exit 1 ved forskelle.
+#
+# Brug (fra repo-roden):
+#   python .tools/check_columnar_equivalence.py
+#   python .tools/check_columnar_equivalence.py --runs 500 --rows 2000
+#   python .tools/check_columnar_equivalence.py eksport_18-10-2026.csv eksport_17-10-2026.csv
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, ROOT)
+import watcher
+
+AFDELINGER = [
+    "DOF København", "DOF Nordsjælland", "DOF Fyn", "DOF Bornholm", "DOF Nordjylland",
+    "dof fyn", "DOF Østjylland", "Ukendt afdeling", "|", "",
+]
+ANTAL = ["1", "1", "2", "3", "12", "", "0", "2,5", "1.000", "ca. 5", "-1", "1,25", "nan", "inf"]
+
+
+def random_export(rng, n_rows):
+    species = sorted(set(watcher.KLASS_MAP) | set(watcher.FAENOLOGI_PERIODER)) or ["Rød Glente"]
+    species += ["[Rød Glente]", " Rød Glente", "Ukendt art", ""]
+    rows = []
+    for i in range(n_rows):
+        row = {col: "" for col in watcher.COLUMNS}
+        row.update({
+            "Dato": rng.choice(["18-10-2026", "01-05-2026", "29-02-2028", "2026-10-18", "", "x"]),
+            "Loknr": rng.choice(["", "101", "202", "303", " 303"]),
+            "Loknavn": rng.choice(["", "Amager", "Skagen"]),
+            "Artnavn": rng.choice(species),
+            "Antal": rng.choice(ANTAL),
+            "Fornavn": rng.choice(["", "Anna", "Bo"]),
+            "Efternavn": rng.choice(["", "Hansen"]),
+            "Obstidfra": rng.choice(["", "07:15", "12:00"]),
+            "Turid": rng.choice(["", "1", "2"]),
+            "Obsid": rng.choice([str(rng.randrange(n_rows)), str(rng.randrange(n_rows)), "", " "]),
+            "DOF_afdeling": " | ".join(rng.sample(AFDELINGER, rng.choice([1, 1, 2]))),
+            "Adfbeskrivelse": rng.choice(["", "rastende", "trækkende"]),
+        })
+        rows.append(row)
+    # Samme observation i flere afdelinger: kopier med anden afdeling og evt. andre felter
+    for row in rng.sample(rows, n_rows // 3):
+        dup = dict(row, DOF_afdeling=rng.choice(AFDELINGER))
+        if rng.random() < 0.5:
+            dup["Antal"] = rng.choice(ANTAL)
+        if rng.random() < 0.3:
+            dup["Loknavn"] = rng.choice(["", "Amager", "Skagen"])
+        rows.insert(rng.randrange(len(rows) + 1), dup)
+    return rows
+
+
+def compare(rows):
+    """Returnér en liste af forskelle mellem dict-vejen og den kolonnebaserede vej."""
+    expected = watcher.enrich_with_kategori(watcher.dedupe_rows([dict(r) for r in rows]))
+    expected_threads = watcher.group_threads(expected)
+    got, threads = watcher.columnar_dedupe_enrich([dict(r) for r in rows])
+    problems = []
+    if len(got) != len(expected):
+        problems.append(f"antal rækker {len(got)} != {len(expected)}")
+    for i, (a, b) in enumerate(zip(got, expected)):
+        if list(a.items()) != list(b.items()):
+            diff = {k: (a.get(k), b.get(k)) for k in dict.fromkeys([*a, *b]) if a.get(k) != b.get(k)}
+            problems.append(f"række {i}: {diff or 'nøglerækkefølge'}")
+        elif any(type(v) is not str for v in a.values()):
+            problems.append(f"række {i}: ikke-str værdier {[type(v).__name__ for v in a.values()]}")
+    if list(threads) != list(expected_threads):
+        problems.append(f"tråde {list(threads)[:5]} != {list(expected_threads)[:5]}")
+    else:
+        for thread_id, members in threads.items():
+            if members != expected_threads[thread_id]:
+                problems.append(f"tråd {thread_id}: rækker afviger")
+    return problems
+
+
+def load_export(path):
+    with open(path, "rb") as f:
+        raw = f.read()
+    return list(watcher.iter_rows(watcher.iter_lines(watcher.iter_decoded([raw]))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ækvivalenstest af den kolonnebaserede pipeline")
+    parser.add_argument("exports", nargs="*", help="optagede eksporter (.csv) der også skal tjekkes")
+    parser.add_argument("--runs", type=int, default=200, help="antal tilfældige eksporter")
+    parser.add_argument("--rows", type=int, default=300, help="rækker pr. tilfældig eksport (før dubletter)")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    if not watcher.columnar_available():
+        print("pandas er ikke installeret")
+        sys.exit(1)
+
+    failed = 0
+    rng = random.Random(args.seed)
+    cases = [(f"tilfældig #{i}", random_export(rng, rng.randint(0, args.rows))) for i in range(args.runs)]
+    cases += [(path, load_export(path)) for path in args.exports]
+    for name, rows in cases:
+        problems = compare(rows)
+        if problems:
+            failed += 1
+            print(f"FEJL  {name} ({len(rows)} rækker): {'; '.join(problems[:3])}")
+
+    for name, rows in cases[args.runs:]:
+        t0 = time.perf_counter()
+        watcher.enrich_with_kategori(watcher.dedupe_rows(rows))
+        t_dict = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        watcher.columnar_dedupe_enrich(rows)
+        t_col = time.perf_counter() - t0
+        print(f"{name}: dict {t_dict * 1000:.0f} ms, kolonner {t_col * 1000:.0f} ms")
+
+    if failed:
+        print(f"{failed} af {len(cases)} eksporter afviger")
+        sys.exit(1)
+    print(f"Ingen forskelle i {len(cases)} eksporter")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+import argparse
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+
+# Kører EXPLAIN QUERY PLAN på de varme forespørgsler i server.py og fejler (exit 1), hvis
+# nogen af dem laver en fuld tabelscanning. Databasen oprettes frisk via db_init og
+# migreringerne, eller man kan pege på en kopi af en rigtig users.db (med sqlite_stat1),
+# så planerne svarer til produktionen.
+#
+# Brug (fra repo-roden):
+#   python .tools/check_query_plans.py
+#   python .tools/check_query_plans.py --db server/users.db
+#
+# Bevidst udeladt: hele indlæsninger der skal læse alt (subscriber-indekset i
+# _build_subscriber_index, count_db_users, admin/all-users og cleanup_user_prefs_without_subscriptions).
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+HOT_QUERIES = [
+    # Abonnementer og opslag pr. bruger
+    ("is-subscribed", "SELECT 1 FROM subscriptions WHERE user_id=? OR device_id=? LIMIT 1", ("u", "d")),
+    ("device-opslag", "SELECT device_id FROM subscriptions WHERE user_id=? LIMIT 1", ("u",)),
+    ("subscription", "SELECT subscription FROM subscriptions WHERE user_id=? AND device_id=?", ("u", "d")),
+    ("slet-subscription", "DELETE FROM subscriptions WHERE user_id=? AND device_id=?", ("u", "d")),
+    ("identitet", "SELECT obserkode, navn FROM user_identity WHERE user_id=?", ("u",)),
+    ("obserkode-opslag", "SELECT user_id FROM user_identity WHERE obserkode_key IN (?, ?)", ("A", "B")),
+    ("prefs", "SELECT prefs FROM user_prefs WHERE user_id=?", ("u",)),
+    ("prefs-afdelinger", "SELECT afdeling, level FROM user_departments WHERE user_id=? ORDER BY rowid", ("u",)),
+    ("prefs-exclude", "SELECT art FROM species_exclude WHERE user_id=? ORDER BY rowid", ("u",)),
+    ("prefs-counts", "SELECT art, min_count FROM species_min_count WHERE user_id=? ORDER BY rowid", ("u",)),
+    ("prefs-quiet", "SELECT device_id, start, end, defer FROM quiet_hours WHERE user_id=? ORDER BY rowid", ("u",)),
+    ("slet-prefs", "DELETE FROM user_prefs WHERE user_id=?", ("u",)),
+    ("cache-generation", "SELECT gen FROM cache_generation WHERE name=?", ("subscribers",)),
+    # Tråde
+    ("tråd-abonnent",
+     "SELECT 1 FROM thread_subs WHERE day=? AND thread_id=? AND user_id=? AND device_id=?",
+     ("2026-10-18", "t", "u", "d")),
+    ("tråd-afmeld-enhed", "DELETE FROM thread_subs WHERE user_id=? AND device_id=?", ("u", "d")),
+    ("tråd-unsubs-enhed", "DELETE FROM thread_unsubs WHERE user_id=? AND device_id=?", ("u", "d")),
+    ("tråd-slet-bruger", "DELETE FROM thread_subs WHERE user_id=?", ("u",)),
+    ("tråd-unsubs-slet-bruger", "DELETE FROM thread_unsubs WHERE user_id=?", ("u",)),
+    ("tråd-interval-oprydning", "DELETE FROM thread_subs WHERE day < ?", ("2026-10-15",)),
+    ("tråd-unsubs-interval-oprydning", "DELETE FROM thread_unsubs WHERE day < ?", ("2026-10-15",)),
+    ("tråd-huller-oprydning",
+     "DELETE FROM thread_subs WHERE day >= ? AND day NOT IN (SELECT value FROM json_each(?))",
+     ("2026-10-15", '["2026-10-15", "2026-10-18"]')),
+    ("tråd-følgere",
+     "WITH pairs(day, thread_id) AS (VALUES (?, ?), (?, ?)) "
+     "SELECT t.day, t.thread_id, t.user_id, t.device_id, s.subscription, i.obserkode_key "
+     "FROM pairs "
+     "JOIN thread_subs t ON t.day = pairs.day AND t.thread_id = pairs.thread_id "
+     "JOIN subscriptions s ON s.user_id = t.user_id AND s.device_id = t.device_id "
+     "LEFT JOIN user_identity i ON i.user_id = t.user_id",
+     ("2026-10-18", "a", "2026-10-18", "b")),
+    ("tråd-auto-subscribe",
+     "INSERT OR IGNORE INTO thread_subs (day, thread_id, user_id, device_id) "
+     "SELECT ?, ?, s.user_id, s.device_id FROM user_identity i "
+     "JOIN subscriptions s ON s.user_id = i.user_id "
+     "WHERE i.obserkode_key IN (?, ?) "
+     "AND NOT EXISTS (SELECT 1 FROM thread_unsubs u WHERE u.day = ? AND u.thread_id = ? "
+     "AND u.user_id = s.user_id AND u.device_id = s.device_id)",
+     ("2026-10-18", "t", "A", "B", "2026-10-18", "t")),
+    # Obsid-abonnementer
+    ("obsid-status", "SELECT sub FROM obsid_subs WHERE user_id=? AND device_id=? AND obsid=?", ("u", "d", "1")),
+    ("obsid-oprydning", "DELETE FROM obsid_subs WHERE date < ?", ("2026-10-04",)),
+    ("obsid-afmeldte", "SELECT user_id, device_id, obsid FROM obsid_subs WHERE sub=0 AND obsid IN (?, ?)", ("1", "2")),
+    # Push-outbox
+    ("outbox-claim",
+     "UPDATE push_outbox SET claimed_until=? "
+     "WHERE id IN (SELECT id FROM push_outbox WHERE next_attempt<=? AND claimed_until<? ORDER BY next_attempt, id LIMIT ?)",
+     (0, 0, 0, 100)),
+    ("outbox-claim-søskende",
+     "UPDATE push_outbox SET claimed_until=? "
+     "WHERE claimed_until<? AND +attempts=0 AND next_attempt>? "
+     "AND (user_id, device_id) IN (SELECT user_id, device_id FROM push_outbox WHERE id IN (?, ?))",
+     (0, 0, 0, 1, 2)),
+    ("outbox-færdig", "DELETE FROM push_outbox WHERE id=?", (1,)),
+    ("outbox-opgivet", "DELETE FROM push_outbox WHERE attempts>=?", (10,)),
+    ("outbox-slet-enhed", "DELETE FROM push_outbox WHERE user_id=? AND device_id=?", ("u", "d")),
+    # Vedligeholdelse
+    ("vedligehold-lease",
+     "INSERT INTO maintenance_lease (name, owner, expires) VALUES ('maintenance', ?, ?) "
+     "ON CONFLICT(name) DO UPDATE SET owner=excluded.owner, expires=excluded.expires "
+     "WHERE maintenance_lease.owner=excluded.owner OR maintenance_lease.expires < ? RETURNING owner",
+     ("host:1", 0, 0)),
+    # Statistik
+    ("tællere-dag", "SELECT metric, count FROM stats_counters WHERE date=?", ("2026-10-18",)),
+    ("tællere-flush",
+     "INSERT INTO stats_counters (date, metric, count) VALUES (?, ?, ?) "
+     "ON CONFLICT(date, metric) DO UPDATE SET count = count + excluded.count",
+     ("2026-10-18", "obs_notification", 1)),
+    ("tællere-oprydning", "DELETE FROM stats_counters WHERE date < ?", ("2025-10-18",)),
+    ("latency-stats",
+     "SELECT stage, bucket, SUM(count) FROM latency_hist WHERE date >= ? GROUP BY stage, bucket",
+     ("2026-10-11",)),
+]
+
+
+# Planlinjer med SCAN der ikke er en tabel: CTE'er med konstante rækker (VALUES) og underforespørgsler.
+# Virtuelle tabeller (json_each over en parameterliste) springes også over.
+NOT_TABLES = {"pairs", "CONSTANT"}
+
+
+def full_scans(conn, sql, params):
+    """Linjer fra planen der scanner en hel tabel (SCAN <tabel/alias> uden indeks)."""
+    bad = []
+    for _, _, _, detail in conn.execute("EXPLAIN QUERY PLAN " + sql, params):
+        words = detail.split()
+        if len(words) < 2 or words[0] != "SCAN" or "USING" in words or "VIRTUAL" in words:
+            continue
+        if words[1] in NOT_TABLES or words[1].isdigit() or words[1].startswith("("):
+            continue
+        bad.append(detail)
+    return bad
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tjek at de varme forespørgsler bruger indeks")
+    parser.add_argument("--db", help="kopi af en eksisterende users.db (kopieres først, ændres ikke)")
+    parser.add_argument("-v", "--verbose", action="store_true", help="vis alle planer")
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix="dofnot-queryplan-")
+    db_path = os.path.join(tmp, "users.db")
+    if args.db:
+        shutil.copyfile(args.db, db_path)
+    os.environ["USERS_DB_PATH"] = db_path
+    sys.path.insert(0, os.path.join(ROOT, "server"))
+    os.chdir(tmp)  # server.log havner i den midlertidige mappe
+    import server  # db_init + migreringer kører ved import
+
+    conn = sqlite3.connect(db_path)
+    print(f"Skemaversion {server.get_schema_version(conn)} – {len(HOT_QUERIES)} forespørgsler")
+    failed = 0
+    for name, sql, params in HOT_QUERIES:
+        bad = full_scans(conn, sql, params)
+        if bad:
+            failed += 1
+            print(f"FEJL  {name}: {'; '.join(bad)}")
+        elif args.verbose:
+            plan = "; ".join(detail for *_, detail in conn.execute("EXPLAIN QUERY PLAN " + sql, params))
+            print(f"ok    {name}: {plan}")
+    conn.close()
+    shutil.rmtree(tmp, ignore_errors=True)
+    if failed:
+        print(f"{failed} forespørgsel(er) laver fuld tabelscanning")
+        sys.exit(1)
+    print("Ingen fulde tabelscanninger")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,260 @@
+import argparse
+import base64
+import json
+import multiprocessing
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+# Load-test af /api/update -> outbox -> web push mod en lokal mock-push-tjeneste.
+#
+# Seeder en midlertidig users.db med N syntetiske brugere (præferencer, artsfiltre og
+# subscriptions der peger på mocken), starter serveren in-process med uvicorn og afspiller
+# payloads som watcheren sender dem. Mocken kører i sin egen proces og kan give latens,
+# 410 og 429. Klienten (POST og outbox-polling) kører i hovedtråden, og dens CPU trækkes fra,
+# så CPU-tallet kun dækker serverens tråde.
+#
+# Brug (fra repo-roden):
+#   python .tools/loadtest_push.py --users 10000 --batches 5 --rows 20
+#   python .tools/loadtest_push.py --users 100000 --payload-file web/payload/18-10-2026/payload_x.json
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+AFDELINGER = [
+    "DOF København", "DOF Nordsjælland", "DOF Vestsjælland", "DOF Storstrøm", "DOF Bornholm",
+    "DOF Fyn", "DOF Sønderjylland", "DOF Sydvestjylland", "DOF Sydøstjylland", "DOF Vestjylland",
+    "DOF Østjylland", "DOF Nordvestjylland", "DOF Nordjylland",
+]
+b64 = lambda b: base64.urlsafe_b64encode(b).decode().rstrip("=")
+
+
+def run_mock(port, latency_ms, p410, p429, ready):
+    """Mock-push-tjeneste: POST /push/<n> svarer 201/410/429; GET /stats giver modtagelser."""
+    import asyncio
+    from aiohttp import web
+
+    receipts = []
+
+    async def push(request):
+        await request.read()
+        r = random.random()
+        if r < p410:
+            status = 410
+        elif r < p410 + p429:
+            status = 429
+        else:
+            status = 201
+            if latency_ms:
+                await asyncio.sleep(random.uniform(0.5, 1.5) * latency_ms / 1000)
+        receipts.append((time.time(), status))
+        return web.Response(status=status, headers={"Retry-After": "1"} if status == 429 else {})
+
+    async def stats(request):
+        return web.json_response(receipts)
+
+    async def main():
+        app = web.Application()
+        app.router.add_post("/push/{n}", push)
+        app.router.add_get("/stats", stats)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        ready.set()
+        await asyncio.Event().wait()
+
+    asyncio.run(main())
+
+
+def make_subscription(port, n, keys):
+    return {
+        "endpoint": f"http://127.0.0.1:{port}/push/{n}",
+        "keys": {"p256dh": keys[n % len(keys)], "auth": b64(os.urandom(16))},
+    }
+
+
+def seed_users(server, n_users, port, species):
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.hazmat.primitives import serialization
+
+    keys = []
+    for _ in range(64):
+        pub = ec.generate_private_key(ec.SECP256R1()).public_key().public_bytes(
+            serialization.Encoding.X962, serialization.PublicFormat.UncompressedPoint
+        )
+        keys.append(b64(pub))
+    prefs_rows, sub_rows = [], []
+    for i in range(n_users):
+        prefs = {afd: random.choice(["Ingen", "SU", "SUB", "Bemærk"]) for afd in random.sample(AFDELINGER, random.randint(1, 4))}
+        prefs["obserkode"] = f"LT{i}"
+        prefs["species_filters"] = {
+            "include": [],
+            "exclude": [a.lower() for a in random.sample(species, random.randint(0, 3))],
+            "counts": {a.lower(): random.randint(2, 10) for a in random.sample(species, random.randint(0, 2))},
+        }
+        prefs_rows.append((f"lt-user-{i}", prefs))
+        sub_rows.append((f"lt-user-{i}", f"lt-device-{i}", json.dumps(make_subscription(port, i, keys))))
+    with server.db_connect() as conn:
+        for user_id, prefs in prefs_rows:
+            server.write_prefs(conn, user_id, prefs)
+        conn.executemany("INSERT OR REPLACE INTO subscriptions (user_id, device_id, subscription) VALUES (?, ?, ?)", sub_rows)
+        server.bump_cache_generation(conn)
+
+
+def make_batch(columns, species, n_rows, n_users, obsid_start):
+    """Rækker som watcheren sender: 38 kolonner + kategori/statechanged/obserstate."""
+    today = time.strftime("%Y-%m-%d")
+    batch = []
+    for i in range(n_rows):
+        obsid = str(obsid_start + i)
+        art = random.choice(species)
+        loknr = str(random.randint(100000, 999999))
+        row = {col: "" for col in columns}
+        row.update({
+            "Dato": today,
+            "Loknr": loknr,
+            "Loknavn": f"Lokalitet {loknr}",
+            "Artnavn": art,
+            "Antal": str(random.randint(1, 12)),
+            "Adfbeskrivelse": random.choice(["rastende", "trækkende", "fouragerende"]),
+            "Obserkode": f"LT{random.randrange(n_users)}",
+            "Fornavn": "Load",
+            "Efternavn": "Test",
+            "Obsid": obsid,
+            "DOF_afdeling": " | ".join(random.sample(AFDELINGER, random.choice([1, 1, 2]))),
+        })
+        row["kategori"] = random.choices(["SU", "SUB", "bemaerk"], weights=[1, 3, 6])[0]
+        row["statechanged"] = 1
+        row["obserstate"] = [row["Obserkode"]]
+        row["tag"] = f"{art.lower().replace(' ', '-')}-{loknr}"
+        row["url"] = f"https://dofbasen.dk/popobs.php?obsid={obsid}&summering=tur&obs=obs"
+        row["stage_ts"] = {"sent": time.time()}
+        batch.append(row)
+    return batch
+
+
+def outbox_busy(db_path):
+    now = time.time()
+    with sqlite3.connect(db_path) as conn:
+        due, pending = conn.execute(
+            "SELECT SUM(next_attempt <= ? OR claimed_until > ?), COUNT(*) FROM push_outbox", (now, now)
+        ).fetchone()
+    return bool(due), pending or 0
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p * (len(values) - 1))))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test af push fan-out")
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--batches", type=int, default=5)
+    parser.add_argument("--rows", type=int, default=20, help="rækker pr. batch")
+    parser.add_argument("--payload-file", help="afspil en gemt payload (JSON-liste) i stedet for syntetiske rækker")
+    parser.add_argument("--latency-ms", type=float, default=50, help="mock-latens pr. push")
+    parser.add_argument("--p410", type=float, default=0.01, help="andel der svarer 410 Gone")
+    parser.add_argument("--p429", type=float, default=0.01, help="andel der svarer 429")
+    parser.add_argument("--port", type=int, default=8899, help="port til serveren (mocken bruger port+1)")
+    parser.add_argument("--timeout", type=float, default=300, help="max sekunder pr. batch")
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix="dofnot-loadtest-")
+    os.environ["USERS_DB_PATH"] = os.path.join(tmp, "users.db")
+    os.environ["UPDATE_API_TOKEN"] = b64(os.urandom(16))
+    if not os.environ.get("VAPID_PRIVATE_KEY"):
+        from cryptography.hazmat.primitives.asymmetric import ec
+        sk = ec.generate_private_key(ec.SECP256R1())
+        os.environ["VAPID_PRIVATE_KEY"] = b64(sk.private_numbers().private_value.to_bytes(32, "big"))
+
+    sys.path.insert(0, os.path.join(ROOT, "server"))
+    sys.path.insert(0, ROOT)
+    os.chdir(tmp)  # server.log m.m. havner i den midlertidige mappe
+    import server
+    import uvicorn
+    from watcher import COLUMNS
+
+    # Payload-filer og oprydning skal ikke røre den rigtige web-mappe
+    server.VAPID_PRIVATE_KEY = os.environ["VAPID_PRIVATE_KEY"]
+    server.web_dir = os.path.join(tmp, "web")
+    server.payload_dir = os.path.join(server.web_dir, "payload")
+    server.latest_symlink_path = os.path.join(server.payload_dir, "latest.json")
+    os.makedirs(server.payload_dir, exist_ok=True)
+
+    species = sorted(server._load_known_species_names()) or ["Rød Glente"]
+    species = [s.title() for s in species]
+
+    mock_port = args.port + 1
+    ready = multiprocessing.Event()
+    mock = multiprocessing.Process(target=run_mock, args=(mock_port, args.latency_ms, args.p410, args.p429, ready), daemon=True)
+    mock.start()
+    ready.wait(10)
+
+    t0 = time.time()
+    seed_users(server, args.users, mock_port, species)
+    print(f"Seedede {args.users} brugere på {time.time() - t0:.1f}s ({server.DB_PATH})")
+
+    uv = uvicorn.Server(uvicorn.Config(server.app, host="127.0.0.1", port=args.port, log_level="warning"))
+    threading.Thread(target=uv.run, daemon=True).start()
+    while not uv.started:
+        time.sleep(0.05)
+
+    if args.payload_file:
+        with open(args.payload_file, "r", encoding="utf-8") as f:
+            batches = [json.load(f)] * args.batches
+    else:
+        batches = [make_batch(COLUMNS, species, args.rows, args.users, 10_000_000 + b * args.rows) for b in range(args.batches)]
+
+    url = f"http://127.0.0.1:{args.port}/api/update"
+    headers = {"X-API-Token": os.environ["UPDATE_API_TOKEN"]}
+    posts, queued, ingest_ms = [], 0, []
+    cpu0, client_cpu0, wall0 = time.process_time(), time.thread_time(), time.time()
+    for batch in batches:
+        t_post = time.time()
+        resp = requests.post(url, json=batch, headers=headers, timeout=120)
+        resp.raise_for_status()
+        ingest_ms.append((time.time() - t_post) * 1000)
+        posts.append(t_post)
+        queued += resp.json().get("queued", 0)
+        deadline = time.time() + args.timeout
+        while time.time() < deadline:
+            busy, pending = outbox_busy(server.DB_PATH)
+            if not busy:
+                break
+            time.sleep(0.05)
+    wall = time.time() - wall0
+    # Processens CPU minus hovedtrådens (klienten) = serverens tråde (uvicorn, DB- og I/O-puljer)
+    cpu = (time.process_time() - cpu0) - (time.thread_time() - client_cpu0)
+
+    receipts = requests.get(f"http://127.0.0.1:{mock_port}/stats", timeout=10).json()
+    _, pending = outbox_busy(server.DB_PATH)
+    delivered = [ts for ts, status in receipts if status == 201]
+    latencies = []
+    for ts in delivered:
+        started = [p for p in posts if p <= ts]
+        if started:
+            latencies.append((ts - started[-1]) * 1000)
+    attempts = len(receipts)
+
+    print(f"Batches: {len(batches)}  jobs i outbox: {queued}  push-forsøg: {attempts}")
+    print(f"  leveret (201): {len(delivered)}  410: {sum(1 for _, s in receipts if s == 410)}"
+          f"  429: {sum(1 for _, s in receipts if s == 429)}  ventende genforsøg: {pending}")
+    print(f"Ingest (/api/update svartid): p50 {statistics.median(ingest_ms):.0f} ms  max {max(ingest_ms):.0f} ms")
+    print(f"Levering (POST -> mock modtager): p50 {percentile(latencies, 0.5):.0f} ms  p99 {percentile(latencies, 0.99):.0f} ms")
+    print(f"Gennemløb: {attempts / wall:.0f} push/s over {wall:.1f}s")
+    print(f"CPU (server-tråde, ekskl. klient): {cpu:.2f}s  = {cpu / max(attempts, 1) * 1000:.2f} ms/push")
+
+    uv.should_exit = True
+    mock.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -38,7 +38,6 @@ def cleanup_old_obsid_birthtimes(log_path, birthtimes_path, days=3):
 
 def wait_until_next_run():
     tz = pytz.timezone("Europe/Copenhagen")
-    import sqlite3
     while True:
         now = datetime.now(pytz.UTC).astimezone(tz)
         next_run = (now + timedelta(days=1)).replace(hour=0, minute=0, second=1, microsecond=0)
@@ -59,20 +58,19 @@ def wait_until_next_run():
                 print("server.log findes ikke.")
         except Exception as e:
             print(f"Kunne ikke slette server.log: {e}")
-        # Oprydning i stats_notifications (slet data ældre end 1 år)
+        # Oprydning i stats_counters (slet data ældre end 1 år)
         try:
-            db_path = os.path.join(os.path.dirname(__file__), "users.db")  # Ret evt. filnavn
             tz = pytz.timezone("Europe/Copenhagen")
             cutoff = (datetime.now(pytz.UTC).astimezone(tz) - timedelta(days=365)).strftime("%Y-%m-%d")
-            with sqlite3.connect(db_path) as conn:
+            with server.db_connect() as conn:
                 conn.execute(
-                    "DELETE FROM stats_notifications WHERE date < ?",
+                    "DELETE FROM stats_counters WHERE date < ?",
                     (cutoff,)
                 )
                 conn.commit()
-            print("Oprydning i stats_notifications udført.")
+            print("Oprydning i stats_counters udført.")
         except Exception as e:
-            print(f"Fejl ved oprydning i stats_notifications: {e}")
+            print(f"Fejl ved oprydning i stats_counters: {e}")
 
         # Oprydning i obsid_birthtimes og log
         try:
@@ -1,13 +1,15 @@
 import sqlite3
 import csv
-from fastapi import FastAPI, Request, status, HTTPException, WebSocket, WebSocketDisconnect, Body, Header
+from fastapi import FastAPI, Request, Response, status, HTTPException, WebSocket, WebSocketDisconnect, Body, Header, Depends
 from fastapi.responses import JSONResponse, FileResponse, PlainTextResponse, HTMLResponse
 import json
 import os
 import glob
 from datetime import datetime, timedelta
 from fastapi.staticfiles import StaticFiles
-from pywebpush import webpush, WebPushException
+from pywebpush import webpush_async, WebPusher, WebPushException
+from py_vapid import Vapid
+import aiohttp
 import unicodedata
 import uuid
 import re
@@ -17,19 +19,26 @@ from urllib.parse import urljoin, urlparse, parse_qs
 from fastapi import Query  # Kun hvis du stadig bruger Query i nogle endpoints
 from contextlib import asynccontextmanager, suppress
 from dotenv import load_dotenv
-from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List
 import threading
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+import copy
 import time
 import asyncio
+import contextvars
+import functools
+import base64
+import hashlib
+import hmac
+import secrets
+import socket
+from concurrent.futures import ThreadPoolExecutor
 from fastapi.middleware.cors import CORSMiddleware
-from starlette.requests import Request as StarletteRequest
+from starlette.requests import Request as StarletteRequest, HTTPConnection
 from starlette.requests import ClientDisconnect
 import pytz
 import logging
 import subprocess
-import queue
 from haversine import haversine
 
 load_dotenv()
@@ -53,26 +62,293 @@ comment_file_locks = defaultdict(threading.Lock)
 dk_time = datetime.now(pytz.timezone("Europe/Copenhagen")).isoformat()
 
 
+# --- ASYNC I/O ---
+# Event-loopet må ikke blokeres af SQLite, filer, urllib eller subprocess. Routes uden await er
+# almindelige "def"-routes, som FastAPI kører i sin trådpulje. Async routes (body-læsning, push,
+# websockets) sender DB-arbejde til workerens dedikerede DB-tråd med run_db og fil-, netværks-
+# og subprocess-arbejde til trådpuljen med run_io.
+_db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+
+async def run_db(func, *args, **kwargs):
+    """Kør func på DB-tråden (med kalderens contextvars) og vent på resultatet."""
+    loop = asyncio.get_running_loop()
+    ctx = contextvars.copy_context()
+    return await loop.run_in_executor(_db_executor, functools.partial(ctx.run, func, *args, **kwargs))
+
+async def run_io(func, *args, **kwargs):
+    """Kør blokerende fil-/netværksarbejde i trådpuljen."""
+    return await asyncio.to_thread(func, *args, **kwargs)
+
+def _read_json(path, default=None):
+    if not os.path.isfile(path):
+        return default
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def _write_json(path, data, indent=2):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=indent)
+
+async def read_json_file(path, default=None):
+    return await run_io(_read_json, path, default)
+
+async def write_json_file(path, data, indent=2):
+    await run_io(_write_json, path, data, indent)
+
+# EVENT_LOOP_DEBUG=1 slår asyncio's debug-tilstand til: alt der blokerer loopet i mere end
+# 50 ms logges i server.log, og tasken er opkaldt efter routen (fx "POST /api/prefs").
+EVENT_LOOP_DEBUG = os.environ.get("EVENT_LOOP_DEBUG", "").lower() in ("1", "true", "yes")
+EVENT_LOOP_SLOW_CALLBACK = 0.05
+
+def enable_event_loop_debug():
+    loop = asyncio.get_running_loop()
+    loop.set_debug(True)
+    loop.slow_callback_duration = EVENT_LOOP_SLOW_CALLBACK
+    logging.getLogger("asyncio").setLevel(logging.WARNING)
+    logging.warning(f"[event-loop] Debug slået til: logger callbacks over {EVENT_LOOP_SLOW_CALLBACK * 1000:.0f} ms")
+
+async def name_task_after_route(connection: HTTPConnection):
+    if EVENT_LOOP_DEBUG:
+        task = asyncio.current_task()
+        route = connection.scope.get("route")
+        if task is not None and route is not None:
+            method = connection.scope.get("method") or "WS"
+            task.set_name(f"{method} {route.path}")
+
+# --- ROLLE-REGISTER ---
+# admin.json, superadmin.json og blacklist.json læses én gang pr. proces og holdes i hukommelsen
+# som frozensets (O(1) medlemskab). Hvert opslag koster kun et os.stat(); ændres filens mtime,
+# størrelse eller inode (en anden worker, et admin-kald eller en manuel rettelse), parses den igen.
+# Alle skrivninger går gennem update_json_file, som skriver en temp-fil og os.replace'er den på
+# plads, så en læser aldrig ser en halvt skrevet fil.
+_json_file_cache = {}
+_json_write_lock = threading.Lock()
+
+def _file_stamp(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+def read_cached_json(path, default, derive=None):
+    """Indholdet af en JSON-fil (eller derive(indhold)), genbrugt indtil filen ændres.
+
+    Resultatet deles mellem kald og må ikke ændres af kalderen.
+    """
+    stamp = _file_stamp(path)
+    key = (path, derive)
+    cached = _json_file_cache.get(key)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+    data = default
+    if stamp is not None:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warning(f"[register] Kunne ikke læse {path}: {e}")
+    try:
+        value = derive(data) if derive else data
+    except Exception:
+        value = derive(default)
+    _json_file_cache[key] = (stamp, value)
+    return value
+
+def update_json_file(path, default, mutate):
+    """Læs, ændr og skriv en JSON-fil atomisk. mutate(data) ændrer på stedet og returnerer resultatet.
+
+    En ødelagt fil overskrives ikke (json-fejlen sendes videre); en manglende fil starter som default.
+    """
+    with _json_write_lock:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            data = copy.deepcopy(default)
+        result = mutate(data)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        return result
+
+def _admin_set(data):
+    return frozenset(data.get("admins", []))
+
+def _superadmin_set(data):
+    return frozenset(data.get("superadmins", []))
+
+def _blacklist_set(data):
+    return frozenset(entry["obserkode"] for entry in data if "obserkode" in entry)
+
+def load_admins():
+    return read_cached_json(ADMIN_PATH, {}, _admin_set)
+
+def load_superadmins():
+    return read_cached_json(SUPERADMIN_PATH, {}, _superadmin_set)
+
+def load_blacklisted_obsids():
+    return read_cached_json(BLACKLIST_PATH, [], _blacklist_set)
+
+# --- SESSIONER ---
+# HMAC-signerede session-tokens udstedes af /api/subscribe, /api/validate-login og /api/session og
+# sendes med i X-Session-Token (app.js gør det automatisk). Tokenet bærer user_id, device_id,
+# obserkode, roller og udløb, så get_obserkode_from_userprefs og has_role kan svare uden
+# identitets-opslag eller rolle-filerne, når tokenet tilhører den user_id requesten handler om.
+# Et ugyldigt eller udløbet token ignoreres bare, og tjekkene falder tilbage til databasen.
+# Rollerne gælder kun så længe admin.json/superadmin.json er uændrede siden udstedelsen.
+# Tokenets device_id sammenlignes med subscriptions (via opslags-cachen), så et token holder op
+# med at virke for netop den bruger, når enheden afmelder sig, en anden enhed abonnerer, eller
+# brugeren slettes.
+SESSION_HEADER = "X-Session-Token"
+SESSION_TTL = int(os.environ.get("SESSION_TTL", str(7 * 24 * 3600)))
+SESSION_SECRET_PATH = os.path.join(SERVER_DIR, "session_secret")
+_current_session = contextvars.ContextVar("session", default=None)
+
+def _load_session_secret():
+    secret = os.environ.get("SESSION_SECRET")
+    if secret:
+        return secret.encode()
+    if not os.path.isfile(SESSION_SECRET_PATH):
+        # Fælles for alle workers: den første der når frem, linker sin nøgle ind atomisk
+        tmp = f"{SESSION_SECRET_PATH}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            f.write(secrets.token_hex(32))
+        try:
+            os.chmod(tmp, 0o600)
+            os.link(tmp, SESSION_SECRET_PATH)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp)
+    with open(SESSION_SECRET_PATH, "rb") as f:
+        return f.read().strip()
+
+SESSION_SECRET = _load_session_secret()
+
+def _b64encode(raw):
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode()
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+def _sign(body):
+    return hmac.new(SESSION_SECRET, body.encode(), hashlib.sha256).digest()
+
+def _role_files_version():
+    stamps = []
+    for path in (ADMIN_PATH, SUPERADMIN_PATH):
+        stamp = _file_stamp(path)
+        stamps.append("-".join(map(str, stamp)) if stamp else "0")
+    return ":".join(stamps)
+
+def issue_session(user_id, device_id):
+    """Nyt token for user_id/device_id med obserkode og roller som de er lige nu.
+
+    Kun for den enhed der står i subscriptions; ellers None (så et token ikke kan overleve,
+    at brugeren senere abonnerer fra en anden enhed).
+    """
+    stored_device_id = cached_lookup("device", user_id, lambda conn: _load_device_id(conn, user_id))
+    if not user_id or stored_device_id != device_id:
+        return None
+    row = cached_lookup("identity", user_id, lambda conn: _load_identity(conn, user_id))
+    obserkode = row[0] if row and row[0] is not None else ""
+    roles_version = _role_files_version()
+    roles = []
+    if obserkode in load_admins():
+        roles.append("admin")
+    if obserkode in load_superadmins():
+        roles.append("superadmin")
+    now = time.time()
+    claims = {
+        "uid": user_id,
+        "did": device_id,
+        "obk": obserkode,
+        "roles": roles,
+        "rv": roles_version,
+        "iat": now,
+        "exp": now + SESSION_TTL,
+    }
+    body = _b64encode(json.dumps(claims, separators=(",", ":")).encode())
+    return f"{body}.{_b64encode(_sign(body))}"
+
+def attach_session(response, user_id, device_id):
+    """Udsted token og sæt det i svarets X-Session-Token (hvis enheden er abonneret)."""
+    token = issue_session(user_id, device_id)
+    if token:
+        response.headers[SESSION_HEADER] = token
+    return token
+
+def verify_session(token):
+    """Claims for et gyldigt token, ellers None."""
+    try:
+        body, sig = token.split(".")
+        if not hmac.compare_digest(_sign(body), _b64decode(sig)):
+            return None
+        claims = json.loads(_b64decode(body))
+    except Exception:
+        return None
+    if claims.get("exp", 0) < time.time():
+        return None
+    return claims
+
+async def load_session(connection: HTTPConnection, response: Response):
+    token = connection.headers.get(SESSION_HEADER)
+    session = verify_session(token) if token else None
+    if token and session is None:
+        # Tomt header-felt: klienten smider det forældede token og henter et nyt
+        response.headers[SESSION_HEADER] = ""
+    _current_session.set(session)
+
+def session_for(user_id):
+    """Requestens verificerede session, hvis den tilhører user_id og enheden stadig er abonneret."""
+    session = _current_session.get()
+    if session is None or not user_id or session.get("uid") != user_id:
+        return None
+    stored_device_id = cached_lookup("device", user_id, lambda conn: _load_device_id(conn, user_id))
+    if session.get("did") != stored_device_id:
+        return None
+    return session
+
+def has_role(user_id, obserkode, role):
+    """Er obserkode "admin" eller "superadmin"? Fra sessionen hvis muligt, ellers fra rolle-filen."""
+    session = session_for(user_id)
+    if session is not None and session.get("obk") == obserkode and session.get("rv") == _role_files_version():
+        return role in session.get("roles", ())
+    members = load_superadmins() if role == "superadmin" else load_admins()
+    return obserkode in members
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Oprydning i baggrundstråd (blocking) – uændret
-    def run_and_repeat():
-        while True:
-            try:
-                cleanup_dirs(os.path.join(web_dir, "payload"), days=3)
-                cleanup_dirs(os.path.join(web_dir, "obs"), days=3)
-                database_maintenance()
-            except Exception as e:
-                logging.exception(f"[cleanup] Fejl under oprydning: {e}")
-            time.sleep(3600)
+    # Vedligeholdelse i baggrundstråd (blocking); kun lejemålets holder blandt workers kører jobs
+    _maintenance_stop.clear()
+    maintenance_thread = threading.Thread(target=maintenance_scheduler, name="maintenance", daemon=True)
+    maintenance_thread.start()
 
-    t = threading.Thread(target=run_and_repeat, daemon=True)
-    t.start()
+    if EVENT_LOOP_DEBUG:
+        enable_event_loop_debug()
+
+    background_tasks = [
+        asyncio.create_task(push_outbox_worker()),
+        asyncio.create_task(stats_flush_worker()),
+    ]
 
     yield  # appen kører
 
+    for task in background_tasks:
+        task.cancel()
+        with suppress(asyncio.CancelledError):
+            await task
+    await close_push_session()
+    await run_db(flush_stats)
+    _maintenance_stop.set()
+    await run_io(maintenance_thread.join, 5)
+
 
-app = FastAPI(lifespan=lifespan)
+app = FastAPI(lifespan=lifespan, dependencies=[Depends(name_task_after_route), Depends(load_session)])
 
 @app.get("/healthz")
 async def healthz():
@@ -97,7 +373,47 @@ async def log_all_requests(request: Request, call_next):
     logging.info(log_line)
     return response
 
-DB_PATH = os.path.join(os.path.dirname(__file__), "users.db")
+# USERS_DB_PATH kan pege på en anden database (fx til load-test i .tools/loadtest_push.py)
+DB_PATH = os.environ.get("USERS_DB_PATH") or os.path.join(os.path.dirname(__file__), "users.db")
+
+# --- DATABASE-FORBINDELSER ---
+# Én langlivet forbindelse pr. tråd (og pr. proces) i stedet for sqlite3.connect() pr. kald.
+# "with db_connect() as conn:" virker som før: blokken committes eller rulles tilbage,
+# men forbindelsen lukkes ikke, så pragmas og sqlite3's statement-cache genbruges.
+DB_TIMEOUT = 10
+DB_CACHED_STATEMENTS = 256
+DB_PRAGMAS = (
+    "PRAGMA auto_vacuum=INCREMENTAL",  # kun virksomt på en ny database (før WAL og første tabel)
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-16000",      # 16 MB side-cache pr. forbindelse
+    "PRAGMA mmap_size=268435456",    # 256 MB
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA busy_timeout=10000",
+)
+_db_local = threading.local()
+
+def _open_db_connection(path):
+    conn = sqlite3.connect(
+        path,
+        timeout=DB_TIMEOUT,
+        check_same_thread=False,
+        cached_statements=DB_CACHED_STATEMENTS,
+    )
+    for pragma in DB_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+def db_connect(path=None):
+    path = path or DB_PATH
+    conns = getattr(_db_local, "conns", None)
+    if conns is None or _db_local.pid != os.getpid():
+        conns = _db_local.conns = {}
+        _db_local.pid = os.getpid()
+    conn = conns.get(path)
+    if conn is None:
+        conn = conns[path] = _open_db_connection(path)
+    return conn
 
 logging.basicConfig(
     filename="server.log",
@@ -105,8 +421,393 @@ logging.basicConfig(
     level=logging.INFO,
 )
 
+# --- BRUGERPRÆFERENCER ---
+# Præferencerne ligger normaliseret: afdelingsvalg i user_departments, obserkode/navn i
+# user_identity, artsfiltre i species_exclude/species_min_count og stille perioder i quiet_hours.
+# user_prefs er stadig "hovedrækken" pr. bruger, og prefs-kolonnen holder kun det, der ikke er
+# normaliseret (fx species_filters.include). read_prefs/write_prefs samler og splitter den samme
+# dict, som frontenden altid har fået; endpoints ændrer enkelte nøgler med mutate_prefs.
+AFDELING_VALG = ("Ingen", "SU", "SUB", "Bemærk")
+
+def obserkode_key(obserkode):
+    return str(obserkode or "").strip().upper()
+
+def _split_prefs(prefs):
+    residual = {}
+    departments = []
+    identity = {}
+    exclude = []
+    counts = []
+    quiet = []
+    for key, value in prefs.items():
+        if key in ("obserkode", "navn"):
+            if value is not None:
+                identity[key] = value
+        elif key == "species_filters" and isinstance(value, dict) \
+                and isinstance(value.get("exclude") or [], list) and isinstance(value.get("counts") or {}, dict):
+            exclude = [str(art) for art in (value.get("exclude") or [])]
+            for art, min_count in (value.get("counts") or {}).items():
+                if not isinstance(min_count, (int, float, str, type(None))):
+                    min_count = json.dumps(min_count)
+                counts.append((str(art), min_count))
+            residual[key] = {k: v for k, v in value.items() if k not in ("exclude", "counts")}
+        elif key == "quiet_hours" and isinstance(value, dict) \
+                and all(isinstance(qh, dict) for qh in value.values()):
+            for device_id, qh in value.items():
+                defer = qh.get("defer")
+                quiet.append((device_id, qh.get("start"), qh.get("end"), None if defer is None else int(bool(defer))))
+        elif isinstance(value, str) and value in AFDELING_VALG:
+            departments.append((key, value))
+        else:
+            residual[key] = value
+    return residual, departments, identity, exclude, counts, quiet
+
+def write_prefs(conn, user_id, prefs, ts=None):
+    """Gem en komplet præference-dict for user_id (i den forbindelse/transaktion man har)."""
+    if ts is None:
+        ts = int(datetime.now().timestamp())
+    residual, departments, identity, exclude, counts, quiet = _split_prefs(prefs)
+    conn.execute(
+        "INSERT INTO user_prefs (user_id, prefs, ts) VALUES (?, ?, ?) "
+        "ON CONFLICT(user_id) DO UPDATE SET prefs = excluded.prefs, ts = excluded.ts",
+        (user_id, json.dumps(residual), ts)
+    )
+    for table in ("user_departments", "user_identity", "species_exclude", "species_min_count", "quiet_hours"):
+        conn.execute(f"DELETE FROM {table} WHERE user_id=?", (user_id,))
+    if departments:
+        conn.executemany(
+            "INSERT INTO user_departments (user_id, afdeling, level) VALUES (?, ?, ?)",
+            [(user_id, afd, level) for afd, level in departments]
+        )
+    if identity:
+        conn.execute(
+            "INSERT INTO user_identity (user_id, obserkode, obserkode_key, navn) VALUES (?, ?, ?, ?)",
+            (user_id, identity.get("obserkode"), obserkode_key(identity.get("obserkode")), identity.get("navn"))
+        )
+    if exclude:
+        conn.executemany(
+            "INSERT OR IGNORE INTO species_exclude (user_id, art) VALUES (?, ?)",
+            [(user_id, art) for art in exclude]
+        )
+    if counts:
+        conn.executemany(
+            "INSERT OR REPLACE INTO species_min_count (user_id, art, min_count) VALUES (?, ?, ?)",
+            [(user_id, art, min_count) for art, min_count in counts]
+        )
+    if quiet:
+        conn.executemany(
+            "INSERT OR REPLACE INTO quiet_hours (user_id, device_id, start, end, defer) VALUES (?, ?, ?, ?, ?)",
+            [(user_id,) + qh for qh in quiet]
+        )
+
+def read_prefs(conn, user_id):
+    """Saml præference-dicten for user_id igen ({} hvis brugeren ikke findes)."""
+    row = conn.execute("SELECT prefs FROM user_prefs WHERE user_id=?", (user_id,)).fetchone()
+    if not row:
+        return {}
+    prefs = json.loads(row[0]) if row[0] else {}
+    for afd, level in conn.execute(
+        "SELECT afdeling, level FROM user_departments WHERE user_id=? ORDER BY rowid", (user_id,)
+    ):
+        prefs[afd] = level
+    identity = conn.execute("SELECT obserkode, navn FROM user_identity WHERE user_id=?", (user_id,)).fetchone()
+    if identity:
+        if identity[0] is not None:
+            prefs["obserkode"] = identity[0]
+        if identity[1] is not None:
+            prefs["navn"] = identity[1]
+    exclude = [art for (art,) in conn.execute(
+        "SELECT art FROM species_exclude WHERE user_id=? ORDER BY rowid", (user_id,)
+    )]
+    counts = dict(conn.execute(
+        "SELECT art, min_count FROM species_min_count WHERE user_id=? ORDER BY rowid", (user_id,)
+    ).fetchall())
+    species_filters = prefs.get("species_filters")
+    if isinstance(species_filters, dict):
+        species_filters["exclude"] = exclude
+        species_filters["counts"] = counts
+    elif exclude or counts:
+        prefs["species_filters"] = {"include": [], "exclude": exclude, "counts": counts}
+    quiet = conn.execute(
+        "SELECT device_id, start, end, defer FROM quiet_hours WHERE user_id=? ORDER BY rowid", (user_id,)
+    ).fetchall()
+    if quiet:
+        prefs["quiet_hours"] = {}
+        for device_id, start, end, defer in quiet:
+            qh = {"start": start, "end": end}
+            if defer is not None:
+                qh["defer"] = bool(defer)
+            prefs["quiet_hours"][device_id] = qh
+    return prefs
+
+# Delvise ændringer: hver nøgle skrives direkte i sin tabel (eller i den resterende JSON med
+# json_set/json_remove) i én transaktion, så samtidige ændringer fra to faner ikke overskriver
+# hinanden. user_prefs.version tælles op ved hver ændring og bruges til optimistisk låsning.
+_REMOVE = object()
+
+def _set_residual_pref(conn, user_id, key, value=_REMOVE):
+    if not key.isascii() or '"' in key or "\\" in key:
+        # json.dumps gemmer æøå \u-escaped, og dem (og citationstegn) matcher JSON1-stier ikke:
+        # ret i Python, stadig inden for transaktionen
+        row = conn.execute("SELECT prefs FROM user_prefs WHERE user_id=?", (user_id,)).fetchone()
+        residual = json.loads(row[0]) if row and row[0] else {}
+        if value is _REMOVE:
+            residual.pop(key, None)
+        else:
+            residual[key] = value
+        conn.execute("UPDATE user_prefs SET prefs=? WHERE user_id=?", (json.dumps(residual), user_id))
+    elif value is _REMOVE:
+        conn.execute(
+            "UPDATE user_prefs SET prefs = json_remove(COALESCE(prefs, '{}'), ?) WHERE user_id=?",
+            (f'$."{key}"', user_id)
+        )
+    else:
+        conn.execute(
+            "UPDATE user_prefs SET prefs = json_set(COALESCE(prefs, '{}'), ?, json(?)) WHERE user_id=?",
+            (f'$."{key}"', json.dumps(value), user_id)
+        )
+
+def apply_pref(conn, user_id, key, value=_REMOVE):
+    """Sæt én præferencenøgle (eller fjern den) uden at røre resten – samme opdeling som write_prefs."""
+    residual, departments, identity, exclude, counts, quiet = _split_prefs({} if value is _REMOVE else {key: value})
+    if key in ("obserkode", "navn"):
+        conn.execute(
+            "INSERT INTO user_identity (user_id, obserkode_key) VALUES (?, '') ON CONFLICT(user_id) DO NOTHING",
+            (user_id,)
+        )
+        if key == "obserkode":
+            conn.execute(
+                "UPDATE user_identity SET obserkode=?, obserkode_key=? WHERE user_id=?",
+                (identity.get("obserkode"), obserkode_key(identity.get("obserkode")), user_id)
+            )
+        else:
+            conn.execute("UPDATE user_identity SET navn=? WHERE user_id=?", (identity.get("navn"), user_id))
+        conn.execute("DELETE FROM user_identity WHERE user_id=? AND obserkode IS NULL AND navn IS NULL", (user_id,))
+    elif key == "species_filters":
+        conn.execute("DELETE FROM species_exclude WHERE user_id=?", (user_id,))
+        conn.execute("DELETE FROM species_min_count WHERE user_id=?", (user_id,))
+        if exclude:
+            conn.executemany(
+                "INSERT OR IGNORE INTO species_exclude (user_id, art) VALUES (?, ?)",
+                [(user_id, art) for art in exclude]
+            )
+        if counts:
+            conn.executemany(
+                "INSERT OR REPLACE INTO species_min_count (user_id, art, min_count) VALUES (?, ?, ?)",
+                [(user_id, art, min_count) for art, min_count in counts]
+            )
+    elif key == "quiet_hours":
+        conn.execute("DELETE FROM quiet_hours WHERE user_id=?", (user_id,))
+        if quiet:
+            conn.executemany(
+                "INSERT INTO quiet_hours (user_id, device_id, start, end, defer) VALUES (?, ?, ?, ?, ?)",
+                [(user_id,) + qh for qh in quiet]
+            )
+    elif departments:
+        conn.execute(
+            "INSERT INTO user_departments (user_id, afdeling, level) VALUES (?, ?, ?) "
+            "ON CONFLICT(user_id, afdeling) DO UPDATE SET level = excluded.level",
+            (user_id, key, departments[0][1])
+        )
+    else:
+        conn.execute("DELETE FROM user_departments WHERE user_id=? AND afdeling=?", (user_id, key))
+    _set_residual_pref(conn, user_id, key, residual[key] if key in residual else _REMOVE)
+
+def set_device_quiet_hours(conn, user_id, device_id, start=None, end=None, defer=False):
+    """Sæt eller slet (uden start/end) den stille periode for én enhed."""
+    if not start or not end:
+        conn.execute("DELETE FROM quiet_hours WHERE user_id=? AND device_id=?", (user_id, device_id))
+    else:
+        conn.execute(
+            "INSERT INTO quiet_hours (user_id, device_id, start, end, defer) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(user_id, device_id) DO UPDATE SET start = excluded.start, end = excluded.end, defer = excluded.defer",
+            (user_id, device_id, start, end, int(bool(defer)))
+        )
+
+def bump_prefs_version(conn, user_id, ts=None):
+    if ts is None:
+        ts = int(datetime.now().timestamp())
+    row = conn.execute(
+        "UPDATE user_prefs SET version = version + 1, ts = ? WHERE user_id=? RETURNING version",
+        (ts, user_id)
+    ).fetchone()
+    return row[0] if row else 0
+
+def read_prefs_version(conn, user_id):
+    row = conn.execute("SELECT version FROM user_prefs WHERE user_id=?", (user_id,)).fetchone()
+    return row[0] if row else 0
+
+def mutate_prefs(user_id, mutate, expected_version=None):
+    """Kør mutate(conn) for user_id i én transaktion og returnér det nye versionsnummer.
+
+    Er expected_version sat og er præferencerne ændret siden, afvises ændringen med 409.
+    """
+    if expected_version is not None:
+        try:
+            expected_version = int(expected_version)
+        except (TypeError, ValueError):
+            raise HTTPException(status_code=400, detail="Ugyldig version")
+    conn = db_connect()
+    conn.commit()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute(
+            "INSERT INTO user_prefs (user_id, prefs, ts) VALUES (?, '{}', ?) ON CONFLICT(user_id) DO NOTHING",
+            (user_id, int(datetime.now().timestamp()))
+        )
+        current = read_prefs_version(conn, user_id)
+        if expected_version is not None and expected_version != current:
+            raise HTTPException(
+                status_code=409,
+                detail={"error": "Præferencerne er ændret et andet sted", "version": current}
+            )
+        mutate(conn)
+        version = bump_prefs_version(conn, user_id)
+        bump_cache_generation(conn)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return version
+
+def normalize_user_prefs(conn):
+    """Flyt gamle JSON-præferencer over i de normaliserede tabeller."""
+    migrated = 0
+    for user_id, prefs_json, ts in conn.execute("SELECT user_id, prefs, ts FROM user_prefs").fetchall():
+        try:
+            prefs = json.loads(prefs_json) if prefs_json else {}
+        except Exception:
+            continue
+        if isinstance(prefs, dict):
+            write_prefs(conn, user_id, prefs, ts)
+            migrated += 1
+    print(f"[migrate] Normaliserede præferencer for {migrated} brugere")
+
+def count_db_users(conn):
+    """(brugere i alt, med obserkode, uden obserkode, unikke obserkoder) til statistikken."""
+    total = conn.execute("SELECT COUNT(*) FROM user_prefs").fetchone()[0]
+    with_kode, unique_koder = conn.execute(
+        "SELECT COUNT(*), COUNT(DISTINCT obserkode) FROM user_identity "
+        "WHERE obserkode IS NOT NULL AND obserkode <> ''"
+    ).fetchone()
+    return total, with_kode, total - with_kode, unique_koder
+
+# --- SKEMA-MIGRERINGER ---
+# Nummererede migreringer oven på tabellerne fra db_init. schema_version har en række pr.
+# anvendt migrering; run_migrations kører de manglende i rækkefølge i én BEGIN IMMEDIATE,
+# så kun én worker migrerer når flere starter samtidig. Nye migreringer tilføjes sidst i
+# MIGRATIONS og må aldrig omnummereres.
+def thread_day_key(day):
+    """'DD-MM-YYYY' (som i URL'er og obs-mapper) -> 'YYYY-MM-DD' som gemmes i thread_subs/unsubs."""
+    day = str(day or "")
+    if len(day) == 10 and day[2] == "-" and day[5] == "-":
+        return f"{day[6:]}-{day[3:5]}-{day[:2]}"
+    return day
+
+def thread_day_from_key(key):
+    """Omvendt af thread_day_key."""
+    key = str(key or "")
+    if len(key) == 10 and key[4] == "-" and key[7] == "-":
+        return f"{key[8:]}-{key[5:7]}-{key[:4]}"
+    return key
+
+def _add_secondary_indexes(conn):
+    for sql in (
+        # is-subscribed slår op på device_id (OR user_id)
+        "CREATE INDEX IF NOT EXISTS idx_subscriptions_device ON subscriptions(device_id)",
+        # Oprydning når en enhed afmeldes eller slettes
+        "CREATE INDEX IF NOT EXISTS idx_thread_subs_user ON thread_subs(user_id, device_id)",
+        "CREATE INDEX IF NOT EXISTS idx_thread_unsubs_user ON thread_unsubs(user_id, device_id)",
+        "CREATE INDEX IF NOT EXISTS idx_push_outbox_user ON push_outbox(user_id, device_id)",
+        "CREATE INDEX IF NOT EXISTS idx_push_outbox_attempts ON push_outbox(attempts)",
+    ):
+        conn.execute(sql)
+
+def _thread_days_to_iso(conn):
+    for table in ("thread_subs", "thread_unsubs"):
+        # OR IGNORE: findes samme række allerede med ISO-dato, bliver den gamle stående og slettes bagefter
+        conn.execute(
+            f"UPDATE OR IGNORE {table} SET day = substr(day, 7, 4) || '-' || substr(day, 4, 2) || '-' || substr(day, 1, 2) "
+            "WHERE day GLOB '[0-9][0-9]-[0-9][0-9]-[0-9][0-9][0-9][0-9]'"
+        )
+        conn.execute(f"DELETE FROM {table} WHERE day GLOB '[0-9][0-9]-[0-9][0-9]-[0-9][0-9][0-9][0-9]'")
+
+def _add_prefs_version(conn):
+    conn.execute("ALTER TABLE user_prefs ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+
+def _add_maintenance_tables(conn):
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_obsid_subs_date ON obsid_subs(date)")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS maintenance_lease (
+            name TEXT PRIMARY KEY,
+            owner TEXT,
+            expires REAL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS maintenance_runs (
+            job TEXT PRIMARY KEY,
+            last_run REAL,
+            duration_ms REAL,
+            detail TEXT
+        )
+    """)
+
+def _stats_notifications_to_counters(conn):
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='stats_notifications'").fetchone():
+        conn.execute(
+            "INSERT INTO stats_counters (date, metric, count) "
+            "SELECT date, 'obs_notification', obs_notification FROM stats_notifications WHERE obs_notification > 0 "
+            "ON CONFLICT(date, metric) DO UPDATE SET count = count + excluded.count"
+        )
+        conn.execute("DROP TABLE stats_notifications")
+
+MIGRATIONS = (
+    (1, "normaliser brugerpræferencer", normalize_user_prefs),
+    (2, "sekundære indekser", _add_secondary_indexes),
+    (3, "ISO-datoer i thread_subs/thread_unsubs", _thread_days_to_iso),
+    (4, "versionsnummer på præferencer", _add_prefs_version),
+    (5, "vedligeholdelses-lease og obsid_subs-datoindeks", _add_maintenance_tables),
+    (6, "stats_notifications -> stats_counters", _stats_notifications_to_counters),
+)
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def get_schema_version(conn):
+    return conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+
+def run_migrations(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            name TEXT,
+            applied REAL
+        )
+    """)
+    conn.commit()
+    if get_schema_version(conn) >= SCHEMA_VERSION:
+        return
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        current = get_schema_version(conn)
+        # Databaser fra før schema_version markerede præference-migreringen med user_version
+        if current == 0 and conn.execute("PRAGMA user_version").fetchone()[0] >= 1:
+            conn.execute("INSERT INTO schema_version (version, name, applied) VALUES (1, ?, ?)", (MIGRATIONS[0][1], time.time()))
+            current = 1
+        for version, name, migrate in MIGRATIONS:
+            if version <= current:
+                continue
+            t0 = time.perf_counter()
+            migrate(conn)
+            conn.execute("INSERT INTO schema_version (version, name, applied) VALUES (?, ?, ?)", (version, name, time.time()))
+            print(f"[migrate] {version}: {name} ({(time.perf_counter() - t0) * 1000:.0f} ms)")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    conn.execute("ANALYZE")
+
 def db_init():
-    with sqlite3.connect(DB_PATH) as conn:
+    with db_connect() as conn:
         conn.execute("""
             CREATE TABLE IF NOT EXISTS user_prefs (
                 user_id TEXT PRIMARY KEY,
@@ -150,27 +851,203 @@ def db_init():
                 PRIMARY KEY (user_id, device_id, obsid)
             )
         """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_obsid_subs_obsid ON obsid_subs(obsid)")
         conn.execute("""
-            CREATE TABLE IF NOT EXISTS stats_notifications (
-                date TEXT PRIMARY KEY,
-                obs_notification INTEGER DEFAULT 0
+            CREATE TABLE IF NOT EXISTS stats_counters (
+                date TEXT,
+                metric TEXT,
+                count INTEGER DEFAULT 0,
+                PRIMARY KEY (date, metric)
             )
         """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS push_outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT,
+                device_id TEXT,
+                payload TEXT,
+                obsid TEXT,
+                attempts INTEGER DEFAULT 0,
+                next_attempt REAL,
+                claimed_until REAL DEFAULT 0,
+                created REAL,
+                stages TEXT
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_push_outbox_next ON push_outbox(next_attempt)")
+        outbox_columns = {row[1] for row in conn.execute("PRAGMA table_info(push_outbox)")}
+        if "stages" not in outbox_columns:
+            conn.execute("ALTER TABLE push_outbox ADD COLUMN stages TEXT")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS latency_hist (
+                date TEXT,
+                stage TEXT,
+                bucket INTEGER,
+                count INTEGER DEFAULT 0,
+                PRIMARY KEY (date, stage, bucket)
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS cache_generation (
+                name TEXT PRIMARY KEY,
+                gen INTEGER DEFAULT 0
+            )
+        """)
+        # Normaliserede præferencer (se BRUGERPRÆFERENCER); user_prefs.prefs holder kun resten
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS user_departments (
+                user_id TEXT,
+                afdeling TEXT,
+                level TEXT,
+                PRIMARY KEY (user_id, afdeling)
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS user_identity (
+                user_id TEXT PRIMARY KEY,
+                obserkode TEXT,
+                obserkode_key TEXT,
+                navn TEXT
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_user_identity_obserkode ON user_identity(obserkode_key)")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS species_exclude (
+                user_id TEXT,
+                art TEXT,
+                PRIMARY KEY (user_id, art)
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS species_min_count (
+                user_id TEXT,
+                art TEXT,
+                min_count,
+                PRIMARY KEY (user_id, art)
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS quiet_hours (
+                user_id TEXT,
+                device_id TEXT,
+                start TEXT,
+                end TEXT,
+                defer INTEGER,
+                PRIMARY KEY (user_id, device_id)
+            )
+        """)
+        # Når en user_prefs-række slettes (uanset hvor), forsvinder resten af præferencerne med den
+        conn.execute("""
+            CREATE TRIGGER IF NOT EXISTS user_prefs_delete AFTER DELETE ON user_prefs
+            BEGIN
+                DELETE FROM user_departments WHERE user_id = OLD.user_id;
+                DELETE FROM user_identity WHERE user_id = OLD.user_id;
+                DELETE FROM species_exclude WHERE user_id = OLD.user_id;
+                DELETE FROM species_min_count WHERE user_id = OLD.user_id;
+                DELETE FROM quiet_hours WHERE user_id = OLD.user_id;
+            END
+        """)
+        run_migrations(conn)
 db_init()
 
+def bump_cache_generation(conn, name="subscribers"):
+    """Markér in-memory caches (fx routing-indekset) som forældede i alle workers."""
+    conn.execute(
+        "INSERT INTO cache_generation (name, gen) VALUES (?, 1) "
+        "ON CONFLICT(name) DO UPDATE SET gen = gen + 1",
+        (name,)
+    )
+    if name == "subscribers":
+        invalidate_lookup_cache()
+
+def get_cache_generation(conn, name="subscribers"):
+    row = conn.execute("SELECT gen FROM cache_generation WHERE name=?", (name,)).fetchone()
+    return row[0] if row else 0
+
+# --- OPSLAGS-CACHE ---
+# LRU-cache i processen til device_id, præferencer og obserkode/navn pr. user_id.
+# Gyldigheden tjekkes med PRAGMA data_version (ændres når en anden forbindelse – anden tråd,
+# worker eller cron – har committet) og først derefter med "subscribers"-generationen, som
+# bumpes ved hver skrivning til præferencer og subscriptions. Egne skrivninger rydder cachen
+# direkte i bump_cache_generation. Opslag midt i en åben transaktion går udenom cachen.
+LOOKUP_CACHE_MAX = int(os.environ.get("LOOKUP_CACHE_MAX", "20000"))
+_lookup_cache = OrderedDict()
+_lookup_cache_state = {"generation": None}
+_lookup_cache_lock = threading.Lock()
+_lookup_cache_stats = defaultdict(lambda: {"hits": 0, "misses": 0})
+_lookup_local = threading.local()
+
+def invalidate_lookup_cache():
+    with _lookup_cache_lock:
+        _lookup_cache.clear()
+        _lookup_cache_state["generation"] = None
+    _lookup_local.data_version = None
+
+def _validate_lookup_cache(conn):
+    data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+    if data_version == getattr(_lookup_local, "data_version", None) and _lookup_cache_state["generation"] is not None:
+        return
+    generation = get_cache_generation(conn)
+    with _lookup_cache_lock:
+        if _lookup_cache_state["generation"] != generation:
+            _lookup_cache.clear()
+            _lookup_cache_state["generation"] = generation
+    _lookup_local.data_version = data_version
+
+def cached_lookup(kind, key, loader):
+    """Slå (kind, key) op i cachen; ved miss kaldes loader(conn), og resultatet gemmes."""
+    conn = db_connect()
+    if conn.in_transaction:
+        return loader(conn)
+    _validate_lookup_cache(conn)
+    cache_key = (kind, key)
+    with _lookup_cache_lock:
+        if cache_key in _lookup_cache:
+            _lookup_cache.move_to_end(cache_key)
+            _lookup_cache_stats[kind]["hits"] += 1
+            return _lookup_cache[cache_key]
+        _lookup_cache_stats[kind]["misses"] += 1
+        generation = _lookup_cache_state["generation"]
+    value = loader(conn)
+    with _lookup_cache_lock:
+        # Gem kun hvis cachen ikke er blevet ugyldiggjort imens
+        if _lookup_cache_state["generation"] == generation:
+            _lookup_cache[cache_key] = value
+            if len(_lookup_cache) > LOOKUP_CACHE_MAX:
+                _lookup_cache.popitem(last=False)
+    return value
+
+def lookup_cache_stats():
+    with _lookup_cache_lock:
+        lookups = {}
+        for kind, counts in sorted(_lookup_cache_stats.items()):
+            total = counts["hits"] + counts["misses"]
+            lookups[kind] = {**counts, "hit_rate": round(counts["hits"] / total, 3) if total else None}
+        return {
+            "pid": os.getpid(),
+            "generation": _lookup_cache_state["generation"],
+            "entries": len(_lookup_cache),
+            "max_entries": LOOKUP_CACHE_MAX,
+            "lookups": lookups,
+        }
+
+def _load_identity(conn, user_id):
+    return conn.execute("SELECT obserkode, navn FROM user_identity WHERE user_id=?", (user_id,)).fetchone()
+
 def cleanup_user_prefs_without_subscriptions():
     """
     Slet alle user_prefs hvor user_id ikke findes i subscriptions.
     """
-    with sqlite3.connect(DB_PATH) as conn:
+    with db_connect() as conn:
         conn.execute("""
             DELETE FROM user_prefs
             WHERE user_id NOT IN (SELECT DISTINCT user_id FROM subscriptions)
         """)
+        bump_cache_generation(conn)
         conn.commit()
 
 def remove_subscription_and_cleanup(user_id, device_id):
-    with sqlite3.connect(DB_PATH) as conn:
+    with db_connect() as conn:
         cur = conn.execute(
             "DELETE FROM subscriptions WHERE user_id=? AND device_id=?",
             (user_id, device_id)
@@ -185,6 +1062,10 @@ def remove_subscription_and_cleanup(user_id, device_id):
             "DELETE FROM thread_unsubs WHERE user_id=? AND device_id=?",
             (user_id, device_id)
         )
+        conn.execute(
+            "DELETE FROM push_outbox WHERE user_id=? AND device_id=?",
+            (user_id, device_id)
+        )
         # Slet user_prefs hvis der ikke er flere subscriptions for user_id
         remaining = conn.execute(
             "SELECT 1 FROM subscriptions WHERE user_id=? LIMIT 1",
@@ -198,6 +1079,7 @@ def remove_subscription_and_cleanup(user_id, device_id):
             print(f"[remove_subscription_and_cleanup] Slettede user_prefs for {user_id} (ingen subscriptions tilbage)")
         else:
             print(f"[remove_subscription_and_cleanup] Der findes stadig subscriptions for {user_id} efter sletning!")
+        bump_cache_generation(conn)
         conn.commit()
 
 def slugify(text):
@@ -206,25 +1088,26 @@ def slugify(text):
     return '-'.join(words)
 
 def get_navn_from_userid(user_id):
-    with sqlite3.connect(DB_PATH) as conn:
-        cur = conn.execute("SELECT prefs FROM user_prefs WHERE user_id=?", (user_id,))
-        row = cur.fetchone()
-        if row:
-            try:
-                prefs = json.loads(row[0])
-                return prefs.get("navn") or prefs.get("obserkode") or user_id
-            except Exception:
-                return user_id
+    row = cached_lookup("identity", user_id, lambda conn: _load_identity(conn, user_id))
+    if row:
+        return row[1] or row[0] or user_id
     return user_id
 
+def _load_device_id(conn, user_id):
+    row = conn.execute(
+        "SELECT device_id FROM subscriptions WHERE user_id=? LIMIT 1",
+        (user_id,)
+    ).fetchone()
+    return row[0] if row else None
+
+def load_all_subscriptions():
+    """(user_id, device_id, subscription-json) for alle enheder – til push til alle brugere."""
+    with db_connect() as conn:
+        return conn.execute("SELECT user_id, device_id, subscription FROM subscriptions").fetchall()
+
 def get_device_id_for_user(user_id):
     """Returner device_id for user_id fra subscriptions-tabellen (første fundne)."""
-    with sqlite3.connect(DB_PATH) as conn:
-        row = conn.execute(
-            "SELECT device_id FROM subscriptions WHERE user_id=? LIMIT 1",
-            (user_id,)
-        ).fetchone()
-    return row[0] if row else None
+    return cached_lookup("device", user_id, lambda conn: _load_device_id(conn, user_id))
 
 def cleanup_dirs(base_dir, days=3):
     now = datetime.now()
@@ -241,67 +1124,265 @@ def cleanup_dirs(base_dir, days=3):
             import shutil
             shutil.rmtree(dir_path)
 
+# --- VEDLIGEHOLDELSE ---
+# Én vedligeholdelsestråd pr. worker, men kun den worker der holder lejemålet i maintenance_lease
+# kører jobbene; de andre prøver igen ved næste tik og overtager, hvis holderen dør (lejemålet
+# udløber). Hvornår et job sidst kørte, står i maintenance_runs, så intervallerne gælder på
+# tværs af workers og genstarter. Hvert job logges med sin køretid.
+MAINTENANCE_TICK = 60                      # sekunder mellem forsøg på at tage/forny lejemålet
+MAINTENANCE_LEASE_TTL = 10 * 60
+OBSID_SUBS_DAYS = int(os.environ.get("OBSID_SUBS_DAYS", "14"))
+VACUUM_MIN_FREE_PAGES = 1000               # incremental vacuum først når der er noget at hente
+VACUUM_CONVERT_MAX_BYTES = 256 * 1024 * 1024  # større databaser omlægges manuelt (VACUUM låser skrivning)
+_maintenance_owner = f"{socket.gethostname()}:{os.getpid()}"
+_maintenance_stop = threading.Event()
+
+def acquire_maintenance_lease(conn, now=None):
+    """Tag eller forny lejemålet. True hvis denne proces holder det."""
+    now = now or time.time()
+    row = conn.execute(
+        "INSERT INTO maintenance_lease (name, owner, expires) VALUES ('maintenance', ?, ?) "
+        "ON CONFLICT(name) DO UPDATE SET owner=excluded.owner, expires=excluded.expires "
+        "WHERE maintenance_lease.owner=excluded.owner OR maintenance_lease.expires < ? "
+        "RETURNING owner",
+        (_maintenance_owner, now + MAINTENANCE_LEASE_TTL, now)
+    ).fetchone()
+    conn.commit()
+    return row is not None
+
+def release_maintenance_lease(conn):
+    conn.execute("DELETE FROM maintenance_lease WHERE name='maintenance' AND owner=?", (_maintenance_owner,))
+    conn.commit()
+
+def _present_obs_days():
+    obs_root = os.path.join(web_dir, "obs")
+    if not os.path.isdir(obs_root):
+        return set()
+    return {
+        thread_day_key(name) for name in os.listdir(obs_root)
+        if os.path.isdir(os.path.join(obs_root, name))
+    }
+
+def cleanup_files():
+    for name in ("payload", "obs"):
+        path = os.path.join(web_dir, name)
+        if os.path.isdir(path):
+            cleanup_dirs(path, days=3)
+    return ""
+
 def database_maintenance():
-    with sqlite3.connect(DB_PATH) as conn:
+    """Set-baseret oprydning: tråd-abonnementer for dage uden obs-mappe og gamle obsid_subs."""
+    present = sorted(_present_obs_days())
+    oldest = present[0] if present else None
+    cutoff = (datetime.now() - timedelta(days=OBSID_SUBS_DAYS)).strftime("%Y-%m-%d")
+    deleted = {}
+    with db_connect() as conn:
         # Slet KUN thread_subs og thread_unsubs for dage der ikke længere findes i obs
         for table in ["thread_subs", "thread_unsubs"]:
-            days = conn.execute(f"SELECT DISTINCT day FROM {table}").fetchall()
-            for (day,) in days:
-                obs_dir = os.path.join(web_dir, "obs", day)
-                if not os.path.isdir(obs_dir):
-                    print(f"Sletter {table} for dag {day} (mappe findes ikke)")
-                    conn.execute(f"DELETE FROM {table} WHERE day=?", (day,))
+            if oldest is None:
+                deleted[table] = conn.execute(f"DELETE FROM {table}").rowcount
+                continue
+            # Alt før den ældste mappe i ét intervalslet, huller efter den i ét slet mod listen
+            cur = conn.execute(f"DELETE FROM {table} WHERE day < ?", (oldest,))
+            gaps = conn.execute(
+                f"DELETE FROM {table} WHERE day >= ? AND day NOT IN (SELECT value FROM json_each(?))",
+                (oldest, json.dumps(present))
+            )
+            deleted[table] = cur.rowcount + gaps.rowcount
+        deleted["obsid_subs"] = conn.execute("DELETE FROM obsid_subs WHERE date < ?", (cutoff,)).rowcount
         conn.commit()
+    for table, count in deleted.items():
+        if count:
+            print(f"Sletter {count} rækker i {table}")
     # Ryd op i user_prefs uden tilknyttede subscriptions
-    cleanup_user_prefs_without_subscriptions()  
+    cleanup_user_prefs_without_subscriptions()
+    return ", ".join(f"{table}={count}" for table, count in deleted.items())
 
-obs_notification_queue = queue.Queue()
+def wal_checkpoint():
+    with db_connect() as conn:
+        busy, log_pages, checkpointed = conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+    return f"busy={busy} log={log_pages} checkpointed={checkpointed}"
 
-def obs_notification_worker():
-    import sqlite3
-    tz = pytz.timezone("Europe/Copenhagen")
-    while True:
-        today = datetime.now(pytz.UTC).astimezone(tz).strftime("%Y-%m-%d")
-        # Saml alle kald i køen (batch)
-        count = 0
+def analyze_database():
+    with db_connect() as conn:
+        conn.execute("ANALYZE")
+    return ""
+
+def incremental_vacuum():
+    with db_connect() as conn:
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            # Ældre database: auto_vacuum=INCREMENTAL (sat i DB_PRAGMAS) gælder først efter et fuldt VACUUM
+            size = conn.execute("PRAGMA page_count").fetchone()[0] * conn.execute("PRAGMA page_size").fetchone()[0]
+            if size > VACUUM_CONVERT_MAX_BYTES:
+                return f"auto_vacuum mangler – kør VACUUM manuelt ({size // (1024 * 1024)} MB)"
+            conn.execute("VACUUM")
+            return "omlagt til auto_vacuum=INCREMENTAL (fuldt VACUUM)"
+        free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if free < VACUUM_MIN_FREE_PAGES:
+            return f"freelist={free}"
+        # executescript kører pragmaen til ende; execute() frigør kun én side pr. kald
+        conn.executescript("PRAGMA incremental_vacuum")
+        return f"frigjort={free - conn.execute('PRAGMA freelist_count').fetchone()[0]} sider"
+
+# (navn, interval i sekunder, funktion)
+MAINTENANCE_JOBS = (
+    ("filer", 3600, cleanup_files),
+    ("oprydning", 3600, database_maintenance),
+    ("wal_checkpoint", 15 * 60, wal_checkpoint),
+    ("analyze", 24 * 3600, analyze_database),
+    ("incremental_vacuum", 24 * 3600, incremental_vacuum),
+)
+
+def run_due_maintenance(now=None, force=False):
+    """Kør de jobs hvis interval er gået. Kaldes kun af lejemålets holder."""
+    now = now or time.time()
+    with db_connect() as conn:
+        last_runs = dict(conn.execute("SELECT job, last_run FROM maintenance_runs").fetchall())
+    for name, interval, job in MAINTENANCE_JOBS:
+        if not force and now - last_runs.get(name, 0) < interval:
+            continue
+        t0 = time.perf_counter()
         try:
-            while True:
-                obs_notification_queue.get(timeout=1)
-                count += 1
-        except queue.Empty:
-            pass
-        if count > 0:
-            with sqlite3.connect(DB_PATH) as conn:
-                conn.execute("""
-                    INSERT INTO stats_notifications (date, obs_notification)
-                    VALUES (?, ?)
-                    ON CONFLICT(date) DO UPDATE SET obs_notification = obs_notification + ?
-                """, (today, count, count))
-                conn.commit()
+            detail = job() or ""
+        except Exception as e:
+            logging.exception(f"[vedligehold] {name} fejlede: {e}")
+            detail = f"fejl: {e}"
+        duration_ms = (time.perf_counter() - t0) * 1000
+        logging.info(f"[vedligehold] {name}: {duration_ms:.0f} ms {detail}")
+        with db_connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO maintenance_runs (job, last_run, duration_ms, detail) VALUES (?, ?, ?, ?)",
+                (name, time.time(), duration_ms, detail)
+            )
+            conn.commit()
+
+def maintenance_scheduler():
+    while not _maintenance_stop.is_set():
+        try:
+            with db_connect() as conn:
+                holder = acquire_maintenance_lease(conn)
+            if holder:
+                run_due_maintenance()
+        except Exception as e:
+            logging.exception(f"[vedligehold] Fejl i scheduler: {e}")
+        _maintenance_stop.wait(MAINTENANCE_TICK)
+    try:
+        with db_connect() as conn:
+            release_maintenance_lease(conn)
+    except Exception:
+        pass
+
+# --- PUSH-LEVERING (asyncio) ---
+# Én langlivet aiohttp-session pr. worker med keep-alive forbindelser pr. push-tjeneste
+# (FCM, Mozilla autopush, Apple). limit_per_host begrænser samtidige forbindelser pr. origin,
+# så en stor fan-out hverken åbner en TLS-forbindelse pr. besked eller oversvømmer én tjeneste.
+PUSH_MAX_PER_ORIGIN = int(os.environ.get("PUSH_MAX_PER_ORIGIN", "64"))
+PUSH_TIMEOUT = 15  # sekunder pr. push-request
+VAPID_CLAIMS_SUB = "mailto:kontakt@dofnot.dk"
+
+# VAPID-tokens afhænger kun af push-tjenestens origin (aud), så en signeret header genbruges
+# for alle subscriptions hos samme tjeneste, indtil den er tæt på at udløbe.
+VAPID_TOKEN_LIFETIME = 12 * 3600
+VAPID_TOKEN_MARGIN = 30 * 60
+
+_push_session = None
+_vapid_key = None
+_vapid_header_cache = {}
+
+def get_vapid_headers(endpoint, sub=VAPID_CLAIMS_SUB):
+    """Returnér VAPID-headers for endpointets origin; signerer kun når cachen er udløbet."""
+    global _vapid_key
+    url = urlparse(endpoint or "")
+    aud = f"{url.scheme}://{url.netloc}"
+    now = time.time()
+    cached = _vapid_header_cache.get((aud, sub))
+    if cached and cached[0] - VAPID_TOKEN_MARGIN > now:
+        return cached[1]
+    if _vapid_key is None:
+        _vapid_key = Vapid.from_string(private_key=VAPID_PRIVATE_KEY)
+    exp = int(now) + VAPID_TOKEN_LIFETIME
+    headers = _vapid_key.sign({"sub": sub, "aud": aud, "exp": exp})
+    _vapid_header_cache[(aud, sub)] = (exp, headers)
+    return headers
+
+def get_push_session():
+    """Returnér workerens fælles push-session (oprettes ved første brug i event-loopet)."""
+    global _push_session
+    if _push_session is None or _push_session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=0,
+            limit_per_host=PUSH_MAX_PER_ORIGIN,
+            keepalive_timeout=75,
+            ttl_dns_cache=300,
+        )
+        _push_session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=PUSH_TIMEOUT),
+        )
+    return _push_session
+
+async def close_push_session():
+    global _push_session
+    if _push_session is not None and not _push_session.closed:
+        await _push_session.close()
+    _push_session = None
+
+def _is_dns_error(ex):
+    text = str(ex)
+    return (
+        "getaddrinfo failed" in text
+        or "NameResolutionError" in text
+        or "Failed to resolve" in text
+        or isinstance(ex, getattr(aiohttp, "ClientConnectorDNSError", ()))
+    )
 
-# Start baggrundstråden én gang ved opstart
-threading.Thread(target=obs_notification_worker, daemon=True).start()
+async def send_push(sub, push_payload, user_id, device_id, ensure_ascii=True, stage_ts=None):
+    """Send én web push via den fælles forbindelsespulje.
 
-def send_push(sub, push_payload, user_id, device_id):
+    Returnerer "ok", "gone" (abonnementet er slettet), "retry" (midlertidig fejl hos
+    push-tjenesten eller på netværket) eller "failed" (permanent fejl, prøv ikke igen).
+    Hvis stage_ts er en dict, sættes "encrypted" og "push_done" (epoch) i den.
+    """
     try:
-        webpush(
-            subscription_info=sub,
-            data=json.dumps(push_payload),
-            vapid_private_key=VAPID_PRIVATE_KEY,
-            vapid_claims={"sub": "mailto:kontakt@dofnot.dk"},
+        headers = {"Urgency": "high"}
+        headers.update(get_vapid_headers(sub.get("endpoint")))
+        session = get_push_session()
+        # Som WebPusher.send_async, men delt op så kryptering og HTTP kan tidsmåles hver for sig
+        params = WebPusher(sub, aiohttp_session=session)._prepare_send_data(
+            json.dumps(push_payload, ensure_ascii=ensure_ascii),
+            headers,
             ttl=3600,
-            headers={"Urgency": "high"}
+            content_encoding="aes128gcm",
         )
+        if stage_ts is not None:
+            stage_ts["encrypted"] = time.time()
+        async with session.post(
+            params["endpoint"],
+            data=params["data"],
+            headers=params["headers"],
+            timeout=aiohttp.ClientTimeout(total=PUSH_TIMEOUT),
+        ) as response:
+            response_text = await response.text()
+        if response.status > 202:
+            raise WebPushException(
+                f"Push failed: {response.status} {response.reason}\nResponse body:{response_text}",
+                response=response,
+            )
+        if stage_ts is not None:
+            stage_ts["push_done"] = time.time()
+        count_metric("obs_notification")
+        return "ok"
     except WebPushException as ex:
         should_delete = False
         status = None
-        if hasattr(ex, "response") and ex.response:
+        if hasattr(ex, "response") and ex.response is not None:
             status = getattr(ex.response, "status_code", None)
             if status is None:
                 status = getattr(ex.response, "status", None)
-            msg = f"[WebPushException] status={status}, body={getattr(ex.response, 'content', '')}"
+            msg = f"[WebPushException] status={status}, fejl={ex}"
             print(msg)
             logging.info(msg)
+        count_metric(f"push_failed:{status or 'ukendt'}")
         if status == 410:
             should_delete = True
         elif "unsubscribed" in str(ex).lower() or "expired" in str(ex).lower():
@@ -310,61 +1391,416 @@ def send_push(sub, push_payload, user_id, device_id):
             msg = f"Sletter abonnement for {user_id}/{device_id} pga. push-fejl: {ex}"
             print(msg)
             logging.info(msg)
-            remove_subscription_and_cleanup(user_id, device_id)
-        else:
-            msg = f"Push-fejl til {user_id}/{device_id}: {ex}"
-            print(msg)
-            logging.info(msg)
+            await run_db(remove_subscription_and_cleanup, user_id, device_id)
+            return "gone"
+        msg = f"Push-fejl til {user_id}/{device_id}: {ex}"
+        print(msg)
+        logging.info(msg)
+        if status == 429 or (status is not None and status >= 500):
+            return "retry"
+        return "failed"
     except Exception as ex:
-        msg = f"Uventet push-fejl til {user_id}/{device_id}: {ex}"
+        msg = f"Uventet push-fejl til {user_id}/{device_id}: {ex!r}"
         print(msg)
         logging.info(msg)
-        if "getaddrinfo failed" in str(ex) or "NameResolutionError" in str(ex) or "Failed to resolve" in str(ex):
+        count_metric(f"push_failed:{'dns' if _is_dns_error(ex) else type(ex).__name__}")
+        if _is_dns_error(ex):
             msg = f"Sletter abonnement for {user_id}/{device_id} pga. netværksfejl: {ex}"
             print(msg)
             logging.info(msg)
-            remove_subscription_and_cleanup(user_id, device_id)
+            await run_db(remove_subscription_and_cleanup, user_id, device_id)
+            return "gone"
+        if isinstance(ex, (aiohttp.ClientError, asyncio.TimeoutError)):
+            return "retry"
+        return "failed"
+
+# --- LATENS-MÅLING ---
+# Hver række har stage_ts (epoch pr. stadie) fra watcheren; serveren tilføjer sine egne stadier.
+# Tiden mellem to på hinanden følgende stadier lægges i et histogram pr. stadie (plus "total"
+# fra first_seen til push_done), som flushes til latency_hist og vises på /api/admin/latency-stats.
+LATENCY_ROW_STAGES = ("fetch_start", "fetched", "parsed", "enriched", "diffed", "sent", "received", "routed")
+LATENCY_PUSH_STAGES = ("routed", "dequeued", "encrypted", "push_done")
+LATENCY_BUCKETS_MS = (
+    10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000,
+    30000, 60000, 120000, 300000, 600000, 1800000, 3600000
+)
+_latency_counts = defaultdict(int)  # (stage, bucket-grænse i ms, -1 = over sidste grænse) -> antal
+_latency_lock = threading.Lock()
+
+def _latency_bucket(ms):
+    for bound in LATENCY_BUCKETS_MS:
+        if ms <= bound:
+            return bound
+    return -1
+
+def _record_stage_spans(stage_ts, stages, extra=()):
+    samples = list(extra)
+    prev = None
+    for stage in stages:
+        ts = stage_ts.get(stage)
+        if not isinstance(ts, (int, float)):
+            continue
+        if prev is not None:
+            samples.append((stage, ts - prev))
+        prev = ts
+    if not samples:
+        return
+    with _latency_lock:
+        for stage, seconds in samples:
+            _latency_counts[(stage, _latency_bucket(max(seconds, 0) * 1000))] += 1
+
+def record_row_latency(stage_ts):
+    """Registrér watcher-stadierne og serverens modtagelse/routing for én payload-række."""
+    _record_stage_spans(stage_ts, LATENCY_ROW_STAGES)
+
+def record_push_latency(stage_ts):
+    """Registrér leveringsstadierne for én push og den samlede tid fra obsid'en blev set."""
+    start = stage_ts.get("first_seen") or stage_ts.get("fetch_start")
+    done = stage_ts.get("push_done")
+    extra = [("total", done - start)] if isinstance(start, (int, float)) and done else []
+    _record_stage_spans(stage_ts, LATENCY_PUSH_STAGES, extra)
+
+def flush_latency_histograms():
+    with _latency_lock:
+        counts = dict(_latency_counts)
+        _latency_counts.clear()
+    if not counts:
+        return
+    today = datetime.now(pytz.timezone("Europe/Copenhagen")).strftime("%Y-%m-%d")
+    try:
+        with db_connect() as conn:
+            conn.executemany(
+                "INSERT INTO latency_hist (date, stage, bucket, count) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(date, stage, bucket) DO UPDATE SET count = count + excluded.count",
+                [(today, stage, bucket, n) for (stage, bucket), n in counts.items()]
+            )
+    except Exception:
+        # Læg tallene tilbage, så de kommer med ved næste flush
+        with _latency_lock:
+            for key, n in counts.items():
+                _latency_counts[key] += n
+        raise
+
+# --- TÆLLERE (write-behind) ---
+# count_metric() tæller kun op i hukommelsen (under en lås) pr. (dato, metrik); stats_flush_worker
+# skriver det samlede antal til stats_counters med ét upsert pr. nøgle hvert STATS_FLUSH_INTERVAL
+# sekund og ved nedlukning (lifespan), sammen med latens-histogrammerne. Nye metrikker koster
+# derfor ingen ekstra skrivninger på den varme sti. Metrikker: obs_notification (leverede push),
+# push_failed:<status> og comments.
+STATS_FLUSH_INTERVAL = 10
+_counters = defaultdict(int)  # (dato, metrik) -> antal siden sidste flush
+_counters_lock = threading.Lock()
+
+def count_metric(metric, n=1):
+    today = datetime.now(pytz.timezone("Europe/Copenhagen")).strftime("%Y-%m-%d")
+    with _counters_lock:
+        _counters[(today, metric)] += n
+
+def flush_counters():
+    with _counters_lock:
+        counts = dict(_counters)
+        _counters.clear()
+    if not counts:
+        return
+    try:
+        with db_connect() as conn:
+            conn.executemany(
+                "INSERT INTO stats_counters (date, metric, count) VALUES (?, ?, ?) "
+                "ON CONFLICT(date, metric) DO UPDATE SET count = count + excluded.count",
+                [(date, metric, n) for (date, metric), n in counts.items()]
+            )
+    except Exception:
+        # Læg tallene tilbage, så de kommer med ved næste flush
+        with _counters_lock:
+            for key, n in counts.items():
+                _counters[key] += n
+        raise
+
+def load_counters(conn, date):
+    """{metrik: antal} for en dato (kun det der er flushet)."""
+    return dict(conn.execute("SELECT metric, count FROM stats_counters WHERE date=?", (date,)).fetchall())
+
+def flush_stats():
+    # Hver flush for sig, så en fejl i den ene ikke holder den anden tilbage
+    for flush, what in ((flush_counters, "tællere"), (flush_latency_histograms, "histogrammer")):
+        try:
+            flush()
+        except Exception as e:
+            logging.exception(f"[stats] Kunne ikke gemme {what}: {e}")
 
-def get_prefs(user_id):
-    with sqlite3.connect(DB_PATH) as conn:
-        cur = conn.execute("SELECT prefs FROM user_prefs WHERE user_id=?", (user_id,))
-        row = cur.fetchone()
-        return json.loads(row[0]) if row else {}
-
-def set_prefs(user_id, prefs):
-    ts = int(datetime.now().timestamp())
-    with sqlite3.connect(DB_PATH) as conn:
-        conn.execute(
-            "INSERT OR REPLACE INTO user_prefs (user_id, prefs, ts) VALUES (?, ?, ?)",
-            (user_id, json.dumps(prefs), ts)
+async def stats_flush_worker():
+    while True:
+        await asyncio.sleep(STATS_FLUSH_INTERVAL)
+        await run_db(flush_stats)
+
+# --- PUSH-OUTBOX ---
+# /api/update lægger modtager-jobs i push_outbox og svarer straks 202. En drain-task i hver
+# worker (startet i lifespan) henter forfaldne jobs med en tidsbegrænset lease, så flere
+# workers kan dræne samtidig, og jobs fra en worker der dør, samles op igen efter genstart.
+PUSH_OUTBOX_BATCH = 500
+PUSH_OUTBOX_LEASE = 120  # sekunder et claimed job er reserveret til én worker
+PUSH_OUTBOX_POLL = 1.0  # sekunder mellem tjek for jobs lagt ind af andre workers
+PUSH_MAX_ATTEMPTS = 6
+# Jobs til samme enhed samles til ét digest. Med et vindue > 0 venter nye jobs op til så
+# mange sekunder, så observationer fra flere watcher-batches kan komme med i samme digest.
+PUSH_COALESCE_WINDOW = float(os.environ.get("PUSH_COALESCE_WINDOW", "0"))
+PUSH_DIGEST_LIST = 3  # antal observationer der nævnes i digestets brødtekst
+PUSH_DIGEST_URL = "https://notifikation.dofbasen.dk/?from_notification=1"
+
+_push_outbox_wakeup = asyncio.Event()
+
+def enqueue_push_jobs(conn, jobs):
+    """Læg (user_id, device_id, push_payload, obsid, stage_ts) i outboxen; commit styres af kalderen."""
+    now = time.time()
+    due = now + PUSH_COALESCE_WINDOW
+    conn.executemany(
+        "INSERT INTO push_outbox (user_id, device_id, payload, obsid, attempts, next_attempt, claimed_until, created, stages) "
+        "VALUES (?, ?, ?, ?, 0, ?, 0, ?, ?)",
+        [
+            (user_id, device_id, json.dumps(push_payload), str(obsid) if obsid else None, due, now,
+             json.dumps(stage_ts) if stage_ts else None)
+            for user_id, device_id, push_payload, obsid, stage_ts in jobs
+        ]
+    )
+
+def claim_push_jobs(limit=PUSH_OUTBOX_BATCH):
+    """Reservér forfaldne jobs atomisk og returnér dem sammen med enhedens subscription."""
+    now = time.time()
+    with db_connect() as conn:
+        claimed = conn.execute(
+            "UPDATE push_outbox SET claimed_until=? "
+            "WHERE id IN (SELECT id FROM push_outbox WHERE next_attempt<=? AND claimed_until<? ORDER BY next_attempt, id LIMIT ?) "
+            "RETURNING id, user_id, device_id, payload, obsid, attempts, stages",
+            (now + PUSH_OUTBOX_LEASE, now, now, limit)
+        ).fetchall()
+        if not claimed:
+            return []
+        if PUSH_COALESCE_WINDOW > 0:
+            # Tag ventende jobs til de samme enheder med, så de kommer med i digestet nu
+            ids = [row[0] for row in claimed]
+            placeholders = ",".join("?" * len(ids))
+            claimed += conn.execute(
+                "UPDATE push_outbox SET claimed_until=? "
+                "WHERE claimed_until<? AND +attempts=0 AND next_attempt>? "
+                f"AND (user_id, device_id) IN (SELECT user_id, device_id FROM push_outbox WHERE id IN ({placeholders})) "
+                "RETURNING id, user_id, device_id, payload, obsid, attempts, stages",
+                (now + PUSH_OUTBOX_LEASE, now, now, *ids)
+            ).fetchall()
+        subs = {}
+        for user_id, device_id in {(row[1], row[2]) for row in claimed}:
+            row = conn.execute(
+                "SELECT subscription FROM subscriptions WHERE user_id=? AND device_id=?",
+                (user_id, device_id)
+            ).fetchone()
+            if row:
+                subs[(user_id, device_id)] = row[0]
+    jobs = []
+    for job_id, user_id, device_id, payload, obsid, attempts, stages in sorted(claimed):
+        try:
+            stage_ts = json.loads(stages) if stages else {}
+        except Exception:
+            stage_ts = {}
+        stage_ts["dequeued"] = now
+        jobs.append({
+            "id": job_id,
+            "user_id": user_id,
+            "device_id": device_id,
+            "payload": payload,
+            "obsid": obsid,
+            "attempts": attempts,
+            "subscription": subs.get((user_id, device_id)),
+            "stage_ts": stage_ts,
+        })
+    return jobs
+
+def finish_push_jobs(done_ids, retry_ids, deferred=()):
+    """Fjern færdige jobs, planlæg nye forsøg med eksponentiel backoff og flyt udsatte jobs."""
+    now = time.time()
+    with db_connect() as conn:
+        conn.executemany("UPDATE push_outbox SET next_attempt=?, claimed_until=0 WHERE id=?", deferred)
+        conn.executemany("DELETE FROM push_outbox WHERE id=?", [(i,) for i in done_ids])
+        conn.executemany(
+            "UPDATE push_outbox SET attempts=attempts+1, next_attempt=? + MIN(30 * (1 << attempts), 1800), claimed_until=0 WHERE id=?",
+            [(now, i) for i in retry_ids]
         )
+        conn.execute("DELETE FROM push_outbox WHERE attempts>=?", (PUSH_MAX_ATTEMPTS,))
+
+def build_digest_payload(payloads):
+    """Saml flere push-payloads til samme enhed i én notifikation, der linker til forsiden."""
+    n = len(payloads)
+    titles = [p.get("title") for p in payloads if p.get("title")]
+    body = "; ".join(titles[:PUSH_DIGEST_LIST])
+    if len(titles) > PUSH_DIGEST_LIST:
+        body += f" og {len(titles) - PUSH_DIGEST_LIST} flere"
+    return {
+        "title": f"{n} nye observationer",
+        "body": body,
+        "url": PUSH_DIGEST_URL,
+        "tag": f"digest-{int(time.time())}"
+    }
+
+def group_push_jobs(jobs):
+    """Gruppér claimede jobs pr. (user_id, device_id) i den rækkefølge de blev lagt i kø."""
+    groups = {}
+    for job in jobs:
+        groups.setdefault((job["user_id"], job["device_id"]), []).append(job)
+    return list(groups.values())
+
+async def deliver_push_group(group, quiet, unsubscribed):
+    """Lever alle jobs til én enhed: ét job sendes uændret, flere sendes som ét digest.
+
+    quiet er (user_id, device_id) -> (bitmaske, defer) fra routing-indekset, og unsubscribed
+    er obsid-frameldinger fra load_obsid_unsubscriptions. Returnerer
+    ("done", None), ("retry", None) eller ("defer", tidspunkt) hvis jobbene skal vente til
+    enhedens stille periode slutter.
+    """
+    first = group[0]
+    if not first["subscription"]:
+        return "done", None  # Enheden er afmeldt siden jobbene blev lagt i kø
+    mask, defer = quiet.get((first["user_id"], first["device_id"]), (0, False))
+    until = quiet_until(mask)
+    if until is not None:
+        return ("defer", until) if defer else ("done", None)
+    payloads = []
+    sent_jobs = []
+    for job in group:
+        if job["obsid"] and (job["user_id"], job["device_id"], job["obsid"]) in unsubscribed:
+            continue
+        try:
+            payloads.append(json.loads(job["payload"]))
+        except Exception:
+            continue
+        sent_jobs.append(job)
+    if not payloads:
+        return "done", None
+    try:
+        sub = json.loads(first["subscription"])
+    except Exception:
+        return "done", None
+    push_payload = payloads[0] if len(payloads) == 1 else build_digest_payload(payloads)
+    push_ts = {}
+    result = await send_push(sub, push_payload, first["user_id"], first["device_id"], stage_ts=push_ts)
+    if result == "ok":
+        for job in sent_jobs:
+            record_push_latency(dict(job["stage_ts"], **push_ts))
+    return ("retry", None) if result == "retry" else ("done", None)
+
+def wake_push_outbox():
+    _push_outbox_wakeup.set()
+
+async def push_outbox_worker():
+    """Dræn push_outbox løbende; kører i hver uvicorn-worker indtil nedlukning."""
+    while True:
+        try:
+            jobs = await run_db(claim_push_jobs)
+        except Exception as e:
+            logging.exception(f"[outbox] Kunne ikke hente jobs: {e}")
+            jobs = []
+        if jobs:
+            try:
+                quiet = await run_db(load_quiet_schedules)
+                unsubscribed = await run_db(
+                    lambda: load_obsid_unsubscriptions(db_connect(), [job["obsid"] for job in jobs])
+                )
+            except Exception as e:
+                logging.exception(f"[outbox] Kunne ikke hente quiet hours/frameldinger: {e}")
+                quiet, unsubscribed = {}, set()
+            groups = group_push_jobs(jobs)
+            results = await asyncio.gather(
+                *(deliver_push_group(group, quiet, unsubscribed) for group in groups),
+                return_exceptions=True
+            )
+            done_ids, retry_ids, deferred = [], [], []
+            for group, result in zip(groups, results):
+                ids = [job["id"] for job in group]
+                if isinstance(result, Exception):
+                    logging.info(f"[outbox] Fejl ved levering til {group[0]['user_id']}/{group[0]['device_id']}: {result!r}")
+                    retry_ids.extend(ids)
+                elif result[0] == "defer":
+                    deferred.extend((result[1], job_id) for job_id in ids)
+                elif result[0] == "retry":
+                    retry_ids.extend(ids)
+                else:
+                    done_ids.extend(ids)
+            try:
+                await run_db(finish_push_jobs, done_ids, retry_ids, deferred)
+            except Exception as e:
+                logging.exception(f"[outbox] Kunne ikke opdatere jobs: {e}")
+            continue
+        try:
+            await asyncio.wait_for(_push_outbox_wakeup.wait(), timeout=PUSH_OUTBOX_POLL)
+        except asyncio.TimeoutError:
+            pass
+        _push_outbox_wakeup.clear()
+
+def _load_prefs(conn, user_id):
+    return read_prefs(conn, user_id), read_prefs_version(conn, user_id)
+
+def get_prefs_with_version(user_id):
+    prefs, version = cached_lookup("prefs", user_id, lambda conn: _load_prefs(conn, user_id))
+    # Kopi, så kaldere frit kan ændre dicten uden at ændre cachen
+    return copy.deepcopy(prefs), version
+
+def get_prefs(user_id):
+    return get_prefs_with_version(user_id)[0]
+
+# --- QUIET HOURS ---
+# Stille perioder kompileres til en bitmaske med én bit pr. minut i døgnet (dansk tid), som
+# ligger i routing-indekset. Tjekket ved levering er derfor et bitopslag uden DB eller strptime.
+MINUTES_PER_DAY = 24 * 60
+
+def compile_quiet_hours(qh):
+    """Oversæt {"start": "HH:MM", "end": "HH:MM"} til en minut-bitmaske (0 = ingen stille periode)."""
+    try:
+        start_t = datetime.strptime(qh["start"], "%H:%M")
+        end_t = datetime.strptime(qh["end"], "%H:%M")
+    except Exception:
+        return 0
+    start = start_t.hour * 60 + start_t.minute
+    end = end_t.hour * 60 + end_t.minute
+    if start == end:
+        return 0
+    if start < end:
+        return ((1 << (end - start)) - 1) << start
+    return (((1 << (MINUTES_PER_DAY - start)) - 1) << start) | ((1 << end) - 1)
+
+def quiet_until(mask):
+    """Returnér epoch-tidspunktet hvor en aktiv stille periode slutter, eller None hvis den ikke er aktiv."""
+    if not mask:
+        return None
+    now = datetime.now(pytz.UTC).astimezone(pytz.timezone("Europe/Copenhagen"))
+    minute = now.hour * 60 + now.minute
+    if not (mask >> minute) & 1:
+        return None
+    steps = 1
+    while steps < MINUTES_PER_DAY and (mask >> ((minute + steps) % MINUTES_PER_DAY)) & 1:
+        steps += 1
+    return now.timestamp() - now.second - now.microsecond / 1e6 + steps * 60
 
 @app.post("/api/prefs/quiet-hours")
-async def set_quiet_hours(data: dict = Body(...)):
+def set_quiet_hours(data: dict = Body(...)):
     user_id = data.get("user_id")
     device_id = data.get("device_id")
     start = data.get("start")
     end = data.get("end")
+    # defer: saml notifikationer fra den stille periode i et digest, når den slutter
+    defer = bool(data.get("defer"))
     if not user_id or not device_id:
         raise HTTPException(status_code=400, detail="user_id og device_id kræves")
     # Tjek at device_id matcher det i databasen
     correct_device_id = get_device_id_for_user(user_id)
     if correct_device_id and device_id != correct_device_id:
         raise HTTPException(status_code=403, detail="Forkert device_id for bruger")
-    prefs = get_prefs(user_id)
-    if "quiet_hours" not in prefs:
-        prefs["quiet_hours"] = {}
     # Slet hvis tomme værdier
-    if not start or not end:
-        if device_id in prefs["quiet_hours"]:
-            del prefs["quiet_hours"][device_id]
-    else:
-        prefs["quiet_hours"][device_id] = {"start": start, "end": end}
-    set_prefs(user_id, prefs)
-    return {"ok": True}
+    version = mutate_prefs(
+        user_id,
+        lambda conn: set_device_quiet_hours(conn, user_id, device_id, start, end, defer),
+        data.get("version")
+    )
+    return {"ok": True, "version": version}
 
 @app.get("/share/{day}/{thread_id}", response_class=HTMLResponse)
-async def share_thread(day: str, thread_id: str, user_agent: str = Header(None)):
+def share_thread(day: str, thread_id: str, user_agent: str = Header(None)):
     import html
     import pytz
     from datetime import datetime
@@ -452,7 +1888,7 @@ async def share_thread(day: str, thread_id: str, user_agent: str = Header(None))
     return HTMLResponse(content=html_out, status_code=200)
 
 @app.post("/api/log-pageview")
-async def log_pageview(data: dict, request: Request):
+def log_pageview(data: dict, request: Request):
     url = data.get("url")
     user_id = data.get("user_id")
     os_info = data.get("os", "Unknown")
@@ -468,7 +1904,7 @@ async def log_pageview(data: dict, request: Request):
     return {"ok": True}
 
 @app.post("/api/admin/superadmin")
-async def superadmins(data: dict = Body(None)):
+def superadmins(data: dict = Body(None)):
     action = (data or {}).get("action", "get")
     user_id = (data or {}).get("user_id", "")
     device_id = (data or {}).get("device_id", "")
@@ -483,26 +1919,19 @@ async def superadmins(data: dict = Body(None)):
         if requester_obserkode not in superadmins:
             raise HTTPException(status_code=403, detail="Kun hovedadmin")
 
-        # Nu er adgang tjekket, så læs filen
-        with open(SUPERADMIN_PATH, "r", encoding="utf-8") as f:
-            file_data = json.load(f)
-        protected = set(file_data.get("protected", []))
-
         if action == "get":
             return {"superadmins": sorted(superadmins)}
         elif action == "toggle":
             if not obserkode:
                 raise HTTPException(status_code=400, detail="Obserkode mangler")
-            if obserkode in protected:
-                raise HTTPException(status_code=400, detail="Denne superadmin kan ikke fjernes")
-            if obserkode in superadmins:
-                superadmins.remove(obserkode)
-            else:
-                superadmins.add(obserkode)
-            file_data["superadmins"] = sorted(superadmins)
-            with open(SUPERADMIN_PATH, "w", encoding="utf-8") as f:
-                json.dump(file_data, f, ensure_ascii=False, indent=2)
-            return {"ok": True, "superadmins": file_data["superadmins"]}
+            def toggle(file_data):
+                if obserkode in set(file_data.get("protected", [])):
+                    raise HTTPException(status_code=400, detail="Denne superadmin kan ikke fjernes")
+                current = set(file_data.get("superadmins", []))
+                current ^= {obserkode}
+                file_data["superadmins"] = sorted(current)
+                return file_data["superadmins"]
+            return {"ok": True, "superadmins": update_json_file(SUPERADMIN_PATH, {}, toggle)}
         else:
             raise HTTPException(status_code=400, detail="Ugyldig action")
     except Exception as e:
@@ -521,22 +1950,22 @@ async def api_prefs(request: Request):
     if not user_id or not device_id:
         raise HTTPException(status_code=400, detail="user_id og device_id kræves")
     # Tjek at device_id matcher det i databasen
-    correct_device_id = get_device_id_for_user(user_id)
+    correct_device_id = await run_db(get_device_id_for_user, user_id)
     if correct_device_id and device_id != correct_device_id:
         raise HTTPException(status_code=403, detail="Forkert device_id for bruger")
     if new_prefs is not None:
-        # Opdater kun afdelingsnøgler
-        old_prefs = get_prefs(user_id)
-        for afd in new_prefs:
-            old_prefs[afd] = new_prefs[afd]
-        set_prefs(user_id, old_prefs)
-        return {"ok": True}
+        def update_prefs(conn):
+            # Opdater kun de nøgler der er sendt med
+            for afd, value in new_prefs.items():
+                apply_pref(conn, user_id, afd, value)
+        version = await run_db(mutate_prefs, user_id, update_prefs, data.get("version"))
+        return {"ok": True, "version": version}
     # Hvis ingen prefs i body, returner prefs for user
-    prefs = get_prefs(user_id)
-    return JSONResponse(prefs)
+    prefs, version = await run_db(get_prefs_with_version, user_id)
+    return JSONResponse(prefs, headers={"X-Prefs-Version": str(version)})
 
 @app.get("/api/nyheder")
-async def list_nyheder():
+def list_nyheder():
     if os.path.isfile(NYHEDER_PATH):
         with open(NYHEDER_PATH, "r", encoding="utf-8") as f:
             nyheder = json.load(f)
@@ -599,21 +2028,17 @@ async def admin_nyhed(request: Request, data: dict = Body(None), id: str = Query
         _user_id = _data.get("user_id") or user_id
         if not _user_id:
             raise HTTPException(status_code=400, detail="user_id kræves")
-        obserkode = get_obserkode_from_userprefs(_user_id)
-        superadmins = load_superadmins()
-        if obserkode not in superadmins:
+        obserkode = await run_db(get_obserkode_from_userprefs, _user_id)
+        if not await run_io(has_role, _user_id, obserkode, "superadmin"):
             raise HTTPException(status_code=403, detail="Kun superadmin")
 
     # --- GET: Hent én nyhed (kræver ikke superadmin) ---
     if request.method == "GET":
         if not id:
             raise HTTPException(status_code=400, detail="id kræves")
-        if os.path.isfile(NYHEDER_PATH):
-            with open(NYHEDER_PATH, "r", encoding="utf-8") as f:
-                nyheder = json.load(f)
-            for nyhed in nyheder:
-                if nyhed["id"] == id:
-                    return nyhed
+        for nyhed in await read_json_file(NYHEDER_PATH, default=[]):
+            if nyhed["id"] == id:
+                return nyhed
         raise HTTPException(status_code=404, detail="Nyhed ikke fundet")
 
     # --- DELETE: Slet nyhed ---
@@ -627,16 +2052,13 @@ async def admin_nyhed(request: Request, data: dict = Body(None), id: str = Query
         # adgangskontrol allerede tjekket ovenfor
         if not nyhed_id:
             raise HTTPException(status_code=400, detail="id kræves for sletning")
-        if os.path.isfile(NYHEDER_PATH):
-            with open(NYHEDER_PATH, "r", encoding="utf-8") as f:
-                nyheder = json.load(f)
-        else:
+        nyheder = await read_json_file(NYHEDER_PATH)
+        if nyheder is None:
             raise HTTPException(status_code=404, detail="Nyhed ikke fundet")
         nyheder2 = [n for n in nyheder if n.get("id") != nyhed_id]
         if len(nyheder2) == len(nyheder):
             raise HTTPException(status_code=404, detail="Nyhed ikke fundet")
-        with open(NYHEDER_PATH, "w", encoding="utf-8") as f:
-            json.dump(nyheder2, f, ensure_ascii=False, indent=2)
+        await write_json_file(NYHEDER_PATH, nyheder2)
         return {"ok": True, "id": nyhed_id}
 
     # --- POST/PUT kræver adgangskontrol (tjekket ovenfor) ---
@@ -651,10 +2073,8 @@ async def admin_nyhed(request: Request, data: dict = Body(None), id: str = Query
         nyhed_id = data.get("id")
         if not nyhed_id:
             raise HTTPException(status_code=400, detail="id kræves for redigering")
-        if os.path.isfile(NYHEDER_PATH):
-            with open(NYHEDER_PATH, "r", encoding="utf-8") as f:
-                nyheder = json.load(f)
-        else:
+        nyheder = await read_json_file(NYHEDER_PATH)
+        if nyheder is None:
             raise HTTPException(status_code=404, detail="Nyhed ikke fundet")
         found = False
         for i, nyhed in enumerate(nyheder):
@@ -667,8 +2087,7 @@ async def admin_nyhed(request: Request, data: dict = Body(None), id: str = Query
                 break
         if not found:
             raise HTTPException(status_code=404, detail="Nyhed ikke fundet")
-        with open(NYHEDER_PATH, "w", encoding="utf-8") as f:
-            json.dump(nyheder, f, ensure_ascii=False, indent=2)
+        await write_json_file(NYHEDER_PATH, nyheder)
         # Send notifikation hvis ønsket
         if int(data.get("send_notifikation") or 0):
             titel = nyhed.get("titel", "")
@@ -678,18 +2097,15 @@ async def admin_nyhed(request: Request, data: dict = Body(None), id: str = Query
                 "body": strip_markdown(body)[:100] + ("..." if len(strip_markdown(body)) > 100 else ""),
                 "url": f"https://notifikation.dofbasen.dk/nyhed.html?id={nyhed_id}&from_notification=1"
             }
-            with sqlite3.connect(DB_PATH) as conn, ThreadPoolExecutor(max_workers=8) as executor:
-                rows = conn.execute("SELECT user_id, device_id, subscription FROM subscriptions").fetchall()
-                tasks = []
-                for user_id_row, device_id_row, sub_json in rows:
-                    try:
-                        sub = json.loads(sub_json)
-                        tasks.append(executor.submit(send_push, sub, push_payload, user_id_row, device_id_row))
-                        obs_notification_queue.put(1)
-                    except Exception as e:
-                        print(f"Push-fejl til {user_id_row}/{device_id_row}: {e}")
-                for t in tasks:
-                    t.result()
+            rows = await run_db(load_all_subscriptions)
+            tasks = []
+            for user_id_row, device_id_row, sub_json in rows:
+                try:
+                    sub = json.loads(sub_json)
+                    tasks.append(send_push(sub, push_payload, user_id_row, device_id_row))
+                except Exception as e:
+                    print(f"Push-fejl til {user_id_row}/{device_id_row}: {e}")
+            await asyncio.gather(*tasks)
         return {"ok": True, "id": nyhed_id}
 
     # --- POST: Opret nyhed ---
@@ -703,7 +2119,7 @@ async def admin_nyhed(request: Request, data: dict = Body(None), id: str = Query
         datetime.fromisoformat(slet_tidspunkt)
     except Exception:
         raise HTTPException(status_code=400, detail="Ugyldigt slet_tidspunkt (skal være ISO8601)")
-    navn = get_navn_from_userid(user_id)
+    navn = await run_db(get_navn_from_userid, user_id)
     unikt_id_base = slugify(titel)
     now = datetime.now()
     tidstempel = now.strftime("%Y%m%d%H%M%S")
@@ -719,16 +2135,11 @@ async def admin_nyhed(request: Request, data: dict = Body(None), id: str = Query
         "send_notifikation": send_notifikation
     }
     try:
-        if os.path.isfile(NYHEDER_PATH):
-            with open(NYHEDER_PATH, "r", encoding="utf-8") as f:
-                nyheder = json.load(f)
-        else:
-            nyheder = []
+        nyheder = await read_json_file(NYHEDER_PATH, default=[])
     except Exception:
         nyheder = []
     nyheder.append(nyhed)
-    with open(NYHEDER_PATH, "w", encoding="utf-8") as f:
-        json.dump(nyheder, f, ensure_ascii=False, indent=2)
+    await write_json_file(NYHEDER_PATH, nyheder)
 
     # --- Send notifikation hvis ønsket ---
     if send_notifikation:
@@ -737,23 +2148,20 @@ async def admin_nyhed(request: Request, data: dict = Body(None), id: str = Query
             "body": strip_markdown(body)[:100] + ("..." if len(strip_markdown(body)) > 100 else ""),
             "url": f"https://notifikation.dofbasen.dk/nyhed.html?id={unikt_id}&from_notification=1"
         }
-        with sqlite3.connect(DB_PATH) as conn, ThreadPoolExecutor(max_workers=8) as executor:
-            rows = conn.execute("SELECT user_id, device_id, subscription FROM subscriptions").fetchall()
-            tasks = []
-            for user_id_row, device_id_row, sub_json in rows:
-                try:
-                    sub = json.loads(sub_json)
-                    tasks.append(executor.submit(send_push, sub, push_payload, user_id_row, device_id_row))
-                    obs_notification_queue.put(1)
-                except Exception as e:
-                    print(f"Push-fejl til {user_id_row}/{device_id_row}: {e}")
-            for t in tasks:
-                t.result()
+        rows = await run_db(load_all_subscriptions)
+        tasks = []
+        for user_id_row, device_id_row, sub_json in rows:
+            try:
+                sub = json.loads(sub_json)
+                tasks.append(send_push(sub, push_payload, user_id_row, device_id_row))
+            except Exception as e:
+                print(f"Push-fejl til {user_id_row}/{device_id_row}: {e}")
+        await asyncio.gather(*tasks)
 
     return {"ok": True, "id": unikt_id}
 
 @app.post("/api/subscribe")
-async def api_subscribe(request: Request):
+async def api_subscribe(request: Request, response: Response):
     data = await request.json()
     user_id = data.get("user_id") or data.get("userid")
     device_id = data.get("device_id") or data.get("deviceid")
@@ -761,30 +2169,55 @@ async def api_subscribe(request: Request):
     if not user_id or not device_id or not subscription:
         raise HTTPException(status_code=400, detail="user_id, device_id og subscription kræves")
     # Hvis der allerede findes en anden device_id for user_id, kræv at det er samme device_id
-    correct_device_id = get_device_id_for_user(user_id)
+    correct_device_id = await run_db(get_device_id_for_user, user_id)
     if correct_device_id and device_id != correct_device_id:
         raise HTTPException(status_code=403, detail="Forkert device_id for bruger")
-    with sqlite3.connect(DB_PATH) as conn:
-        conn.execute(
-            "INSERT OR REPLACE INTO subscriptions (user_id, device_id, subscription) VALUES (?, ?, ?)",
-            (user_id, device_id, json.dumps(subscription))
-        )
+
+    def save_subscription():
+        with db_connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO subscriptions (user_id, device_id, subscription) VALUES (?, ?, ?)",
+                (user_id, device_id, json.dumps(subscription))
+            )
+            bump_cache_generation(conn)
+    await run_db(save_subscription)
+    await run_db(attach_session, response, user_id, device_id)
     return {"ok": True}
 
+@app.post("/api/session")
+def api_session(response: Response, data: dict = Body(...)):
+    """Udsted et session-token til en eksisterende enhed (fx efter udløb eller første gang efter opdatering)."""
+    user_id = data.get("user_id")
+    device_id = data.get("device_id")
+    if not user_id or not device_id:
+        raise HTTPException(status_code=400, detail="user_id og device_id kræves")
+    # Tjek at device_id matcher det i databasen
+    correct_device_id = get_device_id_for_user(user_id)
+    if correct_device_id and device_id != correct_device_id:
+        raise HTTPException(status_code=403, detail="Forkert device_id for bruger")
+    token = attach_session(response, user_id, device_id)
+    if not token:
+        raise HTTPException(status_code=404, detail="Enheden har ikke et abonnement")
+    return {"ok": True, "session": token}
+
 @app.post("/api/unsubscribe")
 async def api_unsubscribe(request: Request):
     data = await request.json()
     user_id = data.get("user_id")
     device_id = data.get("device_id")
     # Tjek at device_id matcher det i databasen
-    correct_device_id = get_device_id_for_user(user_id)
+    correct_device_id = await run_db(get_device_id_for_user, user_id)
     if correct_device_id and device_id != correct_device_id:
         raise HTTPException(status_code=403, detail="Forkert device_id for bruger")
-    with sqlite3.connect(DB_PATH) as conn:
-        conn.execute(
-            "DELETE FROM subscriptions WHERE user_id=? AND device_id=?",
-            (user_id, device_id)
-        )
+
+    def delete_subscription():
+        with db_connect() as conn:
+            conn.execute(
+                "DELETE FROM subscriptions WHERE user_id=? AND device_id=?",
+                (user_id, device_id)
+            )
+            bump_cache_generation(conn)
+    await run_db(delete_subscription)
     return {"ok": True}
 
 
@@ -815,23 +2248,42 @@ def _parse_dt_from_row(row: dict) -> datetime:
         except Exception:
             return datetime.min
         
-def should_include_obs(obs, species_filters):
+def compile_species_filters(species_filters):
+    """Forbered et artsfilter til opslag: (ekskluderede arter, artsnavn -> minimumsantal)."""
+    species_filters = species_filters or {}
+    exclude = frozenset(str(a).lower() for a in (species_filters.get("exclude") or []))
+    counts = {}
+    for artnavn, min_count in (species_filters.get("counts") or {}).items():
+        if min_count is None:
+            continue
+        try:
+            counts[artnavn] = int(min_count)
+        except Exception:
+            counts[artnavn] = None  # Ugyldigt minimumsantal -> observationen afvises
+    return exclude, counts
+
+def species_filter_allows(compiled_filter, obs):
+    exclude, counts = compiled_filter
     artnavn = (obs.get("Artnavn") or "").strip().lower()
     # Ekskluderede arter har altid højeste prioritet
-    if artnavn in [a.lower() for a in species_filters.get("exclude", [])]:
+    if artnavn in exclude:
         return False
     # Minimumsantal (hvis sat)
-    min_count = species_filters.get("counts", {}).get(artnavn)
-    if min_count is not None:
+    if artnavn in counts:
+        min_count = counts[artnavn]
+        if min_count is None:
+            return False
         try:
-            antal = int(obs.get("Antal") or 0)
-            if antal < int(min_count):
+            if int(obs.get("Antal") or 0) < min_count:
                 return False
         except Exception:
             return False
     # Hvis ikke ekskluderet og evt. antal opfyldt, så inkluder
     return True
 
+def should_include_obs(obs, species_filters):
+    return species_filter_allows(compile_species_filters(species_filters), obs)
+
 def _latest_from_data(data):
     if isinstance(data, list) and data:
         try:
@@ -994,32 +2446,39 @@ async def admin_csv(request: Request):
     if file not in ALLOWED_CSV_FILES:
         raise HTTPException(status_code=403, detail="Ugyldig filsti")
     # Tjek at device_id matcher det i databasen
-    correct_device_id = get_device_id_for_user(user_id)
+    correct_device_id = await run_db(get_device_id_for_user, user_id)
     if correct_device_id and device_id != correct_device_id:
         raise HTTPException(status_code=403, detail="Forkert device_id for bruger")
-    obserkode = get_obserkode_from_userprefs(user_id)
-    superadmins = load_superadmins()
-    if obserkode not in superadmins:
+    obserkode = await run_db(get_obserkode_from_userprefs, user_id)
+    if not await run_io(has_role, user_id, obserkode, "superadmin"):
         raise HTTPException(status_code=403, detail="Kun hovedadmin")
 
     path = os.path.join(os.path.dirname(__file__), "..", file)
     if action == "read":
-        if not os.path.isfile(path):
+        def read_csv():
+            if not os.path.isfile(path):
+                return None
+            with open(path, "r", encoding="utf-8") as f:
+                return f.read()
+        content = await run_io(read_csv)
+        if content is None:
             raise HTTPException(status_code=404, detail="File not found")
-        with open(path, "r", encoding="utf-8") as f:
-            return PlainTextResponse(f.read())
+        return PlainTextResponse(content)
     elif action == "write":
         content = data.get("content", "")
-        # Skriv til begge hvis det er arter_filter_klassificeret.csv
-        if file.endswith("arter_filter_klassificeret.csv"):
-            path1 = os.path.join(os.path.dirname(__file__), "..", "data", "arter_filter_klassificeret.csv")
-            path2 = os.path.join(os.path.dirname(__file__), "..", "web", "data", "arter_filter_klassificeret.csv")
-            for p in {path1, path2}:
-                with open(p, "w", encoding="utf-8") as f:
+
+        def write_csv():
+            # Skriv til begge hvis det er arter_filter_klassificeret.csv
+            if file.endswith("arter_filter_klassificeret.csv"):
+                path1 = os.path.join(os.path.dirname(__file__), "..", "data", "arter_filter_klassificeret.csv")
+                path2 = os.path.join(os.path.dirname(__file__), "..", "web", "data", "arter_filter_klassificeret.csv")
+                for p in {path1, path2}:
+                    with open(p, "w", encoding="utf-8") as f:
+                        f.write(content)
+            else:
+                with open(path, "w", encoding="utf-8") as f:
                     f.write(content)
-        else:
-            with open(path, "w", encoding="utf-8") as f:
-                f.write(content)
+        await run_io(write_csv)
         return {"ok": True}
     else:
         raise HTTPException(status_code=400, detail="Ugyldig action")
@@ -1041,7 +2500,7 @@ def append_line_robust(path, line):
         f.write(line if line.endswith("\n") else line + "\n")
 
 @app.api_route("/api/admin/fetch-faenologi-csv", methods=["GET", "POST"])
-async def fetch_faenologi_csv(request: Request):
+def fetch_faenologi_csv(request: Request):
     import urllib.request
     import re
     import html
@@ -1104,7 +2563,7 @@ async def fetch_faenologi_csv(request: Request):
     return {"ok": True, "rows": len(rows), "changed": changed}
 
 @app.api_route("/api/admin/fetch-all-bemaerk-csv", methods=["GET", "POST"])
-async def fetch_all_bemaerk_csv(request: Request):
+def fetch_all_bemaerk_csv(request: Request):
     import os
     import subprocess
     import urllib.request
@@ -1286,7 +2745,7 @@ async def fetch_all_bemaerk_csv(request: Request):
     return {"ok": True, "results": results}
 
 @app.get("/api/lok_koordinater")
-async def lok_koordinater(loknr: str):
+def lok_koordinater(loknr: str):
     """
     Henter koordinater for en lokalitet fra dofbasen.dk/poplok.php?loknr=...
     Returnerer laengde og bredde (float) eller fejl.
@@ -1322,7 +2781,7 @@ async def lok_koordinater(loknr: str):
     return {"ok": True, "laengde": laengde, "bredde": bredde}
 
 @app.api_route("/api/admin/fetch-arter-csv", methods=["GET", "POST"])
-async def fetch_arter_csv(request: Request):
+def fetch_arter_csv(request: Request):
     urls = [
         "https://dofbasen.dk/opslag/artdata.php?list=art",
         "https://dofbasen.dk/opslag/artdata.php?list=hybrid",
@@ -1463,7 +2922,7 @@ async def fetch_arter_csv(request: Request):
     return {"ok": True, "rows": len(data_rows), "changed": changed}
 
 @app.get("/api/obs/full")
-async def api_obs_full(obsid: str = Query(..., min_length=3, description="DOFbasen observation id")):
+def api_obs_full(obsid: str = Query(..., min_length=3, description="DOFbasen observation id")):
     """
     Returnerer DKU-status, billeder og lydklip for observationen.
     """
@@ -1609,7 +3068,7 @@ def _dedupe_payload_rows(rows: list[dict]) -> list[dict]:
     return list(by_key.values())
 
 @app.post("/api/nearby-observations")
-async def nearby_observations(data: dict = Body(...)):
+def nearby_observations(data: dict = Body(...)):
     user_id = data.get("user_id")
     device_id = data.get("device_id")
     lat = data.get("lat")
@@ -1717,14 +3176,17 @@ async def subscribe_thread(day: str, thread_id: str, request: Request):
     if not user_id or not device_id:
         raise HTTPException(status_code=400, detail="user_id og device_id kræves")
     # Tjek at device_id matcher det i databasen
-    correct_device_id = get_device_id_for_user(user_id)
+    correct_device_id = await run_db(get_device_id_for_user, user_id)
     if correct_device_id and device_id != correct_device_id:
         raise HTTPException(status_code=403, detail="Forkert device_id for bruger")
-    with sqlite3.connect(DB_PATH) as conn:
-        conn.execute(
-            "INSERT OR IGNORE INTO thread_subs (day, thread_id, user_id, device_id) VALUES (?, ?, ?, ?)",
-            (day, thread_id, user_id, device_id)
-        )
+
+    def save_thread_sub():
+        with db_connect() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO thread_subs (day, thread_id, user_id, device_id) VALUES (?, ?, ?, ?)",
+                (thread_day_key(day), thread_id, user_id, device_id)
+            )
+    await run_db(save_thread_sub)
     return {"ok": True}
 
 @app.post("/api/thread/{day}/{thread_id}/unsubscribe")
@@ -1740,18 +3202,21 @@ async def unsubscribe_thread(day: str, thread_id: str, request: Request):
     if not user_id or not device_id:
         raise HTTPException(status_code=400, detail="user_id og device_id kræves")
     # Tjek at device_id matcher det i databasen
-    correct_device_id = get_device_id_for_user(user_id)
+    correct_device_id = await run_db(get_device_id_for_user, user_id)
     if correct_device_id and device_id != correct_device_id:
         raise HTTPException(status_code=403, detail="Forkert device_id for bruger")
-    with sqlite3.connect(DB_PATH) as conn:
-        conn.execute(
-            "DELETE FROM thread_subs WHERE day=? AND thread_id=? AND user_id=? AND device_id=?",
-            (day, thread_id, user_id, device_id)
-        )
-        conn.execute(
-            "INSERT OR IGNORE INTO thread_unsubs (day, thread_id, user_id, device_id) VALUES (?, ?, ?, ?)",
-            (day, thread_id, user_id, device_id)
-        )
+
+    def save_thread_unsub():
+        with db_connect() as conn:
+            conn.execute(
+                "DELETE FROM thread_subs WHERE day=? AND thread_id=? AND user_id=? AND device_id=?",
+                (thread_day_key(day), thread_id, user_id, device_id)
+            )
+            conn.execute(
+                "INSERT OR IGNORE INTO thread_unsubs (day, thread_id, user_id, device_id) VALUES (?, ?, ?, ?)",
+                (thread_day_key(day), thread_id, user_id, device_id)
+            )
+    await run_db(save_thread_unsub)
     return {"ok": True}
 
 @app.post("/api/thread/{day}/{thread_id}/subscription")
@@ -1767,15 +3232,11 @@ async def thread_subscription_status(day: str, thread_id: str, request: Request)
     if not user_id or not device_id:
         return JSONResponse({"subscribed": False})
     # Tjek at device_id matcher det i databasen
-    correct_device_id = get_device_id_for_user(user_id)
+    correct_device_id = await run_db(get_device_id_for_user, user_id)
     if correct_device_id and device_id != correct_device_id:
         raise HTTPException(status_code=403, detail="Forkert device_id for bruger")
-    with sqlite3.connect(DB_PATH) as conn:
-        row = conn.execute(
-            "SELECT 1 FROM thread_subs WHERE day=? AND thread_id=? AND user_id=? AND device_id=?",
-            (day, thread_id, user_id, device_id)
-        ).fetchone()
-    return {"subscribed": bool(row)}
+    subscribed = await run_db(is_thread_subscriber, day, thread_id, user_id, device_id)
+    return {"subscribed": subscribed}
 
 stats_lock = threading.Lock()
 
@@ -1794,34 +3255,44 @@ async def obsid_subscribe(obsid: str, request: Request):
     if not user_id or not device_id or not obsid:
         raise HTTPException(status_code=400, detail="user_id, device_id og obsid kræves")
     # Tjek at device_id matcher det i databasen
-    correct_device_id = get_device_id_for_user(user_id)
+    correct_device_id = await run_db(get_device_id_for_user, user_id)
     if correct_device_id and device_id != correct_device_id:
         raise HTTPException(status_code=403, detail="Forkert device_id for bruger")
-    with sqlite3.connect(DB_PATH) as conn:
-        if subscribe is None:
-            # Returner status: True hvis ingen row eller sub=1, False kun hvis sub=0
-            row = conn.execute(
-                "SELECT sub FROM obsid_subs WHERE user_id=? AND device_id=? AND obsid=?",
-                (user_id, device_id, obsid)
-            ).fetchone()
-            return {"subscribed": not row or row[0] == 1}
-        else:
-            # Sæt abonnement (1=tilmeld, 0=frameld)
-            conn.execute(
-                "INSERT OR REPLACE INTO obsid_subs (user_id, device_id, date, obsid, sub) VALUES (?, ?, ?, ?, ?)",
-                (user_id, device_id, today, obsid, int(subscribe))
-            )
-            conn.commit()
-            return {"ok": True, "subscribed": bool(int(subscribe))}
 
-def is_obsid_unsubscribed(user_id: str, device_id: str, obsid: str) -> bool:
-    with sqlite3.connect(DB_PATH) as conn:
-        row = conn.execute(
-            "SELECT sub FROM obsid_subs WHERE user_id=? AND device_id=? AND obsid=?",
-            (user_id, device_id, obsid)
-        ).fetchone()
-        # Returner True kun hvis sub=0 (frameldt), ellers False (også hvis ingen row)
-        return bool(row and row[0] == 0)
+    def obsid_subscription():
+        with db_connect() as conn:
+            if subscribe is None:
+                # Returner status: True hvis ingen row eller sub=1, False kun hvis sub=0
+                row = conn.execute(
+                    "SELECT sub FROM obsid_subs WHERE user_id=? AND device_id=? AND obsid=?",
+                    (user_id, device_id, obsid)
+                ).fetchone()
+                return {"subscribed": not row or row[0] == 1}
+            else:
+                # Sæt abonnement (1=tilmeld, 0=frameld)
+                conn.execute(
+                    "INSERT OR REPLACE INTO obsid_subs (user_id, device_id, date, obsid, sub) VALUES (?, ?, ?, ?, ?)",
+                    (user_id, device_id, today, obsid, int(subscribe))
+                )
+                conn.commit()
+                return {"ok": True, "subscribed": bool(int(subscribe))}
+    return await run_db(obsid_subscription)
+
+def load_obsid_unsubscriptions(conn, obsids) -> set:
+    """Hent alle frameldinger (sub=0) for de givne obsids i én omgang.
+
+    Returnerer et set af (user_id, device_id, obsid), så push-jobs kan tjekkes i hukommelsen.
+    """
+    obsids = list({str(o) for o in obsids if o})
+    unsubscribed = set()
+    for i in range(0, len(obsids), 500):
+        chunk = obsids[i:i + 500]
+        placeholders = ",".join("?" * len(chunk))
+        unsubscribed.update(conn.execute(
+            f"SELECT user_id, device_id, obsid FROM obsid_subs WHERE sub=0 AND obsid IN ({placeholders})",
+            chunk
+        ).fetchall())
+    return unsubscribed
 
 
 SPECIES_LIST_PATH = os.path.join(os.path.dirname(__file__), "..", "data", "arter_filter_klassificeret.csv")
@@ -1855,187 +3326,257 @@ def _payload_contains_unknown_species(payload: list[dict]) -> bool:
             return True
     return False
 
+# --- ROUTING-INDEKS TIL /api/update ---
+# Abonnenter grupperet pr. (normaliseret afdeling, kategori), så hver payload-række kun
+# rører de enheder, der kan matche. Indekset bygges én gang pr. worker og bygges først
+# igen, når "subscribers"-generationen i cache_generation er ændret (bumpes af mutate_prefs,
+# /api/subscribe, /api/unsubscribe og remove_subscription_and_cleanup). Det holder også
+# enhedernes kompilerede quiet hours, som outbox-leveringen slår op i.
+
+# Kategorier (normaliseret) som hvert præference-valg giver notifikation om, jf. should_notify
+VALG_KATEGORIER = {
+    "SU": ("su",),
+    "SUB": ("su", "sub"),
+    "Bemærk": ("su", "sub", "bemaerk"),
+}
+
+_subscriber_index = {"generation": None, "routes": {}, "quiet": {}}
+_subscriber_index_lock = threading.Lock()
+
+def _build_subscriber_index(conn):
+    routes = defaultdict(list)
+    quiet = {}
+    departments = defaultdict(dict)
+    for user_id, afdeling, level in conn.execute("SELECT user_id, afdeling, level FROM user_departments"):
+        departments[user_id][normalize(afdeling)] = level
+    species_filters = defaultdict(lambda: {"exclude": [], "counts": {}})
+    for user_id, art in conn.execute("SELECT user_id, art FROM species_exclude"):
+        species_filters[user_id]["exclude"].append(art)
+    for user_id, art, min_count in conn.execute("SELECT user_id, art, min_count FROM species_min_count"):
+        species_filters[user_id]["counts"][art] = min_count
+    obserkoder = dict(conn.execute("SELECT user_id, obserkode_key FROM user_identity").fetchall())
+    for user_id, device_id, start, end, defer in conn.execute(
+        "SELECT q.user_id, q.device_id, q.start, q.end, q.defer FROM quiet_hours q "
+        "JOIN subscriptions s ON s.user_id = q.user_id AND s.device_id = q.device_id"
+    ):
+        mask = compile_quiet_hours({"start": start, "end": end})
+        if mask:
+            quiet[(user_id, device_id)] = (mask, bool(defer))
+    compiled_filters = {}
+    rows = conn.execute(
+        "SELECT s.user_id, s.device_id, s.subscription "
+        "FROM subscriptions s JOIN user_prefs p ON p.user_id = s.user_id"
+    ).fetchall()
+    for user_id, device_id, sub_json in rows:
+        user_departments = departments.get(user_id)
+        if not user_departments:
+            continue
+        try:
+            sub = json.loads(sub_json)
+        except Exception:
+            continue
+        if user_id not in compiled_filters:
+            compiled_filters[user_id] = compile_species_filters(species_filters.get(user_id))
+        subscriber = (user_id, device_id, sub, compiled_filters[user_id], obserkoder.get(user_id) or "")
+        for afd_norm, valg in user_departments.items():
+            for kat in VALG_KATEGORIER.get(valg, ()):
+                routes[(afd_norm, kat)].append(subscriber)
+    return {"routes": dict(routes), "quiet": quiet}
+
+def get_subscriber_index(conn):
+    """Returnér routing-indekset; genbygges kun hvis abonnenter/præferencer er ændret."""
+    generation = get_cache_generation(conn)
+    with _subscriber_index_lock:
+        if _subscriber_index["generation"] != generation:
+            _subscriber_index.update(_build_subscriber_index(conn))
+            _subscriber_index["generation"] = generation
+        return _subscriber_index
+
+def get_subscriber_routes(conn):
+    return get_subscriber_index(conn)["routes"]
+
+def load_quiet_schedules():
+    """(user_id, device_id) -> (minut-bitmaske, defer) for enheder med stille periode."""
+    with db_connect() as conn:
+        return get_subscriber_index(conn)["quiet"]
+
+def find_subscribers(routes, afdeling, kategori):
+    """Giv (user_id, device_id, subscription, artsfilter, obserkode) for enheder, der vil have obs'en.
+
+    Samme regler som should_notify: en observation kan have flere afdelinger adskilt af '|',
+    og hver enhed returneres højst én gang.
+    """
+    kat_norm = normalize(kategori)
+    afdelinger = _split_departments(afdeling)
+    if not afdelinger and str(afdeling or "").strip():
+        afdelinger = [str(afdeling).strip()]
+    seen = set()
+    for afd in afdelinger:
+        for subscriber in routes.get((normalize(afd), kat_norm), ()):
+            key = (subscriber[0], subscriber[1])
+            if key in seen:
+                continue
+            seen.add(key)
+            yield subscriber
+
+# --- TRÅD-METADATA OG TRÅD-FØLGERE ---
+# thread.json skrives af watcheren; art/lok caches pr. fil og læses kun igen, når filens
+# mtime/størrelse ændrer sig, så en ny skrivning fra watcheren automatisk invaliderer cachen.
+THREAD_META_CACHE_MAX = 20000
+_thread_meta_cache = {}
+
+def get_thread_meta(day, thread_id):
+    """Returnér {"art", "lok"} for en tråd, eller None hvis tråden ikke findes/kan læses."""
+    thread_path = os.path.join(web_dir, "obs", day, "threads", thread_id, "thread.json")
+    try:
+        st = os.stat(thread_path)
+    except OSError:
+        _thread_meta_cache.pop(thread_path, None)
+        return None
+    stamp = (st.st_mtime_ns, st.st_size)
+    cached = _thread_meta_cache.get(thread_path)
+    if cached and cached[0] == stamp:
+        return cached[1]
+    try:
+        with open(thread_path, "r", encoding="utf-8") as f:
+            thread_info = json.load(f).get("thread", {})
+    except Exception:
+        return None
+    meta = {"art": thread_info.get("art") or "", "lok": thread_info.get("lok") or ""}
+    if len(_thread_meta_cache) >= THREAD_META_CACHE_MAX:
+        _thread_meta_cache.clear()
+    _thread_meta_cache[thread_path] = (stamp, meta)
+    return meta
+
+def load_thread_followers(conn, pairs):
+    """Hent følgere for flere (day, thread_id) på én gang.
+
+    Returnerer (day, thread_id) -> [(user_id, device_id, subscription_json, obserkode)] for enheder,
+    der stadig har en subscription. obserkode er normaliseret til store bogstaver. day er
+    'DD-MM-YYYY' ind og ud; i tabellen ligger den som ISO-dato (thread_day_key).
+    """
+    followers = defaultdict(list)
+    pairs = [(thread_day_key(day), thread_id) for day, thread_id in pairs]
+    for i in range(0, len(pairs), 400):
+        chunk = pairs[i:i + 400]
+        values = ",".join(["(?, ?)"] * len(chunk))
+        rows = conn.execute(
+            f"WITH pairs(day, thread_id) AS (VALUES {values}) "
+            "SELECT t.day, t.thread_id, t.user_id, t.device_id, s.subscription, i.obserkode_key "
+            "FROM pairs "
+            "JOIN thread_subs t ON t.day = pairs.day AND t.thread_id = pairs.thread_id "
+            "JOIN subscriptions s ON s.user_id = t.user_id AND s.device_id = t.device_id "
+            "LEFT JOIN user_identity i ON i.user_id = t.user_id",
+            [value for pair in chunk for value in pair]
+        ).fetchall()
+        for day, thread_id, user_id, device_id, sub_json, obserkode in rows:
+            followers[(thread_day_from_key(day), thread_id)].append((user_id, device_id, sub_json, obserkode or ""))
+    return followers
+
 @app.post("/api/update")
 async def update_data(request: Request):
     from datetime import datetime
 
-    def increment_obs_notification_db():
-        obs_notification_queue.put(1)
-
+    received = time.time()
     payload = await request.json()
     if not isinstance(payload, list):
         raise HTTPException(status_code=400, detail="Payload skal være en liste")
     payload = _dedupe_payload_rows(payload)
-    _save_payload(payload)
-
-    tasks = []
+    await run_io(_save_payload, payload)
 
     api_token = request.headers.get("X-API-Token")
     if api_token != os.environ.get("UPDATE_API_TOKEN"):
         raise HTTPException(status_code=403, detail="Ikke tilladt")
 
-    if _payload_contains_unknown_species(payload):
+    if await run_io(_payload_contains_unknown_species, payload):
         try:
-            await fetch_arter_csv(request)
-            await fetch_faenologi_csv(request)
-            await fetch_all_bemaerk_csv(request)
+            await run_io(fetch_arter_csv, request)
+            await run_io(fetch_faenologi_csv, request)
+            await run_io(fetch_all_bemaerk_csv, request)
             print("[server] Artslister opdateret pga. ukendt art i sync-payload.")
         except Exception as e:
             print(f"[server] Kunne ikke opdatere artslister ved sync: {e}")
 
-    skip_set = set()  # <-- Tilføj denne linje
-
-    def push_task(sub, push_payload, user_id, device_id, obs_id=None):
-        if (user_id, device_id) in skip_set:
-            return
-        # Tjek quiet hours for denne bruger/device
-        prefs = get_prefs(user_id)
-        qh = prefs.get("quiet_hours", {}).get(device_id)
-        if qh:
-            tz = pytz.timezone("Europe/Copenhagen")
-            now = datetime.now(pytz.UTC).astimezone(tz).time()
-            try:
-                start = datetime.strptime(qh["start"], "%H:%M").time()
-                end = datetime.strptime(qh["end"], "%H:%M").time()
-                if start == end:
-                    pass
-                elif start < end:
-                    if start <= now < end:
-                        return
-                else:
-                    if now >= start or now < end:
-                        return
-            except Exception:
-                pass
-
-        # --- TJEK OBSID-UNSUB ---
-        if obs_id:
-            unsub = is_obsid_unsubscribed(user_id, device_id, str(obs_id))
-            if unsub:
-                return
-        
-        try:
-            webpush(
-                subscription_info=sub,
-                data=json.dumps(push_payload),
-                vapid_private_key=VAPID_PRIVATE_KEY,
-                vapid_claims={"sub": "mailto:kontakt@dofnot.dk"},
-                ttl=3600,
-                headers={"Urgency": "high"}
+    def route_payload():
+        # Routing og kø-skrivning kører samlet på DB-tråden
+        jobs = []
+        with db_connect() as conn:
+            routes = get_subscriber_routes(conn)
+            # Alle obsid-frameldinger for batchen i én forespørgsel
+            unsubscribed = load_obsid_unsubscriptions(
+                conn, (obs.get("Obsid") or obs.get("obsid") or obs.get("id") for obs in payload)
             )
-            increment_obs_notification_db()
-        except WebPushException as ex:
-            should_delete = False
-            status = None
-            if hasattr(ex, "response") and ex.response:
-                status = getattr(ex.response, "status_code", None)
-                if status is None:
-                    status = getattr(ex.response, "status", None)
-                print(f"[DEBUG] WebPushException status={status}, body={getattr(ex.response, 'content', '')}")
-            if status == 410:
-                should_delete = True
-            elif "unsubscribed" in str(ex).lower() or "expired" in str(ex).lower():
-                should_delete = True
-            if should_delete:
-                print(f"Sletter abonnement for {user_id}/{device_id} pga. push-fejl: {ex}")
-                remove_subscription_and_cleanup(user_id, device_id)
-                skip_set.add((user_id, device_id))  # <-- Tilføj til skip_set
-                return
-        except Exception as ex:
-            print(f"Uventet push-fejl til {user_id}/{device_id}: {ex}")
-            if "getaddrinfo failed" in str(ex) or "NameResolutionError" in str(ex) or "Failed to resolve" in str(ex):
-                print(f"Sletter abonnement for {user_id}/{device_id} pga. netværksfejl: {ex}")
-                remove_subscription_and_cleanup(user_id, device_id)
-                skip_set.add((user_id, device_id))  # <-- Tilføj til skip_set
-
-    with ThreadPoolExecutor(max_workers=8) as executor, sqlite3.connect(DB_PATH) as conn:
-        for obs in payload:
-            afd = obs.get("DOF_afdeling")
-            kat = obs.get("kategori")
-            statechanged = int(obs.get("statechanged", 0))
-            thread_id = obs.get("tag")  # eller obs.get("thread_id")
-            day = datetime.strptime(obs.get("Dato"), "%Y-%m-%d").strftime("%d-%m-%Y")
-            title = f"{obs.get('Antal','?')} {obs.get('Artnavn','')}, {obs.get('Loknavn','')}"
-            body = f"{obs.get('Adfbeskrivelse','')}, {obs.get('Fornavn','')} {obs.get('Efternavn','')}"
-            push_payload = {
-                "title": title,
-                "body": body,
-                "url": obs.get("url", "https://dofbasen.dk"),
-                "tag": obs.get("tag") or ""
-            }
-            obs_id = obs.get("Obsid") or obs.get("obsid") or obs.get("id") or None
+            thread_rows = []
+            row_stages = []
+            for obs in payload:
+                afd = obs.get("DOF_afdeling")
+                kat = obs.get("kategori")
+                statechanged = int(obs.get("statechanged", 0))
+                thread_id = obs.get("tag")  # eller obs.get("thread_id")
+                day = datetime.strptime(obs.get("Dato"), "%Y-%m-%d").strftime("%d-%m-%Y")
+                title = f"{obs.get('Antal','?')} {obs.get('Artnavn','')}, {obs.get('Loknavn','')}"
+                body = f"{obs.get('Adfbeskrivelse','')}, {obs.get('Fornavn','')} {obs.get('Efternavn','')}"
+                push_payload = {
+                    "title": title,
+                    "body": body,
+                    "url": obs.get("url", "https://dofbasen.dk"),
+                    "tag": obs.get("tag") or ""
+                }
+                obs_id = obs.get("Obsid") or obs.get("obsid") or obs.get("id") or None
+                obs_key = str(obs_id) if obs_id else None
+                stage_ts = obs.get("stage_ts") if isinstance(obs.get("stage_ts"), dict) else {}
+                stage_ts = dict(stage_ts, received=received)
+                row_stages.append(stage_ts)
 
-            if statechanged == 1:
-                rows = conn.execute(
-                    "SELECT user_prefs.user_id, subscriptions.device_id, user_prefs.prefs, subscriptions.subscription "
-                    "FROM user_prefs JOIN subscriptions ON user_prefs.user_id = subscriptions.user_id"
-                ).fetchall()
-                for user_id, device_id, prefs_json, sub_json in rows:
-                    if (user_id, device_id) in skip_set:
-                        continue
-                    prefs = json.loads(prefs_json)
-                    sub = json.loads(sub_json)
-                    species_filters = prefs.get("species_filters") or {"include": [], "exclude": [], "counts": {}}
-                    user_obserkode = prefs.get("obserkode", "").strip().upper()
-                    obs_obserstate = obs.get("obserstate") or []
-                    if isinstance(obs_obserstate, str):
-                        obs_obserstate = [obs_obserstate]
-                    obs_obserstate = [k.strip().upper() for k in obs_obserstate if k]
-                    if user_obserkode and user_obserkode in obs_obserstate:
-                        continue
-                    if should_notify(prefs, afd, kat) and should_include_obs(obs, species_filters):
-                        tasks.append(
-                            executor.submit(push_task, sub, push_payload, user_id, device_id, obs_id)
-                        )
-            else:
-                if not thread_id:
-                    continue
-                thread_path = os.path.join(web_dir, "obs", day, "threads", thread_id, "thread.json")
-                if not os.path.isfile(thread_path):
-                    continue
-                try:
-                    with open(thread_path, "r", encoding="utf-8") as f:
-                        thread_data = json.load(f)
-                    thread_info = thread_data.get("thread", {})
-                    thread_art = (thread_info.get("art") or "").strip().lower()
-                    thread_lok = (thread_info.get("lok") or "").strip().lower()
-                except Exception:
-                    continue
-                obs_art = (obs.get("Artnavn") or "").strip().lower()
-                obs_lok = (obs.get("Loknavn") or "").strip().lower()
-                if obs_art != thread_art or obs_lok != thread_lok:
-                    continue
-                rows = conn.execute(
-                    "SELECT user_id, device_id FROM thread_subs WHERE day=? AND thread_id=?",
-                    (day, thread_id)
-                ).fetchall()
                 obs_obserstate = obs.get("obserstate") or []
                 if isinstance(obs_obserstate, str):
                     obs_obserstate = [obs_obserstate]
                 obs_obserstate = [k.strip().upper() for k in obs_obserstate if k]
-                for user_id, device_id in rows:
-                    if (user_id, device_id) in skip_set:
+
+                if statechanged == 1:
+                    for user_id, device_id, sub, species_filter, user_obserkode in find_subscribers(routes, afd, kat):
+                        if user_obserkode and user_obserkode in obs_obserstate:
+                            continue
+                        if obs_key and (user_id, device_id, obs_key) in unsubscribed:
+                            continue
+                        if species_filter_allows(species_filter, obs):
+                            jobs.append((user_id, device_id, push_payload, obs_id, stage_ts))
+                else:
+                    if not thread_id:
                         continue
-                    prefs = get_prefs(user_id)
-                    user_obserkode = (prefs.get("obserkode") or "").strip().upper()
+                    thread_meta = get_thread_meta(day, thread_id)
+                    if not thread_meta:
+                        continue
+                    obs_art = (obs.get("Artnavn") or "").strip().lower()
+                    obs_lok = (obs.get("Loknavn") or "").strip().lower()
+                    if obs_art != thread_meta["art"].strip().lower() or obs_lok != thread_meta["lok"].strip().lower():
+                        continue
+                    thread_rows.append(((day, thread_id), push_payload, obs_id, obs_key, obs_obserstate, stage_ts))
+
+            # Følgere af alle berørte tråde hentes i én forespørgsel
+            followers = load_thread_followers(conn, {row[0] for row in thread_rows})
+            for pair, push_payload, obs_id, obs_key, obs_obserstate, stage_ts in thread_rows:
+                for user_id, device_id, _sub_json, user_obserkode in followers.get(pair, ()):
                     if obs_obserstate and user_obserkode and user_obserkode in obs_obserstate:
                         continue
-                    sub_row = conn.execute(
-                        "SELECT subscription FROM subscriptions WHERE user_id=? AND device_id=?",
-                        (user_id, device_id)
-                    ).fetchone()
-                    if not sub_row:
+                    if obs_key and (user_id, device_id, obs_key) in unsubscribed:
                         continue
-                    sub = json.loads(sub_row[0])
-                    tasks.append(
-                        executor.submit(push_task, sub, push_payload, user_id, device_id, obs_id)
-                    )
-        for t in tasks:
-            t.result()
-    return {"ok": True}
+                    jobs.append((user_id, device_id, push_payload, obs_id, stage_ts))
+            # Samme routing-tidspunkt for hele batchen; stage_ts-dicts deles af rækkens jobs
+            routed = time.time()
+            for stage_ts in row_stages:
+                stage_ts["routed"] = routed
+                record_row_latency(stage_ts)
+            # Modtager-jobs committes samlet; levering sker i push_outbox_worker
+            enqueue_push_jobs(conn, jobs)
+        return len(jobs)
+
+    queued = await run_db(route_payload)
+    wake_push_outbox()
+    return JSONResponse({"ok": True, "queued": queued}, status_code=202)
 
 @app.post("/api/users-overview")
-async def users_overview(data: dict = Body(...)):
+def users_overview(data: dict = Body(...)):
     user_id = data.get("user_id")
     device_id = data.get("device_id")
     # Tjek at device_id matcher det i databasen
@@ -2044,55 +3585,39 @@ async def users_overview(data: dict = Body(...)):
         raise HTTPException(status_code=403, detail="Forkert device_id for bruger")
     # Tjek superadmin
     obserkode = get_obserkode_from_userprefs(user_id)
-    superadmins = load_superadmins()
-    if obserkode not in superadmins:
+    if not has_role(user_id, obserkode, "superadmin"):
         raise HTTPException(status_code=403, detail="Kun hovedadmin")
     users = []
-    with sqlite3.connect(DB_PATH) as conn:
+    with db_connect() as conn:
         # Find alle user_ids fra både user_prefs og subscriptions
         user_ids = set()
         rows = conn.execute("SELECT user_id FROM user_prefs").fetchall()
         user_ids.update(uid for (uid,) in rows)
         rows = conn.execute("SELECT user_id FROM subscriptions").fetchall()
         user_ids.update(uid for (uid,) in rows)
+        lokalafdelinger = defaultdict(dict)
+        for uid, afd, level in conn.execute("SELECT user_id, afdeling, level FROM user_departments ORDER BY rowid"):
+            lokalafdelinger[uid][afd] = level
+        obserkoder = dict(conn.execute(
+            "SELECT user_id, obserkode FROM user_identity WHERE obserkode IS NOT NULL"
+        ).fetchall())
+        # Avanceret filter: indhold i include, exclude eller counts
+        advanced = {uid for (uid,) in conn.execute(
+            "SELECT user_id FROM species_exclude UNION SELECT user_id FROM species_min_count "
+            "UNION SELECT user_id FROM user_prefs "
+            "WHERE json_valid(prefs) AND json_array_length(prefs, '$.species_filters.include') > 0"
+        )}
         for uid in sorted(user_ids):
-            # Hent prefs hvis de findes
-            cur = conn.execute("SELECT prefs FROM user_prefs WHERE user_id=?", (uid,))
-            row = cur.fetchone()
-            if row and row[0]:
-                try:
-                    prefs = json.loads(row[0])
-                except Exception:
-                    prefs = {}
-            else:
-                prefs = {}
-            lokalafdelinger = {afd: val for afd, val in prefs.items() if val in ("Ingen", "SU", "SUB", "Bemærk")}
-            obserkode = prefs.get("obserkode", "")
-            species_filters = prefs.get("species_filters", {})
-            # Tjek om der er indhold i include, exclude eller counts
-            sf_active = 0
-            if (
-                isinstance(species_filters, dict)
-                and (
-                    species_filters.get("include")
-                    or species_filters.get("exclude")
-                    or (species_filters.get("counts") and len(species_filters.get("counts")) > 0)
-                )
-            ):
-                sf_active = 1
-
-            subs = conn.execute("SELECT subscription FROM subscriptions WHERE user_id=?", (uid,)).fetchall()
-            subscriptions = [json.loads(s[0]) for s in subs if s and s[0]]
             users.append({
                 "user_id": uid,
-                "lokalafdelinger": lokalafdelinger,
-                "obserkode": obserkode,
-                "advanced": sf_active
+                "lokalafdelinger": lokalafdelinger.get(uid, {}),
+                "obserkode": obserkoder.get(uid, ""),
+                "advanced": 1 if uid in advanced else 0
             })
     return users
 
 @app.post("/api/admin/blacklist")
-async def admin_blacklist(data: dict = Body(...)):
+def admin_blacklist(data: dict = Body(...)):
     obsid = data.get("obsid")
     user_id = data.get("user_id")
     device_id = data.get("device_id")
@@ -2106,29 +3631,16 @@ async def admin_blacklist(data: dict = Body(...)):
     if correct_device_id and device_id != correct_device_id:
         return JSONResponse({"ok": False, "error": "Forkert device_id for bruger"}, status_code=403)
 
-    prefs = get_prefs(user_id)
-    admins = load_admins()
-    admin_obserkode = prefs.get("obserkode", "")
-    if admin_obserkode not in admins:
+    admin_obserkode = get_obserkode_from_userprefs(user_id)
+    if not has_role(user_id, admin_obserkode, "admin"):
         return JSONResponse({"ok": False, "error": "Not admin"}, status_code=403)
 
     if not obsid:
-        try:
-            with open(BLACKLIST_PATH, "r", encoding="utf-8") as f:
-                bl = json.load(f)
-            return bl
-        except Exception as e:
-            print("Blacklist read error:", e)
-            return []
+        return read_cached_json(BLACKLIST_PATH, [])
     if not reason:
         return {"ok": False, "error": "Årsag til blacklistning mangler"}
-    try:
-        try:
-            with open(BLACKLIST_PATH, "r", encoding="utf-8") as f:
-                bl = json.load(f)
-        except Exception:
-            bl = []
-        bl = [entry for entry in bl if entry.get("obserkode") != obsid]
+    def add(bl):
+        bl[:] = [entry for entry in bl if entry.get("obserkode") != obsid]
         bl.append({
             "obserkode": obsid,
             "navn": navn,
@@ -2137,15 +3649,15 @@ async def admin_blacklist(data: dict = Body(...)):
             "time": now,
             "admin_obserkode": admin_obserkode
         })
-        with open(BLACKLIST_PATH, "w", encoding="utf-8") as f:
-            json.dump(bl, f, ensure_ascii=False, indent=2)
+    try:
+        update_json_file(BLACKLIST_PATH, [], add)
         return {"ok": True}
     except Exception as e:
         print("Blacklist error:", e)
         return {"ok": False, "error": "Server error"}
 
 @app.post("/api/admin/unblacklist")
-async def admin_unblacklist(data: dict = Body(...)):
+def admin_unblacklist(data: dict = Body(...)):
     obsid = data.get("obsid")
     user_id = data.get("user_id")
     device_id = data.get("device_id")
@@ -2156,24 +3668,20 @@ async def admin_unblacklist(data: dict = Body(...)):
     if correct_device_id and device_id != correct_device_id:
         return {"ok": False, "error": "Forkert device_id for bruger"}
     # Tjek admin-status
-    prefs = get_prefs(user_id)
-    admins = load_admins()
-    if prefs.get("obserkode") not in admins:
+    if not has_role(user_id, get_obserkode_from_userprefs(user_id), "admin"):
         return {"ok": False, "error": "Not admin"}
-    try:
-        with open(BLACKLIST_PATH, "r", encoding="utf-8") as f:
-            bl = json.load(f)
+    def remove(bl):
         # Fjern entry med denne obserkode
-        bl = [entry for entry in bl if entry.get("obserkode") != obsid]
-        with open(BLACKLIST_PATH, "w", encoding="utf-8") as f:
-            json.dump(bl, f, ensure_ascii=False, indent=2)
+        bl[:] = [entry for entry in bl if entry.get("obserkode") != obsid]
+    try:
+        update_json_file(BLACKLIST_PATH, [], remove)
         return {"ok": True}
     except Exception as e:
         print("Unblacklist error:", e)
         return {"ok": False, "error": "Server error"}
     
 @app.post("/api/admin/remove-comment")
-async def admin_remove_comment(data: dict = Body(...)):
+def admin_remove_comment(data: dict = Body(...)):
     admin_user_id = data.get("admin_user_id")
     device_id = data.get("device_id")
     comment_navn = data.get("navn")
@@ -2190,9 +3698,7 @@ async def admin_remove_comment(data: dict = Body(...)):
     if correct_device_id and device_id != correct_device_id:
         return {"ok": False, "error": "Forkert device_id for bruger"}
 
-    prefs = get_prefs(admin_user_id)
-    admins = load_admins()
-    if prefs.get("obserkode") not in admins:
+    if not has_role(admin_user_id, get_obserkode_from_userprefs(admin_user_id), "admin"):
         return {"ok": False, "error": "Not admin"}
 
     kommentar_path = os.path.join(web_dir, "obs", day, "threads", thread_id, "kommentar.json")
@@ -2229,7 +3735,7 @@ async def admin_remove_comment(data: dict = Body(...)):
         return {"ok": False, "error": "Server error"}
 
 @app.get("/api/threads/{day}")
-async def api_threads_index(day: str):
+def api_threads_index(day: str):
     """
     Returner index.json for en given dag, inkl. comment_count for hver tråd.
     Understøtter både array og objekt med "threads".
@@ -2279,7 +3785,7 @@ async def api_threads_index(day: str):
     return JSONResponse(out)
 
 @app.get("/share/obsid/{obsid}/", response_class=HTMLResponse)
-async def share_obsid(obsid: str, user_agent: str = Header(None)):
+def share_obsid(obsid: str, user_agent: str = Header(None)):
     import html
     from fastapi.testclient import TestClient
 
@@ -2353,7 +3859,7 @@ async def share_obsid(obsid: str, user_agent: str = Header(None)):
     return HTMLResponse(content=html_out, status_code=200)
     
 @app.get("/api/dofbasen")
-async def dofbasen_tur(obsid: str = Query(...)):
+def dofbasen_tur(obsid: str = Query(...)):
     import urllib.request
     import html
     import re
@@ -2505,7 +4011,7 @@ async def dofbasen_tur(obsid: str = Query(...)):
 login_attempts = defaultdict(list)
 
 @app.post("/api/copy-species-filter-to-obserkode-users")
-async def copy_species_filter_to_obserkode_users(data: dict = Body(...)):
+def copy_species_filter_to_obserkode_users(data: dict = Body(...)):
     user_id = data.get("user_id")
     device_id = data.get("device_id")
     if not user_id or not device_id:
@@ -2524,22 +4030,21 @@ async def copy_species_filter_to_obserkode_users(data: dict = Body(...)):
     if not species_filters:
         return {"ok": False, "error": "Ingen avanceret filter fundet for bruger"}
     updated_users = []
-    with sqlite3.connect(DB_PATH) as conn:
-        rows = conn.execute("SELECT user_id, prefs FROM user_prefs").fetchall()
-        for uid, prefs_json in rows:
-            try:
-                uprefs = json.loads(prefs_json)
-                kode = (uprefs.get("obserkode") or "").strip().upper()
-                if kode == obserkode and uid != user_id:
-                    uprefs["species_filters"] = species_filters
-                    set_prefs(uid, uprefs)
-                    updated_users.append(uid)
-            except Exception:
-                continue
+    with db_connect() as conn:
+        rows = conn.execute(
+            "SELECT user_id FROM user_identity WHERE obserkode_key=? AND user_id<>?",
+            (obserkode, user_id)
+        ).fetchall()
+        for (uid,) in rows:
+            apply_pref(conn, uid, "species_filters", species_filters)
+            bump_prefs_version(conn, uid)
+            updated_users.append(uid)
+        if updated_users:
+            bump_cache_generation(conn)
     return {"ok": True, "updated_users": updated_users}
 
 @app.post("/api/validate-login")
-async def validate_login(data: dict = Body(...)):
+def validate_login(response: Response, data: dict = Body(...)):
     import requests
 
     user_id = data.get("user_id")
@@ -2592,15 +4097,16 @@ async def validate_login(data: dict = Body(...)):
         navn = ""
 
     # Gem obserkode og navn i prefs (adgangskode gemmes IKKE)
-    prefs = get_prefs(user_id)
-    prefs["obserkode"] = obserkode
-    prefs["navn"] = navn
-    set_prefs(user_id, prefs)
+    def save_login(conn):
+        apply_pref(conn, user_id, "obserkode", obserkode)
+        apply_pref(conn, user_id, "navn", navn)
+    version = mutate_prefs(user_id, save_login)
+    attach_session(response, user_id, device_id)
 
-    return { "ok": True, "token": token, "navn": navn }
+    return { "ok": True, "token": token, "navn": navn, "version": version }
 
 @app.post("/api/remove-connection")
-async def remove_connection(data: dict = Body(...)):
+def remove_connection(response: Response, data: dict = Body(...)):
     user_id = data.get("user_id")
     device_id = data.get("device_id")
     # Tjek at device_id matcher det i databasen
@@ -2609,30 +4115,21 @@ async def remove_connection(data: dict = Body(...)):
         raise HTTPException(status_code=403, detail="Forkert device_id for bruger")
     if not user_id:
         return {"ok": False, "error": "user_id mangler"}
-    prefs = get_prefs(user_id)
-    prefs.pop("obserkode", None)
-    prefs.pop("navn", None)
-    set_prefs(user_id, prefs)
-    return {"ok": True}
-
-def load_admins():
-    try:
-        with open(ADMIN_PATH, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            return set(data.get("admins", []))
-    except Exception:
-        return set()
+    def remove_identity(conn):
+        apply_pref(conn, user_id, "obserkode")
+        apply_pref(conn, user_id, "navn")
+    version = mutate_prefs(user_id, remove_identity, data.get("version"))
+    # Nyt token uden obserkode og roller
+    attach_session(response, user_id, device_id)
+    return {"ok": True, "version": version}
 
 def get_obserkode_from_userprefs(user_id):
-    with sqlite3.connect(DB_PATH) as conn:
-        cur = conn.execute("SELECT prefs FROM user_prefs WHERE user_id=?", (user_id,))
-        row = cur.fetchone()
-        if row:
-            try:
-                prefs = json.loads(row[0])
-                return prefs.get("obserkode", "")
-            except Exception:
-                return ""
+    session = session_for(user_id)
+    if session is not None:
+        return session["obk"]
+    row = cached_lookup("identity", user_id, lambda conn: _load_identity(conn, user_id))
+    if row and row[0] is not None:
+        return row[0]
     return ""
 
 @app.post("/api/request_sync")
@@ -2641,23 +4138,21 @@ async def api_request_sync(request: Request):
     user_id = data.get("user_id")
     device_id = data.get("device_id")
     # Tjek at device_id matcher det i databasen
-    correct_device_id = get_device_id_for_user(user_id)
+    correct_device_id = await run_db(get_device_id_for_user, user_id)
     if correct_device_id and device_id != correct_device_id:
         raise HTTPException(status_code=403, detail="Forkert device_id for bruger")
     if not user_id:
         raise HTTPException(status_code=400, detail="user_id mangler")
-    obserkode = get_obserkode_from_userprefs(user_id)
-    superadmins = load_superadmins()
-    if obserkode not in superadmins:
+    obserkode = await run_db(get_obserkode_from_userprefs, user_id)
+    if not await run_io(has_role, user_id, obserkode, "superadmin"):
         raise HTTPException(status_code=403, detail="Kun hovedadmin")
 
     # Skriv sync-request (overskriver evt. eksisterende)
-    with open(SYNC_PATH, "w", encoding="utf-8") as f:
-        json.dump(data, f)
+    await write_json_file(SYNC_PATH, data, indent=None)
     return {"status": "ok", "written": data}
 
 @app.get("/api/admin/traffic-diffs")
-async def traffic_diffs_public():
+def traffic_diffs_public():
     import datetime
     import pytz
     import os
@@ -2726,24 +4221,15 @@ async def traffic_diffs_public():
     comments_today, su_threads_today, sub_threads_today = count_comments_and_threads_for_day(today_date)
     comments_yesterday, su_threads_yesterday, sub_threads_yesterday = count_comments_and_threads_for_day(today_date - datetime.timedelta(days=1))
 
-    # --- Hent obs_notification fra stats_notifications (database) ---
-    obs_notif_today = 0
-    obs_notif_yesterday = 0
+    # --- Hent tællere (obs_notification, push-fejl, kommentarer) fra stats_counters ---
     today_str = today
     yesterday_str = (today_date - datetime.timedelta(days=1)).strftime("%Y-%m-%d")
-    with sqlite3.connect(DB_PATH) as conn:
-        row = conn.execute(
-            "SELECT obs_notification FROM stats_notifications WHERE date=?",
-            (today_str,)
-        ).fetchone()
-        if row:
-            obs_notif_today = row[0]
-        row = conn.execute(
-            "SELECT obs_notification FROM stats_notifications WHERE date=?",
-            (yesterday_str,)
-        ).fetchone()
-        if row:
-            obs_notif_yesterday = row[0]
+    flush_counters()
+    with db_connect() as conn:
+        counters_today = load_counters(conn, today_str)
+        counters_yesterday = load_counters(conn, yesterday_str)
+    obs_notif_today = counters_today.get("obs_notification", 0)
+    obs_notif_yesterday = counters_yesterday.get("obs_notification", 0)
 
     # --- Diffs/statistik ---
     # (kopieret fra din eksisterende kode)
@@ -2773,28 +4259,12 @@ async def traffic_diffs_public():
             "unique_obserkoder": len(unique_obserkoder)
         }
         # Tæl brugere i databasen
-        with sqlite3.connect(DB_PATH) as conn:
-            rows = conn.execute("SELECT prefs FROM user_prefs").fetchall()
-            total_users = 0
-            users_with_obserkode = 0
-            users_without_obserkode = 0
-            all_db_obserkoder = set()
-            for (prefs_json,) in rows:
-                try:
-                    prefs = json.loads(prefs_json)
-                    total_users += 1
-                    obserkode = prefs.get("obserkode")
-                    if obserkode:
-                        users_with_obserkode += 1
-                        all_db_obserkoder.add(obserkode)
-                    else:
-                        users_without_obserkode += 1
-                except Exception:
-                    continue
+        with db_connect() as conn:
+            total_users, users_with_obserkode, users_without_obserkode, unique_db_obserkoder = count_db_users(conn)
         stats_out["users_total"] = total_users
         stats_out["users_with_obserkode"] = users_with_obserkode
         stats_out["users_without_obserkode"] = users_without_obserkode
-        stats_out["unique_obserkoder_total_db"] = len(all_db_obserkoder)
+        stats_out["unique_obserkoder_total_db"] = unique_db_obserkoder
         days_dict[today_date] = stats_out
 
     # Sortér efter dato
@@ -2867,11 +4337,13 @@ async def traffic_diffs_public():
         "su_threads_yesterday": su_threads_yesterday,
         "sub_threads_yesterday": sub_threads_yesterday,
         "obs_notification_today": obs_notif_today,
-        "obs_notification_yesterday": obs_notif_yesterday
+        "obs_notification_yesterday": obs_notif_yesterday,
+        "counters_today": counters_today,
+        "counters_yesterday": counters_yesterday
     }
 
 @app.post("/api/admin/pageviews-rolling")
-async def pageviews_rolling(data: dict = Body(...)):
+def pageviews_rolling(data: dict = Body(...)):
     import pytz
     import datetime
 
@@ -2883,8 +4355,7 @@ async def pageviews_rolling(data: dict = Body(...)):
         raise HTTPException(status_code=403, detail="Forkert device_id for bruger")
 
     obserkode = get_obserkode_from_userprefs(user_id)
-    superadmins = load_superadmins()
-    if obserkode not in superadmins:
+    if not has_role(user_id, obserkode, "superadmin"):
         raise HTTPException(status_code=403, detail="Kun hovedadmin")
 
     log_path = os.path.join(os.path.dirname(__file__), "pageviews.log")
@@ -2950,8 +4421,83 @@ async def pageviews_rolling(data: dict = Body(...)):
         "rolling_2h": rolling_2h
     }
 
+@app.post("/api/admin/latency-stats")
+def admin_latency_stats(data: dict = Body(None)):
+    """Percentiler (ms) pr. stadie fra watcherens hentning til push-tjenestens svar."""
+    data = data or {}
+    user_id = data.get("user_id", "")
+    device_id = data.get("device_id", "")
+    # Tjek at device_id matcher det i databasen
+    correct_device_id = get_device_id_for_user(user_id)
+    if correct_device_id and device_id != correct_device_id:
+        raise HTTPException(status_code=403, detail="Forkert device_id for bruger")
+    # Kun superadmins må tilgå dette endpoint
+    obserkode = get_obserkode_from_userprefs(user_id)
+    if not has_role(user_id, obserkode, "superadmin"):
+        raise HTTPException(status_code=403, detail="Kun hovedadmin")
+    try:
+        days = max(1, int(data.get("days") or 1))
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="Ugyldigt antal dage")
+
+    flush_latency_histograms()
+    since = (datetime.now(pytz.timezone("Europe/Copenhagen")) - timedelta(days=days - 1)).strftime("%Y-%m-%d")
+    with db_connect() as conn:
+        rows = conn.execute(
+            "SELECT stage, bucket, SUM(count) FROM latency_hist WHERE date >= ? GROUP BY stage, bucket",
+            (since,)
+        ).fetchall()
+    hist = defaultdict(dict)
+    for stage, bucket, count in rows:
+        hist[stage][bucket] = count
+
+    def percentile(buckets, total, p):
+        # Øvre grænse for den bucket, hvor p-fraktilen ligger (-1 = over sidste grænse)
+        target = total * p
+        seen = 0
+        for bound in list(LATENCY_BUCKETS_MS) + [-1]:
+            seen += buckets.get(bound, 0)
+            if seen >= target:
+                return bound
+        return -1
+
+    stages = []
+    order = list(dict.fromkeys(LATENCY_ROW_STAGES[1:] + LATENCY_PUSH_STAGES[1:] + ("total",)))
+    for stage in order:
+        buckets = hist.get(stage)
+        if not buckets:
+            continue
+        total = sum(buckets.values())
+        stages.append({
+            "stage": stage,
+            "count": total,
+            "p50_ms": percentile(buckets, total, 0.50),
+            "p90_ms": percentile(buckets, total, 0.90),
+            "p99_ms": percentile(buckets, total, 0.99),
+            "histogram": {str(bound): buckets.get(bound, 0) for bound in list(LATENCY_BUCKETS_MS) + [-1]},
+        })
+    return {"since": since, "buckets_ms": list(LATENCY_BUCKETS_MS), "stages": stages}
+
+@app.post("/api/admin/cache-stats")
+def admin_cache_stats(data: dict = Body(None)):
+    """Hit/miss for opslags-cachen og routing-indekset i den worker, der svarer."""
+    data = data or {}
+    user_id = data.get("user_id", "")
+    device_id = data.get("device_id", "")
+    # Tjek at device_id matcher det i databasen
+    correct_device_id = get_device_id_for_user(user_id)
+    if correct_device_id and device_id != correct_device_id:
+        raise HTTPException(status_code=403, detail="Forkert device_id for bruger")
+    # Kun superadmins må tilgå dette endpoint
+    obserkode = get_obserkode_from_userprefs(user_id)
+    if not has_role(user_id, obserkode, "superadmin"):
+        raise HTTPException(status_code=403, detail="Kun hovedadmin")
+    stats = lookup_cache_stats()
+    stats["subscriber_index_generation"] = _subscriber_index["generation"]
+    return stats
+
 @app.post("/api/admin/traffic-graphs")
-async def admin_traffic_graphs(data: dict = Body(None)):
+def admin_traffic_graphs(data: dict = Body(None)):
     data = data or {}
     user_id = data.get("user_id", "")
     device_id = data.get("device_id", "")
@@ -2961,8 +4507,7 @@ async def admin_traffic_graphs(data: dict = Body(None)):
         raise HTTPException(status_code=403, detail="Forkert device_id for bruger")
     # Kun superadmins må tilgå dette endpoint
     obserkode = get_obserkode_from_userprefs(user_id)
-    superadmins = load_superadmins()
-    if obserkode not in superadmins:
+    if not has_role(user_id, obserkode, "superadmin"):
         raise HTTPException(status_code=403, detail="Kun hovedadmin")
     masterlog_path = os.path.join(os.path.dirname(__file__), "pageview_masterlog.jsonl")
     log_path = os.path.join(os.path.dirname(__file__), "pageviews.log")
@@ -3053,28 +4598,12 @@ async def admin_traffic_graphs(data: dict = Body(None)):
             }
         }
         # Tæl brugere i databasen
-        with sqlite3.connect(DB_PATH) as conn:
-            rows = conn.execute("SELECT prefs FROM user_prefs").fetchall()
-            total_users = 0
-            users_with_obserkode = 0
-            users_without_obserkode = 0
-            all_db_obserkoder = set()
-            for (prefs_json,) in rows:
-                try:
-                    prefs = json.loads(prefs_json)
-                    total_users += 1
-                    obserkode = prefs.get("obserkode")
-                    if obserkode:
-                        users_with_obserkode += 1
-                        all_db_obserkoder.add(obserkode)
-                    else:
-                        users_without_obserkode += 1
-                except Exception:
-                    continue
+        with db_connect() as conn:
+            total_users, users_with_obserkode, users_without_obserkode, unique_db_obserkoder = count_db_users(conn)
         stats_out["users_total"] = total_users
         stats_out["users_with_obserkode"] = users_with_obserkode
         stats_out["users_without_obserkode"] = users_without_obserkode
-        stats_out["unique_obserkoder_total_db"] = len(all_db_obserkoder)
+        stats_out["unique_obserkoder_total_db"] = unique_db_obserkoder
         # Opdater days_dict for i dag
         days_dict[today_date] = stats_out
 
@@ -3262,29 +4791,28 @@ async def admin_traffic_graphs(data: dict = Body(None)):
     }
 
 @app.post("/api/is-app-user-bulk")
-async def api_is_app_user_bulk(data: dict = Body(...)):
+def api_is_app_user_bulk(data: dict = Body(...)):
     obserkoder = [str(k).strip().upper() for k in data.get("obserkoder", []) if k]
     result = {k: False for k in obserkoder}
     if not obserkoder:
         return result
-    with sqlite3.connect(DB_PATH) as conn:
-        rows = conn.execute("SELECT prefs FROM user_prefs").fetchall()
     known = set()
-    for (prefs_json,) in rows:
-        try:
-            prefs = json.loads(prefs_json)
-            kode = (prefs.get("obserkode") or "").strip().upper()
-            if kode:
-                known.add(kode)
-        except Exception:
-            continue
+    unique = sorted(set(obserkoder))
+    with db_connect() as conn:
+        for i in range(0, len(unique), 500):
+            chunk = unique[i:i + 500]
+            rows = conn.execute(
+                f"SELECT DISTINCT obserkode_key FROM user_identity WHERE obserkode_key IN ({','.join('?' * len(chunk))})",
+                chunk
+            ).fetchall()
+            known.update(kode for (kode,) in rows)
     for k in obserkoder:
         if k in known:
             result[k] = True
     return result
 
 @app.post("/api/admin/all-users")
-async def admin_all_users(data: dict = Body(None)):
+def admin_all_users(data: dict = Body(None)):
     user_id = data.get("user_id", "")
     device_id = data.get("device_id", "")
     # Tjek at device_id matcher det i databasen
@@ -3292,31 +4820,26 @@ async def admin_all_users(data: dict = Body(None)):
     if correct_device_id and device_id != correct_device_id:
         raise HTTPException(status_code=403, detail="Forkert device_id for bruger")
     obserkode = get_obserkode_from_userprefs(user_id)
-    superadmins = load_superadmins()
-    if obserkode not in superadmins:
+    if not has_role(user_id, obserkode, "superadmin"):
         raise HTTPException(status_code=403, detail="Kun hovedadmin")
     users = {}
-    with sqlite3.connect(DB_PATH) as conn:
-        rows = conn.execute("SELECT user_id, prefs FROM user_prefs").fetchall()
-        for uid, prefs_json in rows:
-            try:
-                prefs = json.loads(prefs_json)
-                navn = prefs.get("navn", "")
-                kode = prefs.get("obserkode", "")
-                kode_norm = (kode or "").strip().upper()
-                if kode_norm:
-                    if kode_norm not in users:
-                        users[kode_norm] = {"navn": navn, "obserkode": kode, "antal_oprettede": 1}
-                    else:
-                        users[kode_norm]["antal_oprettede"] += 1
-            except Exception:
-                continue
+    with db_connect() as conn:
+        rows = conn.execute(
+            "SELECT i.obserkode_key, COALESCE(i.navn, ''), i.obserkode FROM user_identity i "
+            "JOIN user_prefs p ON p.user_id = i.user_id "
+            "WHERE i.obserkode_key <> '' ORDER BY p.rowid"
+        ).fetchall()
+        for kode_norm, navn, kode in rows:
+            if kode_norm not in users:
+                users[kode_norm] = {"navn": navn, "obserkode": kode, "antal_oprettede": 1}
+            else:
+                users[kode_norm]["antal_oprettede"] += 1
     user_list = list(users.values())
     user_list.sort(key=lambda u: (u["navn"] or u["obserkode"] or "").upper())
     return user_list
 
 @app.post("/api/admin/delete-user")
-async def admin_delete_user(data: dict = Body(...)):
+def admin_delete_user(data: dict = Body(...)):
     user_id = data.get("user_id", "")
     device_id = data.get("device_id", "")
     # Tjek at device_id matcher det i databasen
@@ -3329,24 +4852,16 @@ async def admin_delete_user(data: dict = Body(...)):
 
     # Tjek om requester er superadmin
     requester_obserkode = get_obserkode_from_userprefs(requester_id)
-    superadmins = load_superadmins()
-    if requester_obserkode not in superadmins:
+    if not has_role(requester_id, requester_obserkode, "superadmin"):
         raise HTTPException(status_code=403, detail="Kun hovedadmin kan slette brugere")
 
     deleted = 0
-    with sqlite3.connect(DB_PATH) as conn:
+    with db_connect() as conn:
         user_ids = []
         # Hvis obserkode angivet: find alle user_ids med denne obserkode
         if obserkode:
-            rows = conn.execute("SELECT user_id, prefs FROM user_prefs").fetchall()
-            for uid, prefs_json in rows:
-                try:
-                    prefs = json.loads(prefs_json)
-                    kode = (prefs.get("obserkode") or "").strip().upper()
-                    if kode == obserkode:
-                        user_ids.append(uid)
-                except Exception:
-                    continue
+            rows = conn.execute("SELECT user_id FROM user_identity WHERE obserkode_key=?", (obserkode,)).fetchall()
+            user_ids.extend(uid for (uid,) in rows)
         # Hvis user_id angivet og ikke allerede fundet
         elif target_user_id:
             user_ids.append(target_user_id)
@@ -3360,31 +4875,23 @@ async def admin_delete_user(data: dict = Body(...)):
             conn.execute("DELETE FROM thread_subs WHERE user_id=?", (uid,))
             conn.execute("DELETE FROM thread_unsubs WHERE user_id=?", (uid,))
             deleted += 1
+        bump_cache_generation(conn)
         conn.commit()
     return {"ok": True, "deleted_users": deleted}
 
 @app.post("/api/is-admin")
-async def is_admin(data: dict = Body(...)):
+def is_admin(data: dict = Body(...)):
     user_id = data.get("user_id")
     device_id = data.get("device_id")
     # Tjek at device_id matcher det i databasen
     correct_device_id = get_device_id_for_user(user_id)
     if correct_device_id and device_id != correct_device_id:
         raise HTTPException(status_code=403, detail="Forkert device_id for bruger")
-    admins = load_admins()
     obserkode = get_obserkode_from_userprefs(user_id)
-    return {"admin": obserkode in admins, "obserkode": obserkode}
-
-def load_superadmins():
-    try:
-        with open(SUPERADMIN_PATH, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            return set(data.get("superadmins", []))
-    except Exception:
-        return set()
+    return {"admin": has_role(user_id, obserkode, "admin"), "obserkode": obserkode}
 
 @app.post("/api/is-subscribed")
-async def is_subscribed(data: dict = Body(...)):
+def is_subscribed(data: dict = Body(...)):
     user_id = data.get("user_id")
     device_id = data.get("device_id")
     # Tjek at device_id matcher det i databasen
@@ -3393,7 +4900,7 @@ async def is_subscribed(data: dict = Body(...)):
         raise HTTPException(status_code=403, detail="Forkert device_id for bruger")
     # Tjek om user_id findes i subscriptions (tilpas evt. logik)
     import sqlite3
-    with sqlite3.connect(DB_PATH) as conn:
+    with db_connect() as conn:
         row = conn.execute(
             "SELECT 1 FROM subscriptions WHERE user_id=? OR device_id=? LIMIT 1",
             (user_id, device_id)
@@ -3402,7 +4909,7 @@ async def is_subscribed(data: dict = Body(...)):
     return {"isSubscribed": is_subscribed}
 
 @app.post("/api/is-superadmin")
-async def is_superadmin(data: dict = Body(...)):
+def is_superadmin(data: dict = Body(...)):
     user_id = data.get("user_id")
     device_id = data.get("device_id")
     # Tjek at device_id matcher det i databasen
@@ -3410,9 +4917,8 @@ async def is_superadmin(data: dict = Body(...)):
     if correct_device_id and device_id != correct_device_id:
         raise HTTPException(status_code=403, detail="Forkert device_id for bruger")
     obserkode = get_obserkode_from_userprefs(user_id)
-    superadmins = load_superadmins()
     return {
-        "superadmin": obserkode in superadmins,
+        "superadmin": has_role(user_id, obserkode, "superadmin"),
         "obserkode": obserkode
     }
 
@@ -3489,28 +4995,12 @@ def archive_and_reset_pageview_log(for_date=None, reset_log=True):
     stats_out["unique_obserkoder"] = len(unique_obserkoder)
 
     # Tæl brugere i databasen
-    with sqlite3.connect(DB_PATH) as conn:
-        rows = conn.execute("SELECT prefs FROM user_prefs").fetchall()
-        total_users = 0
-        users_with_obserkode = 0
-        users_without_obserkode = 0
-        all_db_obserkoder = set()
-        for (prefs_json,) in rows:
-            try:
-                prefs = json.loads(prefs_json)
-                total_users += 1
-                obserkode = prefs.get("obserkode")
-                if obserkode:
-                    users_with_obserkode += 1
-                    all_db_obserkoder.add(obserkode)
-                else:
-                    users_without_obserkode += 1
-            except Exception:
-                continue
+    with db_connect() as conn:
+        total_users, users_with_obserkode, users_without_obserkode, unique_db_obserkoder = count_db_users(conn)
     stats_out["users_total"] = total_users
     stats_out["users_with_obserkode"] = users_with_obserkode
     stats_out["users_without_obserkode"] = users_without_obserkode
-    stats_out["unique_obserkoder_total_db"] = len(all_db_obserkoder)
+    stats_out["unique_obserkoder_total_db"] = unique_db_obserkoder
 
     # Skriv til masterlog
     log_entry = {
@@ -3527,7 +5017,7 @@ def archive_and_reset_pageview_log(for_date=None, reset_log=True):
                 f.write(line if line.endswith("\n") else line + "\n")
 
 @app.post("/api/admin/pageview-stats")
-async def admin_pageview_stats(data: dict = Body(...)):
+def admin_pageview_stats(data: dict = Body(...)):
     user_id = data.get("user_id")
     device_id = data.get("device_id")
     # Tjek at device_id matcher det i databasen
@@ -3535,8 +5025,7 @@ async def admin_pageview_stats(data: dict = Body(...)):
     if correct_device_id and device_id != correct_device_id:
         raise HTTPException(status_code=403, detail="Forkert device_id for bruger")
     obserkode = get_obserkode_from_userprefs(user_id)
-    superadmins = load_superadmins()
-    if obserkode not in superadmins:
+    if not has_role(user_id, obserkode, "superadmin"):
         raise HTTPException(status_code=403, detail="Kun hovedadmin")
 
     today_dk = datetime.now(pytz.timezone("Europe/Copenhagen")).strftime("%Y-%m-%d")
@@ -3668,7 +5157,7 @@ async def admin_pageview_stats(data: dict = Body(...)):
     return stats_out
 
 @app.post("/api/admin/archive-pageview-log")
-async def archive_pageview_log(data: dict = Body(...)):
+def archive_pageview_log(data: dict = Body(...)):
     user_id = data.get("user_id")
     device_id = data.get("device_id")
     # Tjek at device_id matcher det i databasen
@@ -3676,8 +5165,7 @@ async def archive_pageview_log(data: dict = Body(...)):
     if correct_device_id and device_id != correct_device_id:
         raise HTTPException(status_code=403, detail="Forkert device_id for bruger")
     obserkode = get_obserkode_from_userprefs(user_id)
-    superadmins = load_superadmins()
-    if obserkode not in superadmins:
+    if not has_role(user_id, obserkode, "superadmin"):
         raise HTTPException(status_code=403, detail="Kun hovedadmin")
     tz = pytz.timezone("Europe/Copenhagen")
     today = datetime.now(tz).strftime("%Y-%m-%d")
@@ -3685,7 +5173,7 @@ async def archive_pageview_log(data: dict = Body(...)):
     return {"status": "ok"}
 
 @app.post("/api/admin/list-admins")
-async def list_admins(data: dict = Body(...)):
+def list_admins(data: dict = Body(...)):
     user_id = data.get("user_id", "")
     device_id = data.get("device_id", "")
     # Tjek at device_id matcher det i databasen
@@ -3693,27 +5181,22 @@ async def list_admins(data: dict = Body(...)):
     if correct_device_id and device_id != correct_device_id:
         raise HTTPException(status_code=403, detail="Forkert device_id for bruger")
     obserkode = get_obserkode_from_userprefs(user_id)
-    superadmins = load_superadmins()
-    if obserkode not in superadmins:
+    if not has_role(user_id, obserkode, "superadmin"):
         raise HTTPException(status_code=403, detail="Kun hovedadmin")
     try:
-        with open(ADMIN_PATH, "r", encoding="utf-8") as f:
-            admin_data = json.load(f)
-        admin_koder = admin_data.get("admins", [])
+        admin_koder = read_cached_json(ADMIN_PATH, {}).get("admins", [])
         # Hent navn for hver admin fra user_prefs
         admins = []
-        with sqlite3.connect(DB_PATH) as conn:
-            rows = conn.execute("SELECT prefs FROM user_prefs").fetchall()
+        with db_connect() as conn:
             kode_to_navn = {}
-            for (prefs_json,) in rows:
-                try:
-                    prefs = json.loads(prefs_json)
-                    kode = (prefs.get("obserkode") or "").strip().upper()
-                    navn = prefs.get("navn", "")
-                    if kode:
-                        kode_to_navn[kode] = navn
-                except Exception:
-                    continue
+            if admin_koder:
+                rows = conn.execute(
+                    "SELECT i.obserkode_key, COALESCE(i.navn, '') FROM user_identity i "
+                    "JOIN user_prefs p ON p.user_id = i.user_id "
+                    f"WHERE i.obserkode_key IN ({','.join('?' * len(admin_koder))}) ORDER BY p.rowid",
+                    admin_koder
+                ).fetchall()
+                kode_to_navn.update(rows)
         for kode in admin_koder:
             admins.append({
                 "obserkode": kode,
@@ -3724,7 +5207,7 @@ async def list_admins(data: dict = Body(...)):
         return {"admins": []}
 
 @app.post("/api/admin/add-admin")
-async def add_admin(data: dict = Body(...)):
+def add_admin(data: dict = Body(...)):
     user_id = data.get("user_id", "")
     device_id = data.get("device_id", "")
     # Tjek at device_id matcher det i databasen
@@ -3733,25 +5216,20 @@ async def add_admin(data: dict = Body(...)):
         raise HTTPException(status_code=403, detail="Forkert device_id for bruger")
     new_obserkode = (data.get("obserkode") or "").strip().upper()
     obserkode = get_obserkode_from_userprefs(user_id)
-    superadmins = load_superadmins()
-    if obserkode not in superadmins:
+    if not has_role(user_id, obserkode, "superadmin"):
         raise HTTPException(status_code=403, detail="Kun hovedadmin")
     if not new_obserkode or not re.match(r"^[A-Z0-9]+$", new_obserkode):
         raise HTTPException(status_code=400, detail="Ugyldig obserkode")
+    def add(file_data):
+        file_data["admins"] = sorted(set(file_data.get("admins", [])) | {new_obserkode})
     try:
-        with open(ADMIN_PATH, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        admins = set(data.get("admins", []))
-        admins.add(new_obserkode)
-        data["admins"] = sorted(admins)
-        with open(ADMIN_PATH, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        update_json_file(ADMIN_PATH, {}, add)
         return {"ok": True}
     except Exception as e:
         return {"ok": False, "error": str(e)}
 
 @app.post("/api/admin/remove-admin")
-async def remove_admin(data: dict = Body(...)):
+def remove_admin(data: dict = Body(...)):
     user_id = data.get("user_id", "")
     device_id = data.get("device_id", "")
     # Tjek at device_id matcher det i databasen
@@ -3760,25 +5238,19 @@ async def remove_admin(data: dict = Body(...)):
         raise HTTPException(status_code=403, detail="Forkert device_id for bruger")
     remove_obserkode = (data.get("obserkode") or "").strip().upper()
     obserkode = get_obserkode_from_userprefs(user_id)
-    superadmins = load_superadmins()
-    if obserkode not in superadmins:
+    if not has_role(user_id, obserkode, "superadmin"):
         raise HTTPException(status_code=403, detail="Kun hovedadmin")
     if not remove_obserkode:
         raise HTTPException(status_code=400, detail="Ugyldig obserkode")
     # Beskyt alle superadmins mod at blive fjernet
-    if remove_obserkode in superadmins:
+    if remove_obserkode in load_superadmins():
         raise HTTPException(status_code=400, detail="Kan ikke fjerne hovedadmin")
-    try:
-        with open(ADMIN_PATH, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        protected_admins = set(data.get("protected", []))
-        if remove_obserkode in protected_admins:
+    def remove(file_data):
+        if remove_obserkode in set(file_data.get("protected", [])):
             raise HTTPException(status_code=400, detail="Kan ikke fjerne beskyttet admin")
-        admins = set(data.get("admins", []))
-        admins.discard(remove_obserkode)
-        data["admins"] = sorted(admins)
-        with open(ADMIN_PATH, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        file_data["admins"] = sorted(set(file_data.get("admins", [])) - {remove_obserkode})
+    try:
+        update_json_file(ADMIN_PATH, {}, remove)
         return {"ok": True}
     except Exception as e:
         return {"ok": False, "error": str(e)}
@@ -3794,7 +5266,7 @@ def safe_comment(comment):
     }
 
 @app.post("/api/admin/comments")
-async def admin_comments(data: dict = Body(...)):
+def admin_comments(data: dict = Body(...)):
     user_id = data.get("user_id")
     device_id = data.get("device_id")
     # Tjek at device_id matcher det i databasen
@@ -3803,8 +5275,7 @@ async def admin_comments(data: dict = Body(...)):
         raise HTTPException(status_code=403, detail="Forkert device_id for bruger")
     # Tjek superadmin
     obserkode = get_obserkode_from_userprefs(user_id)
-    superadmins = load_superadmins()
-    if obserkode not in superadmins:
+    if not has_role(user_id, obserkode, "superadmin"):
         raise HTTPException(status_code=403, detail="Kun hovedadmin")
     today = datetime.now()
     days = [(today - timedelta(days=i)).strftime("%d-%m-%Y") for i in range(2)]
@@ -3833,7 +5304,7 @@ async def admin_comments(data: dict = Body(...)):
     return JSONResponse(threads)
 
 @app.get("/api/thread/{day}/{thread_id}")
-async def api_thread(day: str, thread_id: str, request: Request):
+def api_thread(day: str, thread_id: str, request: Request):
     """Returner thread.json for en given dag og tråd-id."""
     # Beskyt mod directory traversal
     if not re.match(r"^\d{2}-\d{2}-\d{4}$", day):
@@ -3851,7 +5322,7 @@ async def api_thread(day: str, thread_id: str, request: Request):
     return JSONResponse(data)
 
 @app.post("/api/admin/download/{filename}")
-async def download_admin_file(filename: str, data: dict = Body(...)):
+def download_admin_file(filename: str, data: dict = Body(...)):
     user_id = data.get("user_id", "")
     device_id = data.get("device_id", "")
     # Tjek at device_id matcher det i databasen
@@ -3860,8 +5331,7 @@ async def download_admin_file(filename: str, data: dict = Body(...)):
         raise HTTPException(status_code=403, detail="Forkert device_id for bruger")
     # Tjek superadmin
     obserkode = get_obserkode_from_userprefs(user_id)
-    superadmins = load_superadmins()
-    if obserkode not in superadmins:
+    if not has_role(user_id, obserkode, "superadmin"):
         raise HTTPException(status_code=403, detail="Kun hovedadmin")
     # Beskyt mod directory traversal: kun whitelistede filnavne tilladt
     base_dir = os.path.dirname(__file__)
@@ -3884,7 +5354,7 @@ async def log_all_requests(request: Request, call_next):
     return response
 
 @app.post("/api/admin/serverlog")
-async def get_server_log(data: dict = Body(...)):
+def get_server_log(data: dict = Body(...)):
     user_id = data.get("user_id", "")
     device_id = data.get("device_id", "")
     # Tjek at device_id matcher det i databasen
@@ -3892,8 +5362,7 @@ async def get_server_log(data: dict = Body(...)):
     if correct_device_id and device_id != correct_device_id:
         raise HTTPException(status_code=403, detail="Forkert device_id for bruger")
     obserkode = get_obserkode_from_userprefs(user_id)
-    superadmins = load_superadmins()
-    if obserkode not in superadmins:
+    if not has_role(user_id, obserkode, "superadmin"):
         raise HTTPException(status_code=403, detail="Kun hovedadmin")
     log_path = os.path.join(os.path.dirname(__file__), "server.log")
     if not os.path.isfile(log_path):
@@ -3903,7 +5372,7 @@ async def get_server_log(data: dict = Body(...)):
     return {"log": "".join(lines)}
 
 @app.post("/api/userinfo")
-async def get_or_save_userinfo(data: dict = Body(...)):
+def get_or_save_userinfo(response: Response, data: dict = Body(...)):
     user_id = data.get("user_id")
     device_id = data.get("device_id")
     # Tjek at device_id matcher det i databasen
@@ -3913,19 +5382,23 @@ async def get_or_save_userinfo(data: dict = Body(...)):
     # Hvis der er obserkode/navn, så gem, ellers hent
     obserkode = data.get("obserkode")
     navn = data.get("navn")
-    prefs = get_prefs(user_id)
     if obserkode is not None or navn is not None:
+        def save_userinfo(conn):
+            if obserkode is not None:
+                apply_pref(conn, user_id, "obserkode", obserkode)
+            if navn is not None:
+                apply_pref(conn, user_id, "navn", navn)
+        version = mutate_prefs(user_id, save_userinfo, data.get("version"))
         if obserkode is not None:
-            prefs["obserkode"] = obserkode
-        if navn is not None:
-            prefs["navn"] = navn
-        set_prefs(user_id, prefs)
-        return {"ok": True}
+            attach_session(response, user_id, device_id)
+        return {"ok": True, "version": version}
+    prefs, version = get_prefs_with_version(user_id)
     return {
         "user_id": user_id,
         "device_id": device_id,
         "obserkode": prefs.get("obserkode", ""),
-        "navn": prefs.get("navn", "")
+        "navn": prefs.get("navn", ""),
+        "version": version
     }
 
 @app.post("/api/prefs/user/species")
@@ -3934,34 +5407,38 @@ async def species_filters(request: Request):
     user_id = data.get("user_id")
     device_id = data.get("device_id")
     # Tjek at device_id matcher det i databasen
-    correct_device_id = get_device_id_for_user(user_id)
+    correct_device_id = await run_db(get_device_id_for_user, user_id)
     if correct_device_id and device_id != correct_device_id:
         raise HTTPException(status_code=403, detail="Forkert device_id for bruger")
     filters = data.get("filters")
-    prefs = get_prefs(user_id)
     if filters is not None:
         # Opdater artsfilter
-        prefs["species_filters"] = filters
-        set_prefs(user_id, prefs)
-        return {"ok": True}
+        version = await run_db(
+            mutate_prefs, user_id, lambda conn: apply_pref(conn, user_id, "species_filters", filters), data.get("version")
+        )
+        return {"ok": True, "version": version}
     # Returner artsfilter
-    return JSONResponse(prefs.get("species_filters") or {"include": [], "exclude": [], "counts": {}})
+    prefs, version = await run_db(get_prefs_with_version, user_id)
+    return JSONResponse(
+        prefs.get("species_filters") or {"include": [], "exclude": [], "counts": {}},
+        headers={"X-Prefs-Version": str(version)}
+    )
 
 @app.get("/api/payload")
-async def api_payload():
+def api_payload():
     data = _load_latest_payload()
     if data is None:
         return JSONResponse([])
     return JSONResponse(data)
 
 @app.get("/api/latest")
-async def api_latest():
+def api_latest():
     data = _load_latest_payload()
     latest = _latest_from_data(data) if data is not None else {}
     return JSONResponse(latest)
 
 @app.get("/obs/{day}/threads/{thread_id}")
-async def get_thread_short(day: str, thread_id: str):
+def get_thread_short(day: str, thread_id: str):
     # Beskyt mod directory traversal
     if not re.match(r"^\d{2}-\d{2}-\d{4}$", day):
         return JSONResponse({"detail": "Ugyldig dag"}, status_code=400)
@@ -3981,14 +5458,13 @@ async def debug_push(request: Request):
     user_id = data.get("user_id") or data.get("userid")
     device_id = data.get("device_id") or data.get("deviceid")
     # Tjek at device_id matcher det i databasen
-    correct_device_id = get_device_id_for_user(user_id)
+    correct_device_id = await run_db(get_device_id_for_user, user_id)
     if correct_device_id and device_id != correct_device_id:
         raise HTTPException(status_code=403, detail="Forkert device_id for bruger")
 
     # Indlæs latest.json og tag første observation
     try:
-        with open(latest_symlink_path, "r", encoding="utf-8") as f:
-            latest_list = json.load(f)
+        latest_list = await read_json_file(latest_symlink_path)
         if not latest_list or not isinstance(latest_list, list):
             return JSONResponse({"error": "Ingen observationer fundet eller forkert format"}, status_code=400)
         obs = latest_list[0]
@@ -3996,12 +5472,14 @@ async def debug_push(request: Request):
         return JSONResponse({"error": f"Kunne ikke læse latest.json: {e}"}, status_code=500)
 
     # Find subscription for denne bruger+device
-    try:
-        with sqlite3.connect(DB_PATH) as conn:
-            row = conn.execute(
+    def load_subscription():
+        with db_connect() as conn:
+            return conn.execute(
                 "SELECT subscription FROM subscriptions WHERE user_id=? AND device_id=?",
                 (user_id, device_id)
             ).fetchone()
+    try:
+        row = await run_db(load_subscription)
         if not row:
             return JSONResponse({"error": f"Ingen subscription fundet for {user_id} / {device_id}"}, status_code=404)
         sub = json.loads(row[0])
@@ -4020,7 +5498,7 @@ async def debug_push(request: Request):
 
     # Send push
     try:
-        webpush(
+        await webpush_async(
             subscription_info=sub,
             data=json.dumps(payload, ensure_ascii=False),
             vapid_private_key=VAPID_PRIVATE_KEY,
@@ -4029,7 +5507,9 @@ async def debug_push(request: Request):
                 "publicKey": VAPID_PUBLIC_KEY  # valgfrit, men ikke som separat argument
             },
             ttl=3600,  # 1 time
-            headers={"Urgency": "high"}  # <-- Tilføj urgency high
+            headers={"Urgency": "high"},  # <-- Tilføj urgency high
+            timeout=aiohttp.ClientTimeout(total=PUSH_TIMEOUT),
+            aiohttp_session=get_push_session(),
         )
     except Exception as ex:
         return JSONResponse({"error": f"webpush-fejl: {ex}"}, status_code=500)
@@ -4064,35 +5544,43 @@ ws_connections: Dict[str, List[WebSocket]] = {}
 def ws_key(day, thread_id):
     return f"{day}::{thread_id}"
 
-def load_blacklisted_obsids():
-    try:
-        with open(BLACKLIST_PATH, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        return set(entry["obserkode"] for entry in data if "obserkode" in entry)
-    except Exception:
-        return set()
-    
 def get_comment_lock(day, thread_id):
     return comment_file_locks[(day, thread_id)]
 
+def _read_comments(day, thread_id):
+    thread_dir = os.path.join(web_dir, "obs", day, "threads", thread_id)
+    comments_path = os.path.join(thread_dir, "kommentar.json")
+    if not os.path.isfile(comments_path):
+        return []
+    with open(comments_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def _write_comments(day, thread_id, comments):
+    thread_dir = os.path.join(web_dir, "obs", day, "threads", thread_id)
+    os.makedirs(thread_dir, exist_ok=True)
+    comments_path = os.path.join(thread_dir, "kommentar.json")
+    with open(comments_path, "w", encoding="utf-8") as f:
+        json.dump(comments, f, ensure_ascii=False, indent=2)
+
 def get_comments_for_thread(day, thread_id):
-    lock = get_comment_lock(day, thread_id)
-    with lock:
-        thread_dir = os.path.join(web_dir, "obs", day, "threads", thread_id)
-        comments_path = os.path.join(thread_dir, "kommentar.json")
-        if not os.path.isfile(comments_path):
-            return []
-        with open(comments_path, "r", encoding="utf-8") as f:
-            return json.load(f)
+    with get_comment_lock(day, thread_id):
+        return _read_comments(day, thread_id)
 
 def save_comments_for_thread(day, thread_id, comments):
-    lock = get_comment_lock(day, thread_id)
-    with lock:
-        thread_dir = os.path.join(web_dir, "obs", day, "threads", thread_id)
-        os.makedirs(thread_dir, exist_ok=True)
-        comments_path = os.path.join(thread_dir, "kommentar.json")
-        with open(comments_path, "w", encoding="utf-8") as f:
-            json.dump(comments, f, ensure_ascii=False, indent=2)
+    with get_comment_lock(day, thread_id):
+        _write_comments(day, thread_id, comments)
+
+def update_comments_for_thread(day, thread_id, mutate):
+    """Læs, ændr og gem kommentarerne under samme lås, så samtidige tråde ikke overskriver hinanden.
+
+    mutate(comments) ændrer listen på stedet og returnerer (gem, resultat).
+    """
+    with get_comment_lock(day, thread_id):
+        comments = _read_comments(day, thread_id)
+        save, result = mutate(comments)
+        if save:
+            _write_comments(day, thread_id, comments)
+        return result
 
 def get_comments_for_user(thread_comments, current_user_id):
     blacklisted = load_blacklisted_obsids()
@@ -4112,7 +5600,7 @@ def is_blacklisted_obserkode(obserkode):
 
 def is_valid_user_device(user_id, device_id):
     """Tjek at user_id/device_id findes i subscriptions-tabellen."""
-    with sqlite3.connect(DB_PATH) as conn:
+    with db_connect() as conn:
         row = conn.execute(
             "SELECT 1 FROM subscriptions WHERE user_id=? AND device_id=?",
             (user_id, device_id)
@@ -4121,10 +5609,10 @@ def is_valid_user_device(user_id, device_id):
 
 def is_thread_subscriber(day, thread_id, user_id, device_id):
     """Tjek at user_id/device_id er abonnent på tråden."""
-    with sqlite3.connect(DB_PATH) as conn:
+    with db_connect() as conn:
         row = conn.execute(
             "SELECT 1 FROM thread_subs WHERE day=? AND thread_id=? AND user_id=? AND device_id=?",
-            (day, thread_id, user_id, device_id)
+            (thread_day_key(day), thread_id, user_id, device_id)
         ).fetchone()
     return bool(row)
 
@@ -4145,21 +5633,21 @@ async def ws_thread(websocket: WebSocket, day: str, thread_id: str):
 
             # Alle må læse kommentarer
             if msg_type == "get_comments":
-                comments = get_comments_for_thread(day, thread_id)
-                filtered = get_comments_for_user(comments, user_id)
+                comments = await run_io(get_comments_for_thread, day, thread_id)
+                filtered = await run_io(get_comments_for_user, comments, user_id)
                 safe_comments = [safe_comment(c) for c in filtered]
                 await websocket.send_json({"type": "comments", "comments": safe_comments})
                 continue
 
             # Kun brugere med gyldig user_id/device_id må skrive/like
-            if not user_id or not device_id or not is_valid_user_device(user_id, device_id):
+            if not user_id or not device_id or not await run_db(is_valid_user_device, user_id, device_id):
                 await websocket.send_json({"type": "error", "message": "Du skal være logget ind for at skrive eller like."})
                 continue
 
             # Ny kommentar
             if msg_type == "new_comment":
                 # Tjek device_id matcher det i databasen
-                correct_device_id = get_device_id_for_user(user_id)
+                correct_device_id = await run_db(get_device_id_for_user, user_id)
                 if correct_device_id and device_id != correct_device_id:
                     await websocket.send_json({"type": "error", "message": "Forkert device_id for bruger."})
                     continue
@@ -4167,7 +5655,7 @@ async def ws_thread(websocket: WebSocket, day: str, thread_id: str):
                 navn = msg.get("navn", "Ukendt")
                 body = (msg.get("body") or "").strip()
                 obserkode = msg.get("obserkode", "")
-                blacklisted = load_blacklisted_obsids()
+                blacklisted = await run_io(load_blacklisted_obsids)
                 if obserkode in blacklisted:
                     await websocket.send_json({"type": "error", "message": "Du er blacklistet og kan ikke skrive kommentarer."})
                     continue
@@ -4184,122 +5672,82 @@ async def ws_thread(websocket: WebSocket, day: str, thread_id: str):
                     "thumbs_users": [],
                     "user_id": user_id
                 }
-                comments = get_comments_for_thread(day, thread_id)
-                comments.append(comment)
-                save_comments_for_thread(day, thread_id, comments)
-
-                # Log kommentaren til comments.log (her kan device_id stadig logges hvis ønsket)
-                comment_log_entry = {
-                    "day": day,
-                    "thread_id": thread_id,
-                    **comment,
-                }
-                with open("comments.log", "a", encoding="utf-8") as logf:
-                    logf.write(json.dumps(comment_log_entry, ensure_ascii=False) + "\n")
-
-                # Tilføj forfatteren som abonnent på tråden (hvis ikke allerede)
-                with sqlite3.connect(DB_PATH) as conn:
-                    conn.execute(
-                        "INSERT OR IGNORE INTO thread_subs (day, thread_id, user_id, device_id) VALUES (?, ?, ?, ?)",
-                        (day, thread_id, user_id, device_id)
-                    )
-
-                # --- AUTO-SUBSCRIBE ALLE OBSERKODER FRA EVENTS PÅ TRÅDEN ---
-                thread_path = os.path.join(thread_dir, "thread.json")
-                obserkoder_on_thread = set()
-                if os.path.isfile(thread_path):
-                    try:
-                        with open(thread_path, "r", encoding="utf-8") as f:
-                            thread_data = json.load(f)
-                        events = thread_data.get("events", [])
-                        for ev in events:
-                            kode = (ev.get("Obserkode") or ev.get("obserkode") or "").strip().upper()
-                            if kode:
-                                obserkoder_on_thread.add(kode)
-                    except Exception:
-                        pass
+                def save_comment():
+                    def append(comments):
+                        comments.append(comment)
+                        return True, None
+                    update_comments_for_thread(day, thread_id, append)
+                    count_metric("comments")
+
+                    # Log kommentaren til comments.log (her kan device_id stadig logges hvis ønsket)
+                    comment_log_entry = {
+                        "day": day,
+                        "thread_id": thread_id,
+                        **comment,
+                    }
+                    with open("comments.log", "a", encoding="utf-8") as logf:
+                        logf.write(json.dumps(comment_log_entry, ensure_ascii=False) + "\n")
 
-                if obserkoder_on_thread:
-                    with sqlite3.connect(DB_PATH) as conn:
-                        for kode in obserkoder_on_thread:
-                            rows = conn.execute("SELECT user_id, prefs FROM user_prefs").fetchall()
-                            for u_id, prefs_json in rows:
-                                try:
-                                    prefs = json.loads(prefs_json)
-                                    bruger_kode = (prefs.get("obserkode") or "").strip().upper()
-                                    if bruger_kode == kode:
-                                        dev_rows = conn.execute("SELECT device_id FROM subscriptions WHERE user_id=?", (u_id,)).fetchall()
-                                        for (dev_id,) in dev_rows:
-                                            # Tjek om brugeren har afmeldt denne tråd
-                                            skip = conn.execute(
-                                                "SELECT 1 FROM thread_unsubs WHERE day=? AND thread_id=? AND user_id=? AND device_id=?",
-                                                (day, thread_id, u_id, dev_id)
-                                            ).fetchone()
-                                            if skip:
-                                                continue
-                                            conn.execute(
-                                                "INSERT OR IGNORE INTO thread_subs (day, thread_id, user_id, device_id) VALUES (?, ?, ?, ?)",
-                                                (day, thread_id, u_id, dev_id)
-                                            )
-                                except Exception:
-                                    continue
+                    # --- AUTO-SUBSCRIBE ALLE OBSERKODER FRA EVENTS PÅ TRÅDEN ---
+                    thread_path = os.path.join(thread_dir, "thread.json")
+                    obserkoder_on_thread = set()
+                    if os.path.isfile(thread_path):
+                        try:
+                            with open(thread_path, "r", encoding="utf-8") as f:
+                                thread_data = json.load(f)
+                            events = thread_data.get("events", [])
+                            for ev in events:
+                                kode = (ev.get("Obserkode") or ev.get("obserkode") or "").strip().upper()
+                                if kode:
+                                    obserkoder_on_thread.add(kode)
+                        except Exception:
+                            pass
+                    return sorted(obserkoder_on_thread), get_thread_meta(day, thread_id) or {}
+
+                def subscribe_and_load_followers(koder):
+                    with db_connect() as conn:
+                        # Tilføj forfatteren som abonnent på tråden (hvis ikke allerede)
+                        conn.execute(
+                            "INSERT OR IGNORE INTO thread_subs (day, thread_id, user_id, device_id) VALUES (?, ?, ?, ?)",
+                            (thread_day_key(day), thread_id, user_id, device_id)
+                        )
+                        if koder:
+                            # Alle enheder for brugere med en af obserkoderne – undtagen dem der har afmeldt tråden
+                            conn.execute(
+                                "INSERT OR IGNORE INTO thread_subs (day, thread_id, user_id, device_id) "
+                                "SELECT ?, ?, s.user_id, s.device_id FROM user_identity i "
+                                "JOIN subscriptions s ON s.user_id = i.user_id "
+                                f"WHERE i.obserkode_key IN ({','.join('?' * len(koder))}) "
+                                "AND NOT EXISTS (SELECT 1 FROM thread_unsubs u WHERE u.day = ? AND u.thread_id = ? "
+                                "AND u.user_id = s.user_id AND u.device_id = s.device_id)",
+                                [thread_day_key(day), thread_id, *koder, thread_day_key(day), thread_id]
+                            )
                         conn.commit()
-                # --- SLUT AUTO-SUBSCRIBE ---
+                        followers = load_thread_followers(conn, [(day, thread_id)]).get((day, thread_id), [])
+                    # Find obserkode for forfatter
+                    return followers, obserkode_key(get_obserkode_from_userprefs(user_id))
+
+                koder, thread_meta = await run_io(save_comment)
+                # --- AUTO-SUBSCRIBE (i subscribe_and_load_followers) ---
+                subs, author_obserkode = await run_db(subscribe_and_load_followers, koder)
 
                 # Send push til alle abonnenter (undtagen forfatteren)
-                with sqlite3.connect(DB_PATH) as conn:
-                    subs = conn.execute(
-                        "SELECT user_id, device_id FROM thread_subs WHERE day=? AND thread_id=?",
-                        (day, thread_id)
-                    ).fetchall()
-                thread_path = os.path.join(thread_dir, "thread.json")
-                artnavn = ""
-                loknavn = ""
-                if os.path.isfile(thread_path):
-                    try:
-                        with open(thread_path, "r", encoding="utf-8") as f:
-                            thread_data = json.load(f)
-                        thread_info = thread_data.get("thread", {})
-                        artnavn = thread_info.get("art", "")
-                        loknavn = thread_info.get("lok", "")
-                    except Exception:
-                        pass
-                for sub_user_id, sub_device_id in subs:
-                    # Find obserkode for abonnent
-                    sub_prefs = get_prefs(sub_user_id)
-                    sub_obserkode = (sub_prefs.get("obserkode") or "").strip().upper()
-                    # Find obserkode for forfatter
-                    author_prefs = get_prefs(user_id)
-                    author_obserkode = (author_prefs.get("obserkode") or "").strip().upper()
+                artnavn = thread_meta.get("art", "")
+                loknavn = thread_meta.get("lok", "")
+                deliveries = []
+                for sub_user_id, sub_device_id, sub_json, sub_obserkode in subs:
                     # Spring over hvis det er forfatteren selv eller en anden med samme obserkode
                     if (sub_user_id == user_id and sub_device_id == device_id) or (sub_obserkode and author_obserkode and sub_obserkode == author_obserkode):
                         continue
-                    with sqlite3.connect(DB_PATH) as conn:
-                        row = conn.execute(
-                            "SELECT subscription FROM subscriptions WHERE user_id=? AND device_id=?",
-                            (sub_user_id, sub_device_id)
-                        ).fetchone()
-                    if not row:
-                        continue
-                    sub = json.loads(row[0])
+                    sub = json.loads(sub_json)
                     payload = {
                         "title": f"Nyt indlæg på: {artnavn} - {loknavn}",
                         "body": f"{navn}: {body}",
                         "url": f"/traad.html?date={day}&id={thread_id}",
                         "tag": f"{thread_id}-comment-{ts.replace(' ', '_').replace(':', '-')}"
                     }
-                    try:
-                        webpush(
-                            subscription_info=sub,
-                            data=json.dumps(payload, ensure_ascii=False),
-                            vapid_private_key=VAPID_PRIVATE_KEY,
-                            vapid_claims={"sub": "mailto:kontakt@dofnot.dk"},
-                            ttl=3600,
-                            headers={"Urgency": "high"}
-                        )
-                        obs_notification_queue.put(1)
-                    except Exception as ex:
-                        print(f"Push-fejl til {sub_user_id}/{sub_device_id}: {ex}")
+                    deliveries.append(send_push(sub, payload, sub_user_id, sub_device_id, ensure_ascii=False))
+                await asyncio.gather(*deliveries)
 
                 # Broadcast til alle websockets
                 for ws in ws_connections.get(key, []):
@@ -4313,78 +5761,61 @@ async def ws_thread(websocket: WebSocket, day: str, thread_id: str):
                 ts = msg.get("ts")
                 user_id = msg.get("user_id")
                 # Tjek device_id matcher det i databasen
-                correct_device_id = get_device_id_for_user(user_id)
+                correct_device_id = await run_db(get_device_id_for_user, user_id)
                 if correct_device_id and device_id != correct_device_id:
                     await websocket.send_json({"type": "error", "message": "Forkert device_id for bruger."})
                     continue
 
                 if not ts or not user_id:
                     continue
-                comments = get_comments_for_thread(day, thread_id)
-                found = False
-                for c in comments:
-                    if c.get("ts") == ts:
-                        thumbs_users = set(c.get("thumbs_users", []))
-                        already_thumbed = user_id in thumbs_users
-                        if already_thumbed:
-                            thumbs_users.remove(user_id)
-                        else:
-                            thumbs_users.add(user_id)
-                        c["thumbs_users"] = list(thumbs_users)
-                        c["thumbs"] = len(thumbs_users)
-                        found = True
-
-                        # Send push hvis ny thumbs up og ikke fra ejeren selv
-                        if not already_thumbed and user_id != c.get("user_id"):
-                            owner_user_id = c.get("user_id")
-                            owner_device_id = c.get("device_id")
-                            if owner_user_id and owner_device_id:
-                                with sqlite3.connect(DB_PATH) as conn:
-                                    sub_row = conn.execute(
-                                        "SELECT 1 FROM thread_subs WHERE day=? AND thread_id=? AND user_id=? AND device_id=?",
-                                        (day, thread_id, owner_user_id, owner_device_id)
-                                    ).fetchone()
-                                if sub_row:
-                                    with sqlite3.connect(DB_PATH) as conn:
-                                        row = conn.execute(
-                                            "SELECT subscription FROM subscriptions WHERE user_id=? AND device_id=?",
-                                            (owner_user_id, owner_device_id)
-                                        ).fetchone()
-                                    if row:
-                                        sub = json.loads(row[0])
-                                        thread_path = os.path.join(thread_dir, "thread.json")
-                                        artnavn = ""
-                                        loknavn = ""
-                                        if os.path.isfile(thread_path):
-                                            try:
-                                                with open(thread_path, "r", encoding="utf-8") as f:
-                                                    thread_data = json.load(f)
-                                                thread_info = thread_data.get("thread", {})
-                                                artnavn = thread_info.get("art", "")
-                                                loknavn = thread_info.get("lok", "")
-                                            except Exception:
-                                                pass
-                                        payload = {
-                                            "title": f"👍 på dit indlæg: {artnavn} - {loknavn}",
-                                            "body": f"Dit indlæg har fået en thumbs up!",
-                                            "url": f"/traad.html?date={day}&id={thread_id}",
-                                            "tag": f"{thread_id}-thumbsup-{ts.replace(' ', '_').replace(':', '-')}"
-                                        }
-                                        try:
-                                            webpush(
-                                                subscription_info=sub,
-                                                data=json.dumps(payload, ensure_ascii=False),
-                                                vapid_private_key=VAPID_PRIVATE_KEY,
-                                                vapid_claims={"sub": "mailto:kontakt@dofnot.dk"},
-                                                ttl=3600,
-                                                headers={"Urgency": "high"}
-                                            )
-                                            obs_notification_queue.put(1) 
-                                        except Exception as ex:
-                                            print(f"Push-fejl til {owner_user_id}/{owner_device_id}: {ex}")
-                        break
+
+                def toggle_thumbs(comments):
+                    for c in comments:
+                        if c.get("ts") == ts:
+                            thumbs_users = set(c.get("thumbs_users", []))
+                            already_thumbed = user_id in thumbs_users
+                            if already_thumbed:
+                                thumbs_users.remove(user_id)
+                            else:
+                                thumbs_users.add(user_id)
+                            c["thumbs_users"] = list(thumbs_users)
+                            c["thumbs"] = len(thumbs_users)
+                            # Ejeren skal have push hvis ny thumbs up og ikke fra ejeren selv
+                            notify = not already_thumbed and user_id != c.get("user_id")
+                            return True, (True, notify, c.get("user_id"), c.get("device_id"))
+                    return False, (False, False, None, None)
+
+                def load_owner_subscription(owner_user_id, owner_device_id):
+                    with db_connect() as conn:
+                        sub_row = conn.execute(
+                            "SELECT 1 FROM thread_subs WHERE day=? AND thread_id=? AND user_id=? AND device_id=?",
+                            (thread_day_key(day), thread_id, owner_user_id, owner_device_id)
+                        ).fetchone()
+                        if not sub_row:
+                            return None
+                        row = conn.execute(
+                            "SELECT subscription FROM subscriptions WHERE user_id=? AND device_id=?",
+                            (owner_user_id, owner_device_id)
+                        ).fetchone()
+                    return json.loads(row[0]) if row else None
+
+                found, notify, owner_user_id, owner_device_id = await run_io(
+                    update_comments_for_thread, day, thread_id, toggle_thumbs
+                )
+                if notify and owner_user_id and owner_device_id:
+                    sub = await run_db(load_owner_subscription, owner_user_id, owner_device_id)
+                    if sub:
+                        thread_meta = await run_io(get_thread_meta, day, thread_id) or {}
+                        artnavn = thread_meta.get("art", "")
+                        loknavn = thread_meta.get("lok", "")
+                        payload = {
+                            "title": f"👍 på dit indlæg: {artnavn} - {loknavn}",
+                            "body": f"Dit indlæg har fået en thumbs up!",
+                            "url": f"/traad.html?date={day}&id={thread_id}",
+                            "tag": f"{thread_id}-thumbsup-{ts.replace(' ', '_').replace(':', '-')}"
+                        }
+                        await send_push(sub, payload, owner_user_id, owner_device_id, ensure_ascii=False)
                 if found:
-                    save_comments_for_thread(day, thread_id, comments)
                     for ws in ws_connections.get(key, []):
                         try:
                             await ws.send_json({"type": "thumbs_update"})
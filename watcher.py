@@ -1,14 +1,18 @@
 import argparse
+import codecs
 import io
 import csv
+import itertools
+import hashlib
 import json
+import operator
 import glob
 import time
 import os
 import re
 import requests
 from datetime import datetime, timedelta
-from typing import List, Dict, Tuple, Set
+from typing import List, Dict, Tuple, Set, Iterable, Iterator
 from collections import defaultdict
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
@@ -30,6 +34,10 @@ STATE_FILE = "/state/state.json"
 DATA_DIR = os.path.join(os.path.dirname(__file__), "data")  # NYT
 DOWNLOADS_DIR = os.path.join(os.path.dirname(__file__), "downloads")
 WATCH_STATE_FILE = os.path.join(os.path.dirname(__file__), "state", "watch_state.json")  # NYT: separat state til watcher
+# Sidste hentning pr. dato (sha256 af rå svar + ETag/Last-Modified) og heartbeat
+FETCH_STATE_FILE = os.path.join(os.path.dirname(__file__), "state", "fetch_state.json")
+FETCH_STATE_KEEP_DAYS = 3
+FETCH_CHUNK_SIZE = 64 * 1024
 
 # De 38 faste kolonner som skal
 COLUMNS = [
@@ -60,14 +68,14 @@ class SyncHandler(FileSystemEventHandler):
             yesterday = (now - timedelta(days=1)).strftime("%d-%m-%Y")
             if sync == "today":
                 print("[watcher] (watchdog) Sync-request: i dag")
-                run_once(today, send_notifications=True)
+                run_once(today, send_notifications=True, force=True)
             elif sync == "yesterday":
                 print("[watcher] (watchdog) Sync-request: i går")
-                run_once(yesterday, send_notifications=False)
+                run_once(yesterday, send_notifications=False, force=True)
             elif sync == "both":
                 print("[watcher] (watchdog) Sync-request: både i dag og i går")
-                run_once(today, send_notifications=True)
-                run_once(yesterday, send_notifications=False)
+                run_once(today, send_notifications=True, force=True)
+                run_once(yesterday, send_notifications=False, force=True)
             else:
                 print(f"[watcher] (watchdog) Sync-request: ukendt værdi '{sync}'")
             try:
@@ -77,22 +85,17 @@ class SyncHandler(FileSystemEventHandler):
                 print(f"[watcher] (watchdog) Kunne ikke slette sync-request: {e}")
 
 # --- NYT: Klassifikation (SU/SUB) + bemærk-tærskler pr. afdeling ---
-def load_klassifikation_map() -> Dict[str, str]:
+def load_klassifikation_map(f) -> Dict[str, str]:
     """Læs arter_filter_klassificeret.csv -> artsnavn -> klassifikation (SU/SUB/Alm)."""
-    path = os.path.join(DATA_DIR, "arter_filter_klassificeret.csv")
     mapping: Dict[str, str] = {}
-    try:
-        with open(path, "r", encoding="utf-8-sig") as f:
-            reader = csv.DictReader(f, delimiter=";")
-            for row in reader:
-                name = (row.get("artsnavn") or "").strip()
-                klass = (row.get("klassifikation") or "").strip()
-                if name:
-                    # Fjern firkantede parenteser hvis de findes
-                    name_normalized = name.strip("[]")
-                    mapping[name_normalized] = klass
-    except Exception as e:
-        print(f"[watcher] Kunne ikke læse klassifikationsfil: {e}")
+    reader = csv.DictReader(f, delimiter=";")
+    for row in reader:
+        name = (row.get("artsnavn") or "").strip()
+        klass = (row.get("klassifikation") or "").strip()
+        if name:
+            # Fjern firkantede parenteser hvis de findes
+            name_normalized = name.strip("[]")
+            mapping[name_normalized] = klass
     return mapping
 
 def save_json_to_downloads(rows: List[Dict[str, str]], obsid_birthtimes: dict):
@@ -137,79 +140,37 @@ def save_json_to_downloads(rows: List[Dict[str, str]], obsid_birthtimes: dict):
         files.pop(0)
 
 
-def build_bemaerk_maps() -> Dict[str, Dict[str, int]]:
-    """Læs alle *_bemaerk_parsed.csv -> {region_slug: {artsnavn: min_antal}}."""
-    region_maps: Dict[str, Dict[str, int]] = {}
-    try:
-        pattern = os.path.join(DATA_DIR, "*_bemaerk_parsed.csv")
-        for fp in glob.glob(pattern):
-            slug = os.path.basename(fp).replace("_bemaerk_parsed.csv", "")
-            # print(f"[watcher][bemaerk] Indlæser: {fp} (region: {slug})")  # DEBUG
-            thresholds: Dict[str, int] = {}
-            with open(fp, "r", encoding="utf-8-sig") as f:
-                reader = csv.DictReader(f, delimiter=";")
-                for row in reader:
-                    an = (row.get("artsnavn") or "").strip()
-                    t = (row.get("bemaerk_antal") or "").strip()
-                    if not an or not t:
-                        continue
-                    try:
-                        # Fjern firkantede parenteser ved indlæsning
-                        an_normalized = an.strip("[]")
-                        thresholds[an_normalized] = int(t)
-                        # print(f"  - {an}: {t}")  # DEBUG
-                    except ValueError:
-                        continue
-            region_maps[slug] = thresholds
-    except Exception as e:
-        print(f"[watcher] Kunne ikke læse bemærk-filer: {e}")
-    return region_maps
+def load_bemaerk_thresholds(f) -> Dict[str, int]:
+    """Læs én <region>_bemaerk_parsed.csv -> {artsnavn: min_antal}."""
+    thresholds: Dict[str, int] = {}
+    reader = csv.DictReader(f, delimiter=";")
+    for row in reader:
+        an = (row.get("artsnavn") or "").strip()
+        t = (row.get("bemaerk_antal") or "").strip()
+        if not an or not t:
+            continue
+        try:
+            # Fjern firkantede parenteser ved indlæsning
+            an_normalized = an.strip("[]")
+            thresholds[an_normalized] = int(t)
+        except ValueError:
+            continue
+    return thresholds
 
-def load_faenologi_perioder() -> Dict[str, List[Tuple[str, str]]]:
+def load_faenologi_perioder(f) -> Dict[str, List[Tuple[str, str]]]:
     """Indlæs faenologi.csv -> artsnavn -> [(datofra, datotil), ...]"""
-    path = os.path.join(DATA_DIR, "faenologi.csv")
     mapping: Dict[str, List[Tuple[str, str]]] = {}
-    try:
-        with open(path, "r", encoding="utf-8-sig") as f:
-            reader = csv.DictReader(f, delimiter=";")
-            for row in reader:
-                art = (row.get("Artnavn") or "").strip()
-                fra = (row.get("Datofra") or "").strip()
-                til = (row.get("Datotil") or "").strip()
-                if not art or not fra or not til:
-                    continue
-                # Fjern firkantede parenteser ved indlæsning
-                art_normalized = art.strip("[]")
-                mapping.setdefault(art_normalized, []).append((fra, til))
-    except Exception as e:
-        print(f"[watcher] Kunne ikke læse faenologi-fil: {e}")
-    return mapping
-
-KLASS_MAP = load_klassifikation_map()
-BEMAERK_BY_REGION = build_bemaerk_maps()
-FAENOLOGI_PERIODER = load_faenologi_perioder()
-
-def _dato_in_faenologi_periode(obsdato: str, perioder: List[Tuple[str, str]]) -> bool:
-    """Returnér True hvis obsdato (DD-MM-YYYY) ligger i en af perioderne (DD-MM til DD-MM)."""
-    try:
-        obs_dt = datetime.strptime(obsdato[:5], "%d-%m")
-    except Exception:
-        return False
-    for fra, til in perioder:
-        try:
-            fra_dt = datetime.strptime(fra, "%d-%m")
-            til_dt = datetime.strptime(til, "%d-%m")
-        except Exception:
+    reader = csv.DictReader(f, delimiter=";")
+    for row in reader:
+        art = (row.get("Artnavn") or "").strip()
+        fra = (row.get("Datofra") or "").strip()
+        til = (row.get("Datotil") or "").strip()
+        if not art or not fra or not til:
             continue
-        # Periode over nytår?
-        if fra_dt <= til_dt:
-            if fra_dt <= obs_dt <= til_dt:
-                return True
-        else:
-            # Fx 30-09 til 10-04 (over nytår)
-            if obs_dt >= fra_dt or obs_dt <= til_dt:
-                return True
-    return False
+        # Fjern firkantede parenteser ved indlæsning
+        art_normalized = art.strip("[]")
+        mapping.setdefault(art_normalized, []).append((fra, til))
+    return mapping
 
 def to_region_slug(dept: str) -> str:
     s = (dept or "").strip()
@@ -218,41 +179,193 @@ def to_region_slug(dept: str) -> str:
     return slugify(s)
 
 
+_DAG_1900 = datetime(1900, 1, 1)
+
+def _dag_i_aaret(ddmm: str) -> int | None:
+    """DD-MM -> dag i året (0-364) i strptimes 1900-kalender; None hvis datoen ikke kan læses."""
+    try:
+        return (datetime.strptime(ddmm, "%d-%m") - _DAG_1900).days
+    except Exception:
+        return None
+
+
+class KategoriClassifier:
+    """Klassifikation (SU/SUB/bemaerk/alm) kompileret én gang ud fra referencedata.
+
+    Fænologiperioderne bliver til et bitset over årets dage pr. art, tærsklerne til floats,
+    og DOF_afdeling-feltet slås op i en memoiseret tabel over regionernes tærskler. En række
+    klassificeres derefter kun med dict-opslag og heltalssammenligninger.
+    """
+
+    def __init__(
+        self,
+        klass_map: Dict[str, str],
+        faenologi: Dict[str, List[Tuple[str, str]]],
+        bemaerk_by_region: Dict[str, Dict[str, int]],
+    ):
+        self.su_sub = {art: k for art, k in klass_map.items() if k in ("SU", "SUB")}
+        self.faenologi_bits: Dict[str, int] = {}
+        for art, perioder in faenologi.items():
+            bits = 0
+            for fra, til in perioder:
+                a, b = _dag_i_aaret(fra), _dag_i_aaret(til)
+                if a is None or b is None:
+                    continue
+                if a <= b:
+                    bits |= ((1 << (b - a + 1)) - 1) << a
+                else:
+                    # Periode over nytår, fx 30-09 til 10-04
+                    bits |= ((1 << 365) - (1 << a)) | ((1 << (b + 1)) - 1)
+            if bits:
+                self.faenologi_bits[art] = bits
+        self.bemaerk = {
+            slug: {art: float(thr) for art, thr in thresholds.items()}
+            for slug, thresholds in bemaerk_by_region.items()
+        }
+        # Samme tærskler i lang form (region, art, tærskel) til den kolonnebaserede pipeline
+        self.bemaerk_table = [
+            (slug, art, thr) for slug, thresholds in self.bemaerk.items() for art, thr in thresholds.items()
+        ]
+        # Memo: Dato[:5] -> dag i året, og rå DOF_afdeling -> regionernes tærskler
+        self._dage: Dict[str, int | None] = {}
+        self._afdelinger: Dict[str, tuple] = {}
+
+    def region_slugs(self, afdeling_raw: str) -> List[str]:
+        """Regioner med bemærk-tærskler for et DOF_afdeling-felt, i feltets rækkefølge."""
+        # En observation kan være knyttet til flere lokalafdelinger ("DOF Fyn | DOF Sønderjylland")
+        raw = str(afdeling_raw)
+        afdelinger = [s.strip() for s in raw.split("|") if s.strip()]
+        if not afdelinger:
+            afdelinger = [raw.strip()] if raw.strip() else []
+        slugs = (to_region_slug(afd) for afd in afdelinger)
+        return [slug for slug in slugs if slug in self.bemaerk]
+
+    def _regioner(self, afdeling_raw: str) -> tuple:
+        return tuple(self.bemaerk[slug] for slug in self.region_slugs(afdeling_raw))
+
+    def classify(self, row: Dict[str, str]) -> str:
+        # Fjern firkantede parenteser hvis de findes (normalisering)
+        art = (row.get("Artnavn") or "").strip().strip("[]")
+
+        # 1) SU/SUB fra klassifikationen HAR FORRANG
+        klass = self.su_sub.get(art)
+        if klass:
+            return klass
+
+        # 2) fænologi -> bemaerk
+        bits = self.faenologi_bits.get(art)
+        if bits:
+            obsdato = (row.get("Dato") or "").strip()
+            if obsdato:
+                key = obsdato[:5]
+                try:
+                    dag = self._dage[key]
+                except KeyError:
+                    dag = self._dage[key] = _dag_i_aaret(key)
+                if dag is not None and bits >> dag & 1:
+                    return "bemaerk"
+
+        # 3) bemærk-tærskel -> bemaerk, hvis tærsklen er ramt i mindst én af afdelingerne
+        afdeling_raw = row.get("DOF_afdeling") or ""
+        try:
+            regioner = self._afdelinger[afdeling_raw]
+        except KeyError:
+            regioner = self._afdelinger[afdeling_raw] = self._regioner(afdeling_raw)
+        antal = None
+        for thresholds in regioner:
+            thr = thresholds.get(art)
+            if thr is not None:
+                if antal is None:
+                    antal = parse_float(row.get("Antal"))
+                if antal >= thr:
+                    return "bemaerk"
+
+        # 4) standard
+        return "alm"
+
+
+
+# --- Referencedata (klassifikation, bemærk-tærskler, fænologi) ---
+# De 15 CSV-filer omskrives kun af serverens fetch-endpoints (natligt, eller ved ukendt art).
+# Hver fil parses derfor kun igen når (mtime_ns, størrelse) har ændret sig, og klassifikatoren
+# bygges kun om når indholdet faktisk er ændret. REF_VERSION er en kort sha256 af filernes
+# indhold; den sendes med hver række i batchen, så serveren kan se hvilken klassifikation der
+# har produceret den, og samme indhold giver samme version på tværs af genstarter.
+KLASS_FILE = os.path.join(DATA_DIR, "arter_filter_klassificeret.csv")
+FAENOLOGI_FILE = os.path.join(DATA_DIR, "faenologi.csv")
+BEMAERK_SUFFIX = "_bemaerk_parsed.csv"
+
+_REF_FILES: Dict[str, Tuple[Tuple[int, int], str, object]] = {}  # sti -> (stamp, sha256, parset indhold)
+KLASS_MAP: Dict[str, str] = {}
+BEMAERK_BY_REGION: Dict[str, Dict[str, int]] = {}
+FAENOLOGI_PERIODER: Dict[str, List[Tuple[str, str]]] = {}
+CLASSIFIER = KategoriClassifier(KLASS_MAP, FAENOLOGI_PERIODER, BEMAERK_BY_REGION)
+REF_VERSION = ""
+
+def _load_reference_file(path: str, parse) -> Tuple[str, object]:
+    """(sha256, parset indhold) for path; læses og parses kun hvis (mtime_ns, størrelse) er ændret.
+
+    En manglende fil giver ("", None). Ved læse-/parsefejl caches intet, så næste cyklus prøver igen.
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        _REF_FILES.pop(path, None)
+        return "", None
+    stamp = (st.st_mtime_ns, st.st_size)
+    cached = _REF_FILES.get(path)
+    if cached and cached[0] == stamp:
+        return cached[1], cached[2]
+    try:
+        with open(path, "rb") as f:
+            raw = f.read()
+        value = parse(io.TextIOWrapper(io.BytesIO(raw), encoding="utf-8-sig"))
+    except Exception as e:
+        print(f"[watcher] Kunne ikke læse {os.path.basename(path)}: {e}")
+        _REF_FILES.pop(path, None)
+        return "", None
+    digest = hashlib.sha256(raw).hexdigest()
+    _REF_FILES[path] = (stamp, digest, value)
+    return digest, value
+
+def refresh_reference_data() -> bool:
+    """Genindlæs ændrede referencefiler og byg KLASS_MAP, BEMAERK_BY_REGION, FAENOLOGI_PERIODER og
+    CLASSIFIER om, hvis indholdet er ændret. Returnerer True når REF_VERSION er skiftet."""
+    global KLASS_MAP, BEMAERK_BY_REGION, FAENOLOGI_PERIODER, CLASSIFIER, REF_VERSION
+    h = hashlib.sha256()
+    klass_digest, klass_map = _load_reference_file(KLASS_FILE, load_klassifikation_map)
+    h.update(f"klassifikation:{klass_digest}\n".encode())
+    faen_digest, faenologi = _load_reference_file(FAENOLOGI_FILE, load_faenologi_perioder)
+    h.update(f"faenologi:{faen_digest}\n".encode())
+    bemaerk_paths = sorted(glob.glob(os.path.join(DATA_DIR, "*" + BEMAERK_SUFFIX)))
+    region_maps: Dict[str, Dict[str, int]] = {}
+    for fp in bemaerk_paths:
+        digest, thresholds = _load_reference_file(fp, load_bemaerk_thresholds)
+        if thresholds is None:
+            continue
+        slug = os.path.basename(fp).replace(BEMAERK_SUFFIX, "")
+        region_maps[slug] = thresholds
+        h.update(f"{slug}:{digest}\n".encode())
+    # Glem bemærk-filer der er forsvundet siden sidst
+    for fp in [fp for fp in _REF_FILES if fp.endswith(BEMAERK_SUFFIX) and fp not in bemaerk_paths]:
+        del _REF_FILES[fp]
+
+    version = h.hexdigest()[:12]
+    if version == REF_VERSION:
+        return False
+    KLASS_MAP = klass_map or {}
+    FAENOLOGI_PERIODER = faenologi or {}
+    BEMAERK_BY_REGION = region_maps
+    CLASSIFIER = KategoriClassifier(KLASS_MAP, FAENOLOGI_PERIODER, BEMAERK_BY_REGION)
+    if REF_VERSION:
+        print(f"[watcher] Referencedata ændret: version {REF_VERSION} -> {version}")
+    REF_VERSION = version
+    return True
+
+refresh_reference_data()
+
 def compute_kategori(row: Dict[str, str]) -> str:
-    art = (row.get("Artnavn") or "").strip()
-    # Fjern firkantede parenteser hvis de findes (normalisering)
-    art = art.strip("[]")
-    obsdato = (row.get("Dato") or "").strip()
-
-    # 1) SU/SUB fra klassifikationen HAR FORRANG
-    klass = KLASS_MAP.get(art)
-    if klass == "SU":
-        return "SU"
-    if klass == "SUB":
-        return "SUB"
-
-    # 2) fænologi -> bemaerk
-    perioder = FAENOLOGI_PERIODER.get(art)
-    if perioder and obsdato and _dato_in_faenologi_periode(obsdato, perioder):
-        return "bemaerk"
-
-    # 3) bemærk-tærskel -> bemaerk
-    # En observation kan være knyttet til flere lokalafdelinger.
-    # I så fald er den bemaerk hvis tærsklen er ramt i mindst én afdeling.
-    afdeling_raw = row.get("DOF_afdeling") or ""
-    afdelinger = [s.strip() for s in str(afdeling_raw).split("|") if s.strip()]
-    if not afdelinger:
-        afdelinger = [str(afdeling_raw).strip()] if str(afdeling_raw).strip() else []
-
-    for afd in afdelinger:
-        region_slug = to_region_slug(afd)
-        thresholds = BEMAERK_BY_REGION.get(region_slug) or {}
-        thr = thresholds.get(art)
-        if thr is not None and parse_float(row.get("Antal")) >= float(thr):
-            return "bemaerk"
-
-    # 4) standard
-    return "alm"
+    return CLASSIFIER.classify(row)
 
 
 def _select_representative_row_for_change(
@@ -272,6 +385,13 @@ def _select_representative_row_for_change(
     # ellers seneste
     return max(lst, key=_parse_dt_from_row)
 
+def _url_date(obsdate: str) -> str:
+    # Formatér dato til DD-MM-YYYY hvis nødvendigt
+    if re.match(r"^\d{4}-\d{2}-\d{2}$", obsdate):
+        y, m, d = obsdate.split("-")
+        return f"{d}-{m}-{y}"
+    return obsdate
+
 def enrich_with_kategori(rows: List[Dict[str, str]]) -> List[Dict[str, str]]:
     for r in rows:
         r["kategori"] = compute_kategori(r)
@@ -281,13 +401,7 @@ def enrich_with_kategori(rows: List[Dict[str, str]]) -> List[Dict[str, str]]:
         tag = f"{slugify(art)}-{loknr}" if art and loknr else ""
         r["tag"] = tag
         kat = r["kategori"]  # <-- behold små bogstaver!
-        obsdate = (r.get("Dato") or "").strip()
-        # Formatér dato til DD-MM-YYYY hvis nødvendigt
-        if re.match(r"^\d{4}-\d{2}-\d{2}$", obsdate):
-            y, m, d = obsdate.split("-")
-            obsdate_fmt = f"{d}-{m}-{y}"
-        else:
-            obsdate_fmt = obsdate
+        obsdate_fmt = _url_date((r.get("Dato") or "").strip())
         dofnot_url = f"https://notifikation.dofbasen.dk/traad.html?date={obsdate_fmt}&id={slugify(art)}-{loknr}&from_notification=1"
         dofbasen_url = f"https://dofbasen.dk/popobs.php?obsid={obsid}&summering=tur&obs=obs" if obsid else ""
         obsid_url = f"https://notifikation.dofbasen.dk/obsid.html?obsid={obsid}&from_notification=1"
@@ -306,28 +420,32 @@ def enrich_with_kategori(rows: List[Dict[str, str]]) -> List[Dict[str, str]]:
                 del r["obsid_url"]
     return rows
 
+# Windows-1252 smart quotes og typiske fejltegn (C1-tegn når cp1252 er læst som latin-1)
+SMART_QUOTES_TABLE = str.maketrans({
+    '\x93': '“',
+    '\x94': '”',
+    '\x91': '‘',
+    '\x92': '’',
+    '\x96': '-',   # En dash
+    '\x97': '—',   # Em dash
+    '\x85': '…',   # Ellipsis
+    '\x86': '†',
+    '\x87': '‡',
+    '\x8b': '‹',
+    '\x9b': '›',
+    '\x8c': 'Œ',
+    '\x9c': 'œ',
+    '\x80': '€',
+    '\x82': ',',
+    '\x84': '"',
+    '\x99': '™',
+    '\x9f': 'Ÿ',
+})
+
+_C1_CHARS = re.compile("[\x80-\x9f]")
+
 def fix_smart_quotes(text: str) -> str:
-    # Erstat Windows-1252 smart quotes og typiske fejltegn
-    return (
-        text.replace('\x93', '“')
-            .replace('\x94', '”')
-            .replace('\x91', '‘')
-            .replace('\x92', '’')
-            .replace('\x96', '-')   # En dash
-            .replace('\x97', '—')  # Em dash
-            .replace('\x85', '…')  # Ellipsis
-            .replace('\x86', '†')
-            .replace('\x87', '‡')
-            .replace('\x8b', '‹')
-            .replace('\x9b', '›')
-            .replace('\x8c', 'Œ')
-            .replace('\x9c', 'œ')
-            .replace('\x80', '€')
-            .replace('\x82', ',')
-            .replace('\x84', '"')
-            .replace('\x99', '™')
-            .replace('\x9f', 'Ÿ')
-    )
+    return text.translate(SMART_QUOTES_TABLE)
 
 def slugify(s):
     s = s.lower()
@@ -336,31 +454,18 @@ def slugify(s):
     return s.strip('-')
 
 
+# Felter der identificerer en observation uden Obsid (samme observation i flere afdelinger)
+FALLBACK_KEY_COLUMNS = (
+    "Dato", "Turid", "Loknr", "Artnr", "Artnavn", "Koen", "Adfkode", "Alderkode", "Dragtkode",
+    "Antal", "Obserkode", "Fornavn", "Efternavn", "Obstidfra", "Obstidtil", "Turtidfra", "Turtidtil",
+)
+
 def _row_identity_key(row: Dict[str, str]) -> tuple:
     """Stable dedupe key for the same observation across multiple departments."""
     obsid = (row.get("Obsid") or "").strip()
     if obsid:
         return ("obsid", obsid)
-    return (
-        "fallback",
-        (row.get("Dato") or "").strip(),
-        (row.get("Turid") or "").strip(),
-        (row.get("Loknr") or "").strip(),
-        (row.get("Artnr") or "").strip(),
-        (row.get("Artnavn") or "").strip(),
-        (row.get("Koen") or "").strip(),
-        (row.get("Adfkode") or "").strip(),
-        (row.get("Alderkode") or "").strip(),
-        (row.get("Dragtkode") or "").strip(),
-        (row.get("Antal") or "").strip(),
-        (row.get("Obserkode") or "").strip(),
-        (row.get("Fornavn") or "").strip(),
-        (row.get("Efternavn") or "").strip(),
-        (row.get("Obstidfra") or "").strip(),
-        (row.get("Obstidtil") or "").strip(),
-        (row.get("Turtidfra") or "").strip(),
-        (row.get("Turtidtil") or "").strip(),
-    )
+    return ("fallback",) + tuple((row.get(col) or "").strip() for col in FALLBACK_KEY_COLUMNS)
 
 
 def _merge_department_values(existing: str, incoming: str) -> str:
@@ -440,14 +545,9 @@ def _parse_obs_time(row):
 
 
 
-def save_threads_and_index(rows: List[Dict[str, str]], day: str):
-
-    base_dir = os.path.join("web", "obs", day)
-    threads_dir = os.path.join(base_dir, "threads")
-    os.makedirs(threads_dir, exist_ok=True)
+def group_threads(rows: List[Dict[str, str]]) -> Dict[str, List[Dict[str, str]]]:
+    """Saml SU/SUB-rækker i tråde: thread_id (art-slug + loknr) -> rækker."""
     threads = {}
-
-    # Saml SU/SUB-rækker i tråde
     for row in rows:
         if row.get("kategori") not in ("SU", "SUB"):
             continue
@@ -457,6 +557,16 @@ def save_threads_and_index(rows: List[Dict[str, str]], day: str):
             continue
         thread_id = f"{slugify(art)}-{loknr}"
         threads.setdefault(thread_id, []).append(row)
+    return threads
+
+
+def save_threads_and_index(rows: List[Dict[str, str]], day: str, threads: Dict[str, List[Dict[str, str]]] | None = None):
+
+    base_dir = os.path.join("web", "obs", day)
+    threads_dir = os.path.join(base_dir, "threads")
+    os.makedirs(threads_dir, exist_ok=True)
+    if threads is None:
+        threads = group_threads(rows)
 
     # Indlæs obsid_birthtimes
     birthtimes_path = os.path.join("web", "obsid_birthtimes.json")
@@ -584,6 +694,18 @@ def today_date_str() -> str:
     tz = pytz.timezone("Europe/Copenhagen")
     return datetime.now(pytz.UTC).astimezone(tz).strftime("%d-%m-%Y")
 
+# obsid -> epoch-tidspunkt hvor watcheren første gang så observationen (fra birthtime-loggen).
+# Bruges som starttidspunkt for latensmålingen i stage_ts.
+OBSID_FIRST_SEEN: Dict[str, float] = {}
+
+
+def _first_seen_epoch(entry: dict) -> float:
+    if entry.get("created_ts"):
+        return float(entry["created_ts"])
+    created = datetime.strptime(entry["created"], "%Y%m%d-%H%M%S")
+    return pytz.timezone("Europe/Copenhagen").localize(created).timestamp()
+
+
 def build_obsid_birthtimes(rows: List[Dict[str, str]], prev_birthtimes: dict) -> Dict[str, str]:
     """Returnér obsid -> første systemtid (HH:MM) for SU/SUB/bemaerk/faenologi.
        Gem også log over oprettelser til intern brug med YYYYMMDD-HHMMSS."""
@@ -606,35 +728,120 @@ def build_obsid_birthtimes(rows: List[Dict[str, str]], prev_birthtimes: dict) ->
         birthtimes[obsid] = now_hm
         birthtime_log[obsid] = {
             "created": now_full,
+            "created_ts": time.time(),
             "art": row.get("Artnavn", ""),
             "kategori": row.get("kategori", ""),
             "loknr": row.get("Loknr", ""),
             "dato": row.get("Dato", "")
         }
+    if len(OBSID_FIRST_SEEN) > 100000:
+        OBSID_FIRST_SEEN.clear()
+    for row in rows:
+        obsid = (row.get("Obsid") or "").strip()
+        if obsid and obsid not in OBSID_FIRST_SEEN and obsid in birthtime_log:
+            try:
+                OBSID_FIRST_SEEN[obsid] = _first_seen_epoch(birthtime_log[obsid])
+            except Exception:
+                pass
     # Gem log til fil
     with open(log_path, "w", encoding="utf-8") as f:
         json.dump(birthtime_log, f, ensure_ascii=False, indent=2)
     return birthtimes
 
 
-def fetch_excel_text(date_str=None) -> str:
+def fetch_excel_rows(date_str=None, prev: dict | None = None) -> Tuple[Iterator[Dict[str, str]] | None, dict]:
+    """Hent dagens eksport. Returnér (rækker, fetch_info).
+
+    Svaret læses i bidder og hashes (sha256) undervejs; bidderne gemmes som de kom (én kopi af
+    svaret, ingen samlet tekst). Med prev (fetch_info fra sidste hentning af samme dato) sendes
+    If-None-Match/If-Modified-Since, og ved 304 eller samme digest som prev er rækker None, så
+    intet dekodes eller parses. Ellers er rækker en generator af rensede rækker med de 38
+    kolonner, der dekodes og parses fra bidderne mens den forbruges.
+    """
     if date_str is None:
         date_str = today_date_str()
     url = BASE_URL.format(date=date_str)
-    resp = requests.get(url, timeout=30)
-    resp.raise_for_status()
-
-    # Prøv robuste decodes (danske tegn)
-    for enc in ("utf-8-sig", resp.encoding, "latin-1"):
+    headers = {}
+    if prev and prev.get("etag"):
+        headers["If-None-Match"] = prev["etag"]
+    if prev and prev.get("last_modified"):
+        headers["If-Modified-Since"] = prev["last_modified"]
+    resp = requests.get(url, timeout=30, headers=headers, stream=True)
+    try:
+        if resp.status_code == 304 and prev:
+            return None, dict(prev)
+        resp.raise_for_status()
+        digest = hashlib.sha256()
+        chunks = []
+        for chunk in resp.iter_content(chunk_size=FETCH_CHUNK_SIZE):
+            digest.update(chunk)
+            chunks.append(chunk)
+    finally:
+        resp.close()
+    info = {
+        "digest": digest.hexdigest(),
+        "etag": resp.headers.get("ETag"),
+        "last_modified": resp.headers.get("Last-Modified"),
+    }
+    if prev and prev.get("digest") == info["digest"]:
+        return None, info
+    return iter_rows(iter_lines(iter_decoded(chunks, resp.encoding))), info
+
+
+def _detect_encoding(probe: bytes, declared: str | None) -> str:
+    # Prøv robuste decodes (danske tegn) – på den første bid med ikke-ASCII-bytes
+    for enc in ("utf-8-sig", declared):
         if not enc:
             continue
         try:
-            return resp.content.decode(enc)
-        except Exception:
+            codecs.getincrementaldecoder(enc)().decode(probe, final=False)
+            return enc
+        except (LookupError, UnicodeDecodeError):
             continue
-
-    # Sidste udvej
-    return resp.text
+    return "latin-1"
+
+
+def iter_decoded(chunks: Iterable[bytes], declared: str | None = None) -> Iterator[str]:
+    """Dekod bytes i bidder. Kodningen vælges én gang, ved den første bid med ikke-ASCII-bytes
+    (ren ASCII er ens i alle kandidaterne)."""
+    decoder = None
+    for chunk in chunks:
+        if decoder is None:
+            if chunk.isascii():
+                if chunk:
+                    yield chunk.decode("ascii")
+                continue
+            decoder = codecs.getincrementaldecoder(_detect_encoding(chunk, declared))()
+        try:
+            text = decoder.decode(chunk)
+        except UnicodeDecodeError as e:
+            # Ugyldig UTF-8 længere nede: resten læses som latin-1 (som før, hvor hele svaret faldt tilbage)
+            print(f"[watcher] Dekodningsfejl midt i eksporten ({e}); fortsætter som latin-1")
+            decoder = codecs.getincrementaldecoder("latin-1")()
+            text = decoder.decode(chunk)
+        if text:
+            yield text
+    if decoder is not None:
+        tail = decoder.decode(b"", final=True)
+        if tail:
+            yield tail
+
+
+def iter_lines(pieces: Iterable[str]) -> Iterator[str]:
+    """Linjer inkl. linjeskift, delt på "\n" alene (ligesom io.StringIO – \x85 er et tegn her)."""
+    buf = ""
+    for piece in pieces:
+        buf += piece
+        start = 0
+        while True:
+            end = buf.find("\n", start)
+            if end < 0:
+                break
+            yield buf[start:end + 1]
+            start = end + 1
+        buf = buf[start:]
+    if buf:
+        yield buf
 
 
 def sniff_delimiter(sample: str) -> str:
@@ -650,51 +857,62 @@ def sniff_delimiter(sample: str) -> str:
         return ","
 
 
-def parse_rows_from_text(text: str) -> List[Dict[str, str]]:
-    delim = sniff_delimiter(text)
-    reader = csv.DictReader(io.StringIO(text), delimiter=delim)
-    rows: List[Dict[str, str]] = []
-
-    for row in reader:
-        if row is None:
-            continue
-        # Trim whitespace i nøgler og værdier
-        cleaned: Dict[str, str] = {}
-        for k, v in row.items():
-            if k is None:
-                continue
-            key = k.strip()
-            val = v.strip() if isinstance(v, str) else ("" if v is None else str(v))
-            # Fix smart quotes
-            val = fix_smart_quotes(val)
-            cleaned[key] = val
-
-        # Skip helt tomme linjer
-        if not any(v for v in cleaned.values()):
+def iter_rows(lines: Iterable[str]) -> Iterator[Dict[str, str]]:
+    """Rensede rækker med præcis de 38 kolonner (trimmet, smart quotes rettet); tomme linjer springes over."""
+    lines = iter(lines)
+    head = []
+    size = 0
+    for line in lines:
+        head.append(line)
+        size += len(line)
+        if size >= 2 * 4096:  # sniff_delimiter bruger 4096 tegn efter \r\n -> \n
+            break
+    # translate er dyr pr. felt; kun poster hvis linjer har C1-tegn (\x80-\x9f) skal rettes
+    c1_seen = False
+
+    def watched(source):
+        nonlocal c1_seen
+        for line in source:
+            if not line.isascii() and _C1_CHARS.search(line):
+                c1_seen = True
+            yield line
+
+    reader = csv.reader(watched(itertools.chain(head, lines)), delimiter=sniff_delimiter("".join(head)))
+    header = next(reader, None)
+    if header is None:
+        return
+    index = {}
+    for i, name in enumerate(header):
+        index[name.strip()] = i  # som DictReader: ved dubletter vinder den sidste
+    width = len(header)
+    columns = [(col, index.get(col)) for col in COLUMNS]
+    for fields in reader:
+        fix, c1_seen = c1_seen, False
+        # Skip helt tomme linjer (felter ud over headeren tæller ikke med, som i DictReader)
+        if not any(f.strip() for f in fields[:width]):
             continue
+        n = len(fields)
+        if fix:
+            yield {
+                col: fields[i].strip().translate(SMART_QUOTES_TABLE) if i is not None and i < n else ""
+                for col, i in columns
+            }
+        else:
+            yield {col: fields[i].strip() if i is not None and i < n else "" for col, i in columns}
 
-        rows.append(cleaned)
-
-    return rows
 
 def send_update(rows: List[Dict[str, str]]) -> None:
     """Send en batch som JSON-array til serveren."""
     try:
         headers = {"X-API-Token": os.environ.get("UPDATE_API_TOKEN", "")}
+        sent = time.time()
+        for row in rows:
+            row.setdefault("stage_ts", {})["sent"] = sent
         resp = requests.post(SERVER_URL, json=rows, timeout=50, headers=headers)
         resp.raise_for_status()
     except Exception as e:
         print(f"[watcher] Fejl ved POST: {e}")
 
-def ensure_all_columns(row: Dict[str, str]) -> Dict[str, str]:
-    """Returnér en ny dict med KUN de 38 kolonner og altid alle til stede."""
-    return {col: (row.get(col, "") or "").strip() for col in COLUMNS}
-
-
-def normalize_rows(rows: List[Dict[str, str]]) -> List[Dict[str, str]]:
-    return [ensure_all_columns(r) for r in rows]
-
-
 def parse_float(val: str) -> float:
     """Parse Antal (danske talformater). Bruges kun til diff-sammenligning."""
     if val is None:
@@ -763,6 +981,35 @@ def save_state(state: Dict[str, Dict[str, object]]) -> None:
         json.dump(state, f, ensure_ascii=False)
 
 
+def load_fetch_state() -> Dict[str, dict]:
+    """dato (DD-MM-YYYY) -> {digest, etag, last_modified, checked, changed, unchanged, ref_version}."""
+    try:
+        with open(FETCH_STATE_FILE, "r", encoding="utf-8") as f:
+            data = json.load(f)
+            if isinstance(data, dict):
+                return data
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"[watcher] Kunne ikke læse fetch-state: {e}")
+    return {}
+
+
+def save_fetch_state(fetch_state: Dict[str, dict]) -> None:
+    cutoff = datetime.now() - timedelta(days=FETCH_STATE_KEEP_DAYS)
+    for day in list(fetch_state):
+        try:
+            if datetime.strptime(day, "%d-%m-%Y") < cutoff:
+                del fetch_state[day]
+        except ValueError:
+            del fetch_state[day]
+    os.makedirs(os.path.dirname(FETCH_STATE_FILE), exist_ok=True)
+    tmp = FETCH_STATE_FILE + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(fetch_state, f, ensure_ascii=False)
+    os.replace(tmp, FETCH_STATE_FILE)
+
+
 def _state_get_antal(state_val) -> float | None:
     """Håndter evt. gammel state-struktur."""
     if state_val is None:
@@ -878,21 +1125,283 @@ def latest_row_for_key(k: str, rows_by_key: Dict[str, List[Dict[str, str]]]) ->
     return max(lst, key=_parse_dt_from_row)
 
 
-def run_once(date_str=None, send_notifications=True):
-    global KLASS_MAP, BEMAERK_BY_REGION, FAENOLOGI_PERIODER
-    
-    # Reload klassifikation fra CSV hver gang (så ændringer bliver hentet)
-    KLASS_MAP = load_klassifikation_map()
-    BEMAERK_BY_REGION = build_bemaerk_maps()
-    FAENOLOGI_PERIODER = load_faenologi_perioder()
-    
-    old_state = load_state()
+# --- Kolonnebaseret pipeline (pandas, valgfri) ---
+# WATCHER_PIPELINE=columnar (eller --columnar) lægger hele dagens eksport i en DataFrame (kun de
+# kolonner der regnes på) og laver dedupe, Antal, kategori og trådgruppering pr. kolonne. Resultatet
+# er det samme som dedupe_rows + enrich_with_kategori + group_threads (tjekkes af
+# .tools/check_columnar_equivalence.py). Værdier med få forskellige udfald (Antal, Dato,
+# DOF_afdeling, Artnavn) beregnes én gang pr. unik værdi.
+COLUMNAR_PIPELINE = os.getenv("WATCHER_PIPELINE", "").strip().lower() == "columnar"
 
-    text = fetch_excel_text(date_str)
-    parsed_rows = parse_rows_from_text(text)
-    normalized_rows = normalize_rows(parsed_rows)
-    normalized_rows = dedupe_rows(normalized_rows)
-    enriched_all = enrich_with_kategori(normalized_rows)
+
+def columnar_available() -> bool:
+    try:
+        import pandas  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _map_unique(series, fn):
+    uniques = series.unique()
+    return series.map(dict(zip(uniques, map(fn, uniques))))
+
+
+def _fold_antal(values: List[str]) -> str:
+    # dedupe_rows' Antal-regel trin for trin (bruges kun for grupper med ikke-heltal)
+    cur = values[0]
+    for val in values[1:]:
+        if not cur and val:
+            cur = val
+        best = max(parse_float(cur), parse_float(val))
+        cur = str(int(best)) if best.is_integer() else str(best)
+    return cur
+
+
+# Kolonner som den kolonnebaserede pipeline regner på; resten følger med fra rækkerne
+FRAME_COLUMNS = ("Obsid", "Artnavn", "Loknr", "Dato", "Antal", "DOF_afdeling")
+
+
+def load_export_frame(rows: List[Dict[str, str]]):
+    """DataFrame med FRAME_COLUMNS fra de parsede rækker (iter_rows), én række pr. eksportrække."""
+    import pandas as pd
+    # object-kolonner, så .str-metoderne er Pythons egne (strip, lower, re) som i dict-vejen
+    return pd.DataFrame({col: [r[col] for r in rows] for col in FRAME_COLUMNS}, dtype=object)
+
+
+def _columnar_dedupe(rows: List[Dict[str, str]], frame):
+    """dedupe_rows kolonnevis.
+
+    Returnerer (første række pr. gruppe, DataFrame med gruppernes fælles værdier for
+    FRAME_COLUMNS, {(gruppe, kolonne): værdi} for øvrige kolonner udfyldt fra dubletter).
+    """
+    import numpy as np
+    import pandas as pd
+
+    obsid = frame["Obsid"].str.strip()
+    keys = obsid.to_numpy(dtype=object, copy=True)
+    fallback = np.flatnonzero((obsid == "").to_numpy())
+    for i in fallback.tolist():
+        keys[i] = tuple(rows[i][col].strip() for col in FALLBACK_KEY_COLUMNS)
+    codes, _ = pd.factorize(keys)
+    _, first = np.unique(codes, return_index=True)
+    sizes = np.bincount(codes)
+
+    out = frame.iloc[first].reset_index(drop=True)
+    out["Obsid"] = obsid.to_numpy(dtype=object)[first]
+    out["DOF_afdeling"] = _map_unique(out["DOF_afdeling"], lambda v: _merge_department_values(v, ""))
+    filled: Dict[Tuple[int, str], str] = {}
+
+    in_dup = sizes[codes] > 1
+    if not in_dup.any():
+        return first, out, filled
+    # Rækker i grupper med dubletter, sorteret stabilt efter gruppe (rækkefølgen i gruppen bevares)
+    dup_rows = np.flatnonzero(in_dup)
+    dup_rows = dup_rows[np.argsort(codes[dup_rows], kind="stable")]
+    dup_codes = codes[dup_rows]
+    starts = np.flatnonzero(np.r_[True, dup_codes[1:] != dup_codes[:-1]])
+    ends = np.r_[starts[1:], len(dup_rows)]
+    groups = dup_codes[starts]
+
+    # Øvrige kolonner: første ikke-tomme værdi i gruppen, hvis gruppens første række er tom
+    fill_cols = [col for col in COLUMNS if col not in ("DOF_afdeling", "Antal")]
+    get = operator.itemgetter(*fill_cols)
+    dup = np.empty((len(dup_rows), len(fill_cols)), dtype=object)
+    dup[:] = [get(rows[i]) for i in dup_rows.tolist()]
+    pos = np.where(dup != "", np.arange(len(dup_rows))[:, None], len(dup_rows))
+    firsts = np.minimum.reduceat(pos, starts, axis=0)
+    for k, c in zip(*np.nonzero((firsts < len(dup_rows)) & (firsts != starts[:, None]))):
+        filled[int(groups[k]), fill_cols[c]] = dup[firsts[k, c], c]
+    for col in FRAME_COLUMNS:
+        if col in fill_cols:
+            updates = [(g, v) for (g, c), v in filled.items() if c == col]
+            if updates:
+                g, v = zip(*updates)
+                out.loc[list(g), col] = list(v) if col != "Obsid" else [x.strip() for x in v]
+
+    # DOF_afdeling: alle dele i rækkefølge uden dubletter (uden hensyn til store/små bogstaver).
+    # Har ingen af rækkerne en del, ender dedupe_rows med den sidste rækkes rå værdi.
+    dup_afd = frame["DOF_afdeling"].to_numpy(dtype=object)[dup_rows]
+    parts = pd.Series(dup_afd, index=dup_codes).str.split("|").explode().str.strip()
+    parts = parts[parts != ""]
+    parts = pd.DataFrame({"g": parts.index, "part": parts.to_numpy(), "k": parts.str.lower().to_numpy()})
+    parts = parts.drop_duplicates(["g", "k"])
+    afd = dup_afd[ends - 1]
+    if len(parts):
+        g = parts["g"].to_numpy()
+        part_starts = np.flatnonzero(np.r_[True, g[1:] != g[:-1]])
+        sep = np.full(len(g), " | ", dtype=object)
+        sep[part_starts] = ""
+        afd[np.searchsorted(groups, g[part_starts])] = np.add.reduceat(sep + parts["part"].to_numpy(), part_starts)
+    out.loc[groups, "DOF_afdeling"] = afd
+
+    # Antal: største Antal i gruppen (en tom første værdi tæller ikke med). Grupper med
+    # ikke-heltal følger dedupe_rows trin for trin, da mellemresultatet genparses.
+    antal_raw = frame["Antal"].to_numpy(dtype=object)[dup_rows]
+    antal = _map_unique(pd.Series(antal_raw), parse_float).to_numpy(dtype=float)
+    integral = np.isfinite(antal) & (np.floor(antal) == antal)
+    candidate = antal.copy()
+    candidate[starts[antal_raw[starts] == ""]] = -np.inf
+    best = np.maximum.reduceat(candidate, starts)
+    simple = np.logical_and.reduceat(integral, starts)
+    result = np.empty(len(groups), dtype=object)
+    result[simple] = [str(int(v)) for v in best[simple]]
+    for k in np.flatnonzero(~simple):
+        result[k] = _fold_antal(antal_raw[starts[k]:ends[k]].tolist())
+    out.loc[groups, "Antal"] = result
+    return first, out, filled
+
+
+def columnar_dedupe_enrich(rows: List[Dict[str, str]], classifier: KategoriClassifier | None = None):
+    """dedupe_rows + enrich_with_kategori + group_threads kolonnevis med pandas.
+
+    rows er de parsede rækker fra iter_rows (alle 38 kolonner som str). Returnerer (rækker,
+    tråde) med samme indhold og nøglerækkefølge som den dict-baserede vej.
+    """
+    import numpy as np
+    import pandas as pd
+
+    classifier = classifier or CLASSIFIER
+    if not rows:
+        return [], {}
+    first, out, filled = _columnar_dedupe(rows, load_export_frame(rows))
+    m = len(out)
+
+    art_raw = _map_unique(out["Artnavn"], str.strip)
+    art = _map_unique(art_raw, lambda v: v.strip("[]"))
+    loknr = _map_unique(out["Loknr"], str.strip)
+    dato = _map_unique(out["Dato"], str.strip)
+
+    # 1) SU/SUB fra klassifikationen
+    su_sub = art.map(classifier.su_sub)
+
+    # 2) fænologi: artens dag-bitset som boolsk matrix, slået op på (art, dag i året)
+    dag = _map_unique(dato, lambda v: _dag_i_aaret(v[:5])).fillna(-1).to_numpy(dtype=int)
+    species = pd.unique(art[art.isin(classifier.faenologi_bits.keys())])
+    phen = np.zeros(m, dtype=bool)
+    if len(species):
+        matrix = np.stack([
+            np.unpackbits(
+                np.frombuffer(classifier.faenologi_bits[a].to_bytes(46, "little"), dtype=np.uint8), bitorder="little"
+            )[:365].astype(bool)
+            for a in species
+        ])
+        idx = art.map({a: i for i, a in enumerate(species)}).to_numpy(dtype=float)
+        ok = ~np.isnan(idx) & (dag >= 0)
+        phen[ok] = matrix[idx[ok].astype(int), dag[ok]]
+
+    # 3) bemærk-tærskler: (række, region) mod tabellen (region, art, tærskel), kun for rækker
+    # der ikke allerede er afgjort og hvis art har en tærskel et sted
+    table = pd.DataFrame(classifier.bemaerk_table, columns=["slug", "art", "thr"])
+    need = np.flatnonzero(su_sub.isna().to_numpy() & ~phen & art.isin(table["art"]).to_numpy())
+    over = np.zeros(m, dtype=bool)
+    if len(need):
+        pairs = pd.DataFrame({
+            "row": need,
+            "art": art.to_numpy(dtype=object)[need],
+            "slug": _map_unique(out["DOF_afdeling"].iloc[need], classifier.region_slugs).to_numpy(dtype=object),
+        }).explode("slug").dropna(subset=["slug"])
+        hits = pairs.merge(table, on=["slug", "art"])
+        antal = _map_unique(out["Antal"], parse_float).to_numpy(dtype=float)
+        rows_hit = hits["row"].to_numpy(dtype=int)
+        over[rows_hit[antal[rows_hit] >= hits["thr"].to_numpy(dtype=float)]] = True
+
+    kategori = np.where(su_sub.notna(), su_sub.to_numpy(dtype=object), np.where(phen | over, "bemaerk", "alm"))
+
+    # tag og links som i enrich_with_kategori (links bygges kun for de rækker der bruger dem)
+    slug_lok = _map_unique(art_raw, slugify).to_numpy(dtype=object) + "-" + loknr.to_numpy(dtype=object)
+    tag = np.where((art_raw != "").to_numpy() & (loknr != "").to_numpy(), slug_lok, "")
+    obsid = out["Obsid"].to_numpy(dtype=object)
+    su = np.isin(kategori, ("SU", "SUB"))
+    urls = np.empty(m, dtype=object)
+    urls[~su] = "https://notifikation.dofbasen.dk/obsid.html?obsid=" + obsid[~su] + "&from_notification=1"
+    url_date = _map_unique(dato, _url_date).to_numpy(dtype=object)
+    urls[su] = (
+        "https://notifikation.dofbasen.dk/traad.html?date=" + url_date[su] + "&id=" + slug_lok[su]
+        + "&from_notification=1"
+    )
+    url2 = np.where(obsid[su] != "", "https://dofbasen.dk/popobs.php?obsid=" + obsid[su] + "&summering=tur&obs=obs", "")
+
+    # Rækkerne bygges som kopi af gruppens første række med de beregnede felter
+    records = []
+    for i, afd, antal_str, kat, t, url in zip(
+        first.tolist(), out["DOF_afdeling"].tolist(), out["Antal"].tolist(), kategori.tolist(), tag.tolist(), urls.tolist()
+    ):
+        r = dict(rows[i])
+        r["DOF_afdeling"] = afd
+        r["Antal"] = antal_str
+        r["kategori"] = kat
+        r["tag"] = t
+        r["url"] = url
+        records.append(r)
+    for (g, col), val in filled.items():
+        records[g][col] = val
+    for i, url in zip(np.flatnonzero(su).tolist(), url2.tolist()):
+        records[i]["url2"] = url
+
+    # Tråde: SU/SUB-rækker med art og loknr, grupperet på tag i første-forekomst-rækkefølge
+    idx = np.flatnonzero(su & (tag != ""))
+    threads: Dict[str, List[Dict[str, str]]] = {}
+    if len(idx):
+        codes, uniques = pd.factorize(tag[idx])
+        members = [[] for _ in uniques]
+        for code, i in zip(codes.tolist(), idx.tolist()):
+            members[code].append(records[i])
+        threads = dict(zip(uniques, members))
+    return records, threads
+
+
+def run_once(date_str=None, send_notifications=True, force=False):
+    """Hent, berig og send ændringer for én dato.
+
+    Er eksporten uændret siden sidste kørsel for datoen (samme sha256, eller 304 på ETag/
+    Last-Modified) og beriget med samme REF_VERSION, springes alt efterfølgende over, og kun
+    heartbeat i fetch_state opdateres.
+    force=True (sync-requests) kører altid hele vejen.
+    """
+    # Referencedata parses kun igen hvis filerne er ændret (mtime/størrelse)
+    refresh_reference_data()
+
+    today = date_str or today_date_str()
+    fetch_state = load_fetch_state()
+    prev_fetch = None if force else fetch_state.get(today)
+    if prev_fetch and prev_fetch.get("ref_version") != REF_VERSION:
+        # Ny klassifikation: eksporten skal beriges igen, så hent uden ETag/Last-Modified
+        prev_fetch = None
+
+    # Tidsstempler pr. stadie (epoch) som sendes med hver række til serverens latensmåling
+    stage_ts = {"fetch_start": time.time()}
+    rows, fetch_info = fetch_excel_rows(today, prev_fetch)
+    stage_ts["fetched"] = time.time()
+    entry = fetch_state.setdefault(today, {})
+    entry["checked"] = stage_ts["fetched"]
+    if rows is None:
+        # 304 eller samme digest: evt. nye ETag/Last-Modified gemmes, så næste hentning kan give 304
+        entry.update(fetch_info)
+        entry["unchanged"] = entry.get("unchanged", 0) + 1
+        save_fetch_state(fetch_state)
+        print(f"[watcher] Uændret eksport for {today} – intet at gøre.")
+        return
+
+    # Rækkerne dekodes og parses fra de hentede bidder direkte ind i dedupe (eller en liste)
+    columnar = COLUMNAR_PIPELINE
+    if columnar:
+        export_rows = list(rows)
+    else:
+        normalized_rows = dedupe_rows(rows)
+    stage_ts["parsed"] = time.time()
+
+    def remember_fetch():
+        # Gemmes først når alt nedstrøms er gjort, så en fejl midt i kørslen prøves igen
+        entry.update(fetch_info, changed=time.time(), unchanged=0, ref_version=REF_VERSION)
+        save_fetch_state(fetch_state)
+
+    old_state = load_state()
+    if columnar:
+        enriched_all, threads = columnar_dedupe_enrich(export_rows)
+    else:
+        enriched_all, threads = enrich_with_kategori(normalized_rows), None
+    stage_ts["enriched"] = time.time()
 
     birthtimes_path = os.path.join("web", "obsid_birthtimes.json")
     if os.path.exists(birthtimes_path):
@@ -908,8 +1417,7 @@ def run_once(date_str=None, send_notifications=True):
     with open(birthtimes_path, "w", encoding="utf-8") as f:
         json.dump(obsid_birthtimes, f, ensure_ascii=False, indent=2)
 
-    today = date_str or today_date_str()
-    save_threads_and_index(enriched_all, today)
+    save_threads_and_index(enriched_all, today, threads)
 
     # Tilføj obsidbirthtime til hver observation før gem
     for r in enriched_all:
@@ -921,6 +1429,7 @@ def run_once(date_str=None, send_notifications=True):
     # Hvis vi kører i date-mode (dvs. date_str er angivet), skal vi ikke sende notifikationer
     if date_str and not send_notifications:
         print(f"[watcher] Kørte i date-mode for {date_str}: kun threads/index skrevet.")
+        remember_fetch()
         return
 
     # grupper til opslag
@@ -958,6 +1467,7 @@ def run_once(date_str=None, send_notifications=True):
         save_state(new_state)
 
         if batch:
+            stamp_stage_ts(batch, stage_ts)
             send_update(batch)
             print(f"[watcher] Ændringer: {len(batch)} rækker sendt.")
         else:
@@ -1020,10 +1530,23 @@ def run_once(date_str=None, send_notifications=True):
     save_state(new_state)
 
     if batch:
+        stamp_stage_ts(batch, stage_ts)
         send_update(batch)
         print(f"[watcher] Ændringer: {len(batch)} rækker sendt.")
     else:
         print("[watcher] Ingen ændringer.")
+    remember_fetch()
+
+def stamp_stage_ts(batch: List[Dict[str, str]], stage_ts: Dict[str, float]) -> None:
+    """Påfør watcherens stadie-tidsstempler (og first_seen pr. obsid) og REF_VERSION på rækkerne i en batch."""
+    diffed = time.time()
+    for row in batch:
+        row["ref_version"] = REF_VERSION
+        row_ts = dict(stage_ts, diffed=diffed)
+        first_seen = OBSID_FIRST_SEEN.get(_obsid(row))
+        if first_seen:
+            row_ts["first_seen"] = first_seen
+        row["stage_ts"] = row_ts
 
 def main():
     parser = argparse.ArgumentParser(description="DOF watcher")
@@ -1045,13 +1568,29 @@ def main():
         default=None,
         help="Dato i format DD-MM-YYYY (hvis ikke angivet bruges dags dato)",
     )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Behandl eksporten selv om den er uændret siden sidste kørsel",
+    )
+    parser.add_argument(
+        "--columnar",
+        action="store_true",
+        help="Brug den kolonnebaserede pipeline (pandas) til hele dagen, fx ved backfill",
+    )
     args = parser.parse_args()
 
+    global COLUMNAR_PIPELINE
+    COLUMNAR_PIPELINE = COLUMNAR_PIPELINE or args.columnar
+    if COLUMNAR_PIPELINE and not columnar_available():
+        print("[watcher] pandas er ikke installeret – bruger den almindelige pipeline.")
+        COLUMNAR_PIPELINE = False
+
     if not args.watch:
         # Hvis der gives en dato, send kun notifikationer hvis det er i dag
         today = datetime.now().strftime("%d-%m-%Y")
         send_notif = (args.date is None) or (args.date == today)
-        run_once(args.date, send_notifications=send_notif)
+        run_once(args.date, send_notifications=send_notif, force=args.force)
         return
 
     print(f"[watcher] Starter i watch-mode. Interval: {args.interval}s. Ctrl+C for stop.")
@@ -1081,14 +1620,14 @@ def main():
                     yesterday = (datetime.now() - timedelta(days=1)).strftime("%d-%m-%Y")
                     if sync == "today":
                         print("[watcher] Sync-request: i dag")
-                        run_once(today, send_notifications=True)
+                        run_once(today, send_notifications=True, force=True)
                     elif sync == "yesterday":
                         print("[watcher] Sync-request: i går")
-                        run_once(yesterday, send_notifications=False)
+                        run_once(yesterday, send_notifications=False, force=True)
                     elif sync == "both":
                         print("[watcher] Sync-request: både i dag og i går")
-                        run_once(today, send_notifications=True)
-                        run_once(yesterday, send_notifications=False)
+                        run_once(today, send_notifications=True, force=True)
+                        run_once(yesterday, send_notifications=False, force=True)
                     else:
                         print(f"[watcher] Sync-request: ukendt værdi '{sync}'")
                     try:
@@ -16,6 +16,9 @@ async function fetchArtsliste() {
 }
 
 let userFilters = { include: [], exclude: [], counts: {} };
+// Versionsnummer på præferencerne da filtrene blev hentet – serveren afviser (409) at gemme
+// oven i ændringer lavet i en anden fane/enhed imens
+let prefsVersion = null;
 let useAdvancedFilter = localStorage.getItem('useAdvancedFilter') === 'true';
 
 
@@ -41,6 +44,7 @@ async function fetchUserFilters() {
     body: JSON.stringify({ user_id, device_id })
   });
   if (res.ok) {
+    prefsVersion = res.headers.get('X-Prefs-Version');
     userFilters = await res.json();
     if (!userFilters.include) userFilters.include = [];
     if (!userFilters.exclude) userFilters.exclude = [];
@@ -53,11 +57,21 @@ async function fetchUserFilters() {
 async function saveUserFilters() {
   const user_id = localStorage.getItem('userid');
   const device_id = localStorage.getItem('deviceid');
-  await fetch('/api/prefs/user/species', {
+  const res = await fetch('/api/prefs/user/species', {
     method: 'POST',
     headers: { 'Content-Type': 'application/json' },
-    body: JSON.stringify({ user_id, device_id, filters: userFilters })
+    body: JSON.stringify({ user_id, device_id, filters: userFilters, version: prefsVersion })
   });
+  if (res.status === 409) {
+    alert('Dine filtre er ændret et andet sted. De nyeste filtre hentes – lav ændringen igen.');
+    await fetchUserFilters();
+    renderArtsTable();
+    return;
+  }
+  if (res.ok) {
+    const data = await res.json();
+    prefsVersion = data.version;
+  }
 }
 
 let allArter = [];
@@ -16,6 +16,58 @@ const afdelinger = [
   "DOF Nordjylland"
 ];
 const kategorier = ["Ingen", "SU", "SUB", "Bemærk"];
+
+// Session-token: serveren udsteder et signeret token (X-Session-Token), som sendes med
+// på alle /api/-kald, så den ikke skal slå enheden op i databasen for hver request.
+// Mangler tokenet eller er det udløbet, kører kaldene videre som før (serveren tjekker i DB).
+const SESSION_HEADER = "X-Session-Token";
+
+function sessionTokenValid(token) {
+  try {
+    const body = token.split(".")[0].replace(/-/g, "+").replace(/_/g, "/");
+    const claims = JSON.parse(atob(body));
+    return claims.exp * 1000 > Date.now() + 60000;
+  } catch (e) {
+    return false;
+  }
+}
+
+(function installSessionFetch() {
+  const origFetch = window.fetch.bind(window);
+  window.fetch = function(input, init) {
+    const url = new URL(typeof input === "string" ? input : input.url, location.href);
+    if (url.origin !== location.origin || !url.pathname.startsWith("/api/")) {
+      return origFetch(input, init);
+    }
+    const token = localStorage.getItem("session_token");
+    if (token && sessionTokenValid(token)) {
+      init = Object.assign({}, init);
+      const headers = new Headers(init.headers || (typeof input === "string" ? undefined : input.headers));
+      headers.set(SESSION_HEADER, token);
+      init.headers = headers;
+    }
+    return origFetch(input, init).then(res => {
+      const fresh = res.headers.get(SESSION_HEADER);
+      if (fresh) localStorage.setItem("session_token", fresh);
+      else if (fresh === "") localStorage.removeItem("session_token");
+      return res;
+    });
+  };
+
+  // Hent et nyt token én gang pr. sideindlæsning, hvis enheden er kendt men tokenet mangler/udløber
+  const userid = localStorage.getItem("userid");
+  const deviceid = localStorage.getItem("deviceid");
+  const token = localStorage.getItem("session_token");
+  if (userid && deviceid && !(token && sessionTokenValid(token))) {
+    localStorage.removeItem("session_token");
+    window.fetch("/api/session", {
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify({ user_id: userid, device_id: deviceid })
+    }).catch(() => null);
+  }
+})();
+
 const prefs = {};
 afdelinger.forEach(afd => prefs[afd] = "Ingen");
 
@@ -405,16 +457,18 @@ document.addEventListener("DOMContentLoaded", async () => {
     const qh = (prefs.quiet_hours && prefs.quiet_hours[device_id]) || {};
     if (qh.start) document.getElementById("quiet-start").value = qh.start;
     if (qh.end) document.getElementById("quiet-end").value = qh.end;
+    document.getElementById("quiet-defer").checked = !!qh.defer;
 
     updateQuietHoursStatus(qh);
 
     document.getElementById("save-quiet-hours-btn").onclick = async () => {
       const start = document.getElementById("quiet-start").value;
       const end = document.getElementById("quiet-end").value;
+      const defer = document.getElementById("quiet-defer").checked;
       const res = await fetch("/api/prefs/quiet-hours", {
         method: "POST",
         headers: { "Content-Type": "application/json" },
-        body: JSON.stringify({ user_id, device_id, start, end })
+        body: JSON.stringify({ user_id, device_id, start, end, defer })
       });
       const status = document.getElementById("quiet-hours-status");
       if (res.ok) {
@@ -439,6 +493,7 @@ document.addEventListener("DOMContentLoaded", async () => {
       });
       document.getElementById("quiet-start").value = "22:00";
       document.getElementById("quiet-end").value = "07:00";
+      document.getElementById("quiet-defer").checked = false;
       const status = document.getElementById("quiet-hours-status");
       if (res.ok) {
         updateQuietHoursStatus(null);